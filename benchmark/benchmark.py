@@ -0,0 +1,238 @@
+"""
+Benchmark of AnyNumberInARow3dEnv.
+
+Measure the step throughput, the latency of UtilClass.is_done, the reset cost, the random playout throughput
+and the peak memory of an episode for every combination of num_grid and num_win_seq, and print the results
+as JSON so that the runs can be compared.
+
+    python benchmark/benchmark.py --num-grid 4 6 8 --num-win-seq 3 4 --output result.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from gym_3d_connectX.envs import AnyNumberInARow3dEnv  # noqa: E402
+from gym_3d_connectX.envs.playout import random_playouts  # noqa: E402
+
+
+def make_env(args, num_grid, num_win_seq, record_history=False):
+    """
+    Create the environment of the benchmarked configuration.
+    """
+    return AnyNumberInARow3dEnv(num_grid=num_grid, num_win_seq=num_win_seq, win_check=args.win_check,
+                                backend=args.backend, obs_backend=args.obs_backend, obs_dtype=args.obs_dtype,
+                                record_history=record_history)
+
+
+def play_random_game(env, random_state):
+    """
+    Play a game with uniformly random legal actions and return the number of steps.
+    """
+    env.reset()
+    done = False
+    num_steps = 0
+    while not done:
+        _, _, done, _ = env.step(env.sample_legal_action(random_state))
+        num_steps += 1
+    return num_steps
+
+
+def random_boards(num_grid, num_boards, random_state):
+    """
+    Generate boards of random legal positions with half of the cells filled.
+    """
+    boards = []
+    for _ in range(num_boards):
+        board = np.zeros((num_grid, num_grid, num_grid), dtype=np.int8)
+        heights = np.zeros((num_grid, num_grid), dtype=np.intp)
+        player = 1
+        for action in random_state.choice(num_grid ** 3, num_grid ** 3 // 2, replace=False) % (num_grid ** 2):
+            wide, depth = divmod(int(action), num_grid)
+            if heights[wide, depth] < num_grid:
+                board[heights[wide, depth], wide, depth] = player
+                heights[wide, depth] += 1
+                player = -player
+        boards.append(board)
+    return boards
+
+
+def bench_step(args, num_grid, num_win_seq, random_state):
+    """
+    Steps per second of env.step with random legal actions, including the resets of the finished games.
+    """
+    env = make_env(args, num_grid, num_win_seq)
+    env.reset()
+    actions = []
+    for _ in range(args.steps):
+        actions.append(env.sample_legal_action(random_state))
+        _, _, done, _ = env.step(actions[-1])
+        if done:
+            actions.append(None)
+            env.reset()
+
+    # 行動の選択を計測に含めないように、記録した行動をもう一度再生して計測する
+    env.reset()
+    start = time.perf_counter()
+    for action in actions:
+        if action is None:
+            env.reset()
+        else:
+            env.step(action)
+    elapsed = time.perf_counter() - start
+    num_steps = sum(action is not None for action in actions)
+    return {"steps": num_steps, "seconds": elapsed, "steps_per_sec": num_steps / elapsed}
+
+
+def bench_is_done(args, num_grid, num_win_seq, random_state):
+    """
+    Latency of UtilClass.is_done on random half-filled boards.
+    """
+    env = make_env(args, num_grid, num_win_seq)
+    boards = random_boards(num_grid, 16, random_state)
+    env.utils.is_done(boards[0])  # ラインの表を作る時間は含めない
+    start = time.perf_counter()
+    for i in range(args.calls):
+        env.utils.is_done(boards[i % len(boards)])
+    elapsed = time.perf_counter() - start
+    return {"calls": args.calls, "seconds": elapsed, "usec_per_call": elapsed / args.calls * 1e6}
+
+
+def bench_reset(args, num_grid, num_win_seq, random_state):
+    """
+    Latency of env.reset after a game.
+    """
+    env = make_env(args, num_grid, num_win_seq)
+    elapsed = 0.0
+    for _ in range(args.resets):
+        # 空の盤面ではなく、石が置かれた盤面を初期化する時間を計る
+        for _ in range(num_grid):
+            _, _, done, _ = env.step(env.sample_legal_action(random_state))
+            if done:
+                break
+        start = time.perf_counter()
+        env.reset()
+        elapsed += time.perf_counter() - start
+    return {"calls": args.resets, "seconds": elapsed, "usec_per_call": elapsed / args.resets * 1e6}
+
+
+def bench_playout(args, num_grid, num_win_seq, random_state):
+    """
+    Random playouts per second through env.step, including the action sampling.
+    """
+    env = make_env(args, num_grid, num_win_seq)
+    num_steps = 0
+    start = time.perf_counter()
+    for _ in range(args.games):
+        num_steps += play_random_game(env, random_state)
+    elapsed = time.perf_counter() - start
+    return {"games": args.games, "seconds": elapsed, "games_per_sec": args.games / elapsed,
+            "mean_game_length": num_steps / args.games}
+
+
+def bench_playout_kernel(args, num_grid, num_win_seq, random_state):
+    """
+    Random playouts per second of the batched playout kernel.
+    """
+    num_games = args.games * args.kernel_factor
+    start = time.perf_counter()
+    result = random_playouts(num_games, num_grid=num_grid, num_win_seq=num_win_seq, random_state=random_state)
+    elapsed = time.perf_counter() - start
+    return {"games": num_games, "seconds": elapsed, "games_per_sec": num_games / elapsed,
+            "mean_game_length": float(result.lengths.mean())}
+
+
+def bench_memory(args, num_grid, num_win_seq, random_state):
+    """
+    Peak memory allocated while playing an episode with the history and rebuilding obs_history.
+    """
+    env = make_env(args, num_grid, num_win_seq, record_history=True)
+    env.reset()
+    tracemalloc.start()
+    try:
+        play_random_game(env, random_state)
+        _, episode_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    tracemalloc.start()
+    try:
+        obs_history = env.obs_history
+        _, history_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"episode_peak_bytes": episode_peak, "obs_history_peak_bytes": history_peak,
+            "obs_history_length": len(obs_history)}
+
+
+BENCHMARKS = {
+    "step": bench_step,
+    "is_done": bench_is_done,
+    "reset": bench_reset,
+    "playout": bench_playout,
+    "playout_kernel": bench_playout_kernel,
+    "memory": bench_memory,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-grid", type=int, nargs="+", default=[4, 6, 8])
+    parser.add_argument("--num-win-seq", type=int, nargs="+", default=[3, 4])
+    parser.add_argument("--benchmarks", nargs="+", choices=sorted(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--win-check", choices=["incremental", "full"], default="incremental")
+    parser.add_argument("--backend", choices=["numpy", "bitboard"], default="numpy")
+    parser.add_argument("--obs-backend", choices=["torch", "numpy"], default="numpy")
+    parser.add_argument("--obs-dtype", choices=["int8", "float32", "onehot"], default="int8")
+    parser.add_argument("--steps", type=int, default=2000, help="the number of steps of the step benchmark")
+    parser.add_argument("--calls", type=int, default=2000, help="the number of calls of the is_done benchmark")
+    parser.add_argument("--resets", type=int, default=500, help="the number of calls of the reset benchmark")
+    parser.add_argument("--games", type=int, default=20, help="the number of games of the playout benchmark")
+    parser.add_argument("--kernel-factor", type=int, default=100,
+                        help="the playout_kernel benchmark plays games * kernel_factor games")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON to this file instead of the standard output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for num_grid, num_win_seq in itertools.product(args.num_grid, args.num_win_seq):
+        if num_win_seq > num_grid:
+            continue
+        result = {"num_grid": num_grid, "num_win_seq": num_win_seq}
+        for name in args.benchmarks:
+            # 設定と計測項目ごとに乱数を初期化し、実行する項目を選んでも結果が変わらないようにする
+            result[name] = BENCHMARKS[name](args, num_grid, num_win_seq, np.random.RandomState(args.seed))
+        results.append(result)
+        print(f"num_grid={num_grid} num_win_seq={num_win_seq} done", file=sys.stderr)
+
+    report = {
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
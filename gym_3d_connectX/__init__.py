@@ -2,5 +2,10 @@ from gym.envs.registration import register
 
 register(
     id='3d-connectX-v0',
-    entry_point='gym_3d_connectX.env:AnyNumberInARow3dEnv'
+    entry_point='gym_3d_connectX.envs:AnyNumberInARow3dEnv'
+)
+
+register(
+    id='3d-connectX-sparse-v0',
+    entry_point='gym_3d_connectX.envs:SparseAnyNumberInARow3dEnv'
 )
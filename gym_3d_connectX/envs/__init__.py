@@ -1 +1,7 @@
 from gym_3d_connectX.envs.three_d_connect_n import AnyNumberInARow3dEnv
+from gym_3d_connectX.envs.vector_env import VectorAnyNumberInARow3dEnv
+from gym_3d_connectX.envs.bitboard import BitBoard
+from gym_3d_connectX.envs.subproc_vector_env import SubprocVectorAnyNumberInARow3dEnv
+from gym_3d_connectX.envs.solver import NegamaxSolver
+from gym_3d_connectX.envs.recording import EpisodeReader, EpisodeRecorder
+from gym_3d_connectX.envs.sparse import SparseAnyNumberInARow3dEnv, SparseBoard
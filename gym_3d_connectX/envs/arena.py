@@ -0,0 +1,252 @@
+import collections
+import math
+import multiprocessing
+import operator
+
+import numpy as np
+
+from gym_3d_connectX.envs.three_d_connect_n import AnyNumberInARow3dEnv
+
+# 各ゲームの結果。score は policy_a から見た 1 (勝ち), 0.5 (引き分け), 0 (負け)。
+GameResult = collections.namedtuple("GameResult", ["game_id", "a_first", "score", "num_moves", "forfeit"])
+
+MatchResult = collections.namedtuple("MatchResult", ["wins", "draws", "losses", "forfeits", "score", "elo",
+                                                     "elo_lower", "elo_upper", "games"])
+
+
+def random_policy(obs, legal_mask):
+    """
+    A policy choosing a legal action uniformly at random with the global random state of numpy.
+
+    Parameters
+    ----------
+    obs : ndarray
+        The observation (unused).
+    legal_mask : ndarray
+        The N x N boolean mask of the legal actions.
+
+    Return
+    ------
+    action : int
+        The action number.
+    """
+    return int(np.random.choice(np.flatnonzero(legal_mask)))
+
+
+def elo_from_score(score):
+    """
+    Parameter
+    ---------
+    score : float
+        The expected score (win = 1, draw = 0.5, loss = 0) against the opponent.
+
+    Return
+    ------
+    elo : float
+        The Elo rating difference against the opponent, infinite for the score 0 or 1.
+    """
+    if score <= 0:
+        return -math.inf
+    if score >= 1:
+        return math.inf
+    return -400 * math.log10(1 / score - 1)
+
+
+def summarize(games, z=1.96):
+    """
+    Count the results of the games and estimate the Elo difference with the confidence interval.
+
+    The interval is computed from the standard error of the mean score (the normal approximation),
+    and mapped to Elo by elo_from_score.
+
+    Parameters
+    ----------
+    games : list[GameResult]
+        The results of the games.
+    z : float
+        The quantile of the standard normal distribution of the interval (1.96 for 95 %).
+
+    Return
+    ------
+    result : MatchResult
+        wins, draws, losses : int
+            The numbers of the games policy_a won, drew and lost.
+        forfeits : tuple[int, int]
+            The numbers of the games lost by an illegal move of policy_a and of policy_b.
+        score : float
+            The mean score of policy_a.
+        elo, elo_lower, elo_upper : float
+            The estimated Elo difference of policy_a against policy_b and its confidence interval.
+        games : list[GameResult]
+            The results of the games in the order of game_id.
+    """
+    games = sorted(games, key=lambda game: game.game_id)
+    scores = np.array([game.score for game in games], dtype=np.float64)
+    num_games = len(scores)
+    score = scores.mean() if num_games else 0.5
+    error = z * scores.std() / math.sqrt(num_games) if num_games else math.inf
+    forfeits = (sum(game.forfeit == "a" for game in games), sum(game.forfeit == "b" for game in games))
+    return MatchResult(
+        wins=int((scores == 1).sum()),
+        draws=int((scores == 0.5).sum()),
+        losses=int((scores == 0).sum()),
+        forfeits=forfeits,
+        score=float(score),
+        elo=elo_from_score(score),
+        elo_lower=elo_from_score(score - error),
+        elo_upper=elo_from_score(score + error),
+        games=games,
+    )
+
+
+def play_game(env, first_policy, second_policy):
+    """
+    Play a game between two policies.
+
+    A policy is called with the observation and the N x N legal action mask and returns an action number.
+    A policy returning an illegal action (a full pile, a position off the board or not an integer)
+    loses the game by forfeit.
+
+    Parameters
+    ----------
+    env : AnyNumberInARow3dEnv
+        The environment. It is reset at the beginning of the game.
+    first_policy : callable
+        The policy of the first player.
+    second_policy : callable
+        The policy of the second player.
+
+    Returns
+    -------
+    winner : int
+        1 if first_policy won, -1 if second_policy won, or 0 for a draw.
+    num_moves : int
+        The number of the moves of the game.
+    forfeit : bool
+        Whether the game was decided by an illegal move.
+    """
+    env.reset()
+    # reset は手番を戻さないので、プレーヤー1を先手として始める
+    env.player = 1
+    obs = env.obs_builder.build(env.board, env.player)
+    policies = {1: first_policy, -1: second_policy}
+    num_moves = 0
+    while True:
+        mover = env.player
+        legal_mask = env.action_mask()
+        action = policies[mover](obs, legal_mask)
+        try:
+            action = operator.index(action)
+            is_legal = 0 <= action < legal_mask.size and legal_mask.flat[action]
+        except TypeError:
+            is_legal = False
+        if not is_legal:
+            return -mover, num_moves, True
+
+        obs, _, done, info = env.step(action)
+        num_moves += 1
+        if done:
+            return info["winner"], num_moves, False
+
+
+def _play_games(args):
+    """
+    Play the games of a chunk in a worker process and return their results.
+    """
+    policy_a, policy_b, game_ids, seed, env_kwargs = args
+    # fork したワーカーの乱数が同じにならないように、チャンクごとに初期化する
+    np.random.seed((seed + game_ids[0]) % 2 ** 32)
+    env = AnyNumberInARow3dEnv(**env_kwargs)
+    results = []
+    for game_id in game_ids:
+        a_first = game_id % 2 == 0
+        first_policy, second_policy = (policy_a, policy_b) if a_first else (policy_b, policy_a)
+        winner, num_moves, forfeit = play_game(env, first_policy, second_policy)
+        a_winner = winner if a_first else -winner
+        results.append(GameResult(
+            game_id=game_id,
+            a_first=a_first,
+            score=(a_winner + 1) / 2,
+            num_moves=num_moves,
+            forfeit=(None if not forfeit else "a" if a_winner == -1 else "b"),
+        ))
+    return results
+
+
+def play_match(policy_a, policy_b, num_games, num_workers=None, context=None, chunk_size=None, seed=0, z=1.96,
+               **env_kwargs):
+    """
+    Play games between two policies across a process pool and summarize the results.
+
+    policy_a moves first in the even-numbered games and policy_b in the odd-numbered games.
+    With num_workers > 0, the policies must be picklable (e.g. module-level functions or objects),
+    and each worker plays its chunks of games in its own environment.
+
+    Parameters
+    ----------
+    policy_a : callable
+        The policy evaluated, called with (obs, legal_mask).
+    policy_b : callable
+        The opponent policy, called with (obs, legal_mask).
+    num_games : int
+        The number of the games.
+    num_workers : int, optional
+        The number of the worker processes. Defaults to the number of CPUs, and 0 plays in this process.
+    context : str, optional
+        The start method of multiprocessing ("fork", "spawn" or "forkserver").
+    chunk_size : int, optional
+        The number of the games sent to a worker at once.
+    seed : int
+        The seed of the global random state of numpy in the workers.
+    z : float
+        The quantile of the confidence interval. See summarize.
+    env_kwargs : dict
+        The keyword arguments of AnyNumberInARow3dEnv. By default the observations are numpy arrays
+        from the perspective of the player to move, so that the policies do not depend on the side.
+
+    Return
+    ------
+    result : MatchResult
+        The results from the perspective of policy_a. See summarize.
+    """
+    env_kwargs.setdefault("obs_backend", "numpy")
+    env_kwargs.setdefault("obs_perspective", True)
+    num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(num_games / (4 * max(num_workers, 1))))
+    chunks = [(policy_a, policy_b, list(range(start, min(start + chunk_size, num_games))), seed, env_kwargs)
+              for start in range(0, num_games, chunk_size)]
+
+    games = []
+    # ゲームがなければプールを作らず、空の集計を返す
+    if num_workers == 0 or not chunks:
+        for chunk in chunks:
+            games.extend(_play_games(chunk))
+    else:
+        with multiprocessing.get_context(context).Pool(min(num_workers, len(chunks))) as pool:
+            for results in pool.imap_unordered(_play_games, chunks):
+                games.extend(results)
+    return summarize(games, z=z)
+
+
+def round_robin(policies, num_games, **kwargs):
+    """
+    Play a match between every pair of policies.
+
+    Parameters
+    ----------
+    policies : dict[str, callable]
+        The policies by name.
+    num_games : int
+        The number of the games of each pair.
+    kwargs : dict
+        The keyword arguments of play_match.
+
+    Return
+    ------
+    results : dict[tuple[str, str], MatchResult]
+        The result of each pair (a, b) from the perspective of a, for the pairs in the order of policies.
+    """
+    names = list(policies)
+    return {(a, b): play_match(policies[a], policies[b], num_games, **kwargs)
+            for i, a in enumerate(names) for b in names[i + 1:]}
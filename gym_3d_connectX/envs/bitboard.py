@@ -0,0 +1,218 @@
+import numpy as np
+
+from gym_3d_connectX.envs.utility import get_line_table
+
+# 盤面の設定 (num_grid, num_win_seq) ごとに一度だけ作成し、全ての BitBoard で共有するラインのビットマスク
+_LINE_MASK_CACHE = {}
+
+
+def get_line_masks(num_grid, num_win_seq):
+    """
+    Return the bitmasks of every winning line, shared among the same board configuration.
+    The bit of each cell is its flat index (height * num_grid + wide) * num_grid + depth.
+
+    Parameters
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+
+    Returns
+    -------
+    line_masks : tuple[int]
+        The bitmask of each winning line.
+    cell_line_masks : tuple[tuple[int]]
+        The bitmasks of the winning lines passing through each cell.
+    """
+    key = (num_grid, num_win_seq)
+    if key not in _LINE_MASK_CACHE:
+        line_table = get_line_table(num_grid, num_win_seq)
+        line_masks = tuple(sum(1 << int(cell) for cell in line) for line in line_table.lines)
+        cell_line_masks = tuple(tuple(line_masks[line_id] for line_id in line_ids if line_id >= 0)
+                                for line_ids in line_table.cell_lines)
+        _LINE_MASK_CACHE[key] = (line_masks, cell_line_masks)
+    return _LINE_MASK_CACHE[key]
+
+
+class BitBoard:
+    """
+    Game engine which stores each player's stones as a bitmask.
+    A win is detected by AND/compare operations with the precomputed line masks,
+    which is much cheaper than the ndarray based judgment for boards up to 8 x 8 x 8 (512 cells).
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    stones : dict[int, int]
+        The bitmask of the stones of each player number (1 or -1).
+    heights : list[int]
+        The number of stones in each pile, indexed by wide * num_grid + depth.
+    num_stones : int
+        The number of stones on the board.
+    line_masks : tuple[int]
+        The bitmask of each winning line.
+    cell_line_masks : tuple[tuple[int]]
+        The bitmasks of the winning lines passing through each cell.
+    """
+
+    def __init__(self, num_grid, num_win_seq):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        """
+        self.num_grid = num_grid
+        self.num_win_seq = num_win_seq
+        self.line_masks, self.cell_line_masks = get_line_masks(num_grid, num_win_seq)
+        self.stones = {}
+        self.heights = []
+        self.num_stones = 0
+        self.reset()
+
+    @classmethod
+    def from_board(cls, board, num_win_seq):
+        """
+        Build the bitboard from a three-dimensional array.
+
+        Parameters
+        ----------
+        board : list[list[list[int]]] or ndarray
+            A three-dimensional array representing the current state.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+
+        Return
+        ------
+        bitboard : BitBoard
+            The bitboard holding the same stones as board.
+        """
+        board = np.asarray(board)
+        bitboard = cls(board.shape[0], num_win_seq)
+        flat_board = board.ravel()
+        for player_number in (1, -1):
+            for cell in np.flatnonzero(flat_board == player_number):
+                bitboard.stones[player_number] |= 1 << int(cell)
+        bitboard.heights = np.count_nonzero(board, axis=0).ravel().tolist()
+        bitboard.num_stones = int(np.count_nonzero(board))
+        return bitboard
+
+    def copy(self):
+        """
+        Return
+        ------
+        bitboard : BitBoard
+            A new bitboard holding the same stones, sharing the line masks.
+        """
+        bitboard = object.__new__(type(self))
+        bitboard.__dict__.update(self.__dict__)
+        bitboard.stones = dict(self.stones)
+        bitboard.heights = list(self.heights)
+        return bitboard
+
+    def reset(self):
+        """
+        Remove all the stones.
+        """
+        self.stones = {1: 0, -1: 0}
+        self.heights = [0] * (self.num_grid * self.num_grid)
+        self.num_stones = 0
+
+    def place(self, wide, depth, player_number):
+        """
+        Drop a stone into the pile.
+
+        Parameters
+        ----------
+        wide : int
+            The horizontal coordinates of the pile.
+        depth : int
+            The vertical coordinate of the pile.
+        player_number : int
+            The first player's number is 1, and the next is -1.
+
+        Return
+        ------
+        cell : int
+            The flat index of the placed stone, or -1 if the pile is full.
+        """
+        pile = wide * self.num_grid + depth
+        height = self.heights[pile]
+        if height >= self.num_grid:
+            return -1
+        cell = height * self.num_grid * self.num_grid + pile
+        self.stones[player_number] |= 1 << cell
+        self.heights[pile] = height + 1
+        self.num_stones += 1
+        return cell
+
+    def undo(self, wide, depth, player_number):
+        """
+        Remove the top stone of the pile placed by place.
+
+        Parameters
+        ----------
+        wide : int
+            The horizontal coordinates of the pile.
+        depth : int
+            The vertical coordinate of the pile.
+        player_number : int
+            The player number of the stone to be removed.
+        """
+        pile = wide * self.num_grid + depth
+        height = self.heights[pile] - 1
+        self.stones[player_number] &= ~(1 << (height * self.num_grid * self.num_grid + pile))
+        self.heights[pile] = height
+        self.num_stones -= 1
+
+    def is_win_at(self, cell, player_number):
+        """
+        Judges whether the player has completed a line passing through the cell.
+
+        Parameters
+        ----------
+        cell : int
+            The flat index of the last placed stone.
+        player_number : int
+            The player number of the last placed stone.
+
+        Return
+        ------
+        done : bool
+            The flag of whether the episode has finished or not.
+        """
+        stones = self.stones[player_number]
+        for mask in self.cell_line_masks[cell]:
+            if stones & mask == mask:
+                return True
+        return False
+
+    def is_done(self):
+        """
+        Judges whether either player has completed a line on the whole board.
+
+        Return
+        ------
+        done : bool
+            The flag of whether the episode has finished or not.
+        """
+        for stones in self.stones.values():
+            for mask in self.line_masks:
+                if stones & mask == mask:
+                    return True
+        return False
+
+    def is_full(self):
+        """
+        Return
+        ------
+        is_full : bool
+            The flag of whether all the cells are filled.
+        """
+        return self.num_stones == self.num_grid ** 3
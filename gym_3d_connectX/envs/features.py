@@ -0,0 +1,169 @@
+import numpy as np
+
+from gym_3d_connectX.envs.utility import get_line_table
+
+
+class FeatureExtractor:
+    """
+    Maintain the feature planes of the policy networks incrementally from the moves.
+
+    For every winning line of the line table, the number of stones of each player is kept.
+    A line is "open" for a player while the opponent has no stone on it, and open_lines counts,
+    for each player, each number of stones k and each cell, the open lines with k stones passing through the cell.
+    A move only changes the lines passing through the placed stone, so the update costs
+    O(lines per cell * num_win_seq) instead of a scan of the whole board.
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    board : ndarray
+        The flat int8 board, indexed by the flat cell index (height * num_grid + wide) * num_grid + depth.
+    heights : ndarray
+        The number of stones in each pile, indexed by wide * num_grid + depth.
+    line_counts : ndarray
+        A (num_lines, 2) array of the number of stones of player 1 and player -1 on each line.
+    open_lines : ndarray
+        A (2, num_win_seq + 1, num_grid ** 3) array. open_lines[p][k][cell] is the number of the lines through
+        the cell on which player p (0 for player 1, 1 for player -1) has k stones and the opponent has none.
+    """
+
+    def __init__(self, num_grid, num_win_seq):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        """
+        self.num_grid = num_grid
+        self.num_win_seq = num_win_seq
+        line_table = get_line_table(num_grid, num_win_seq)
+        self._lines = line_table.lines
+        self._cell_lines = line_table.cell_lines
+        cells = np.arange(num_grid ** 3)
+        # 各マスの高さと柱の番号。柱の高さと等しいマスが次に石を置けるマス。
+        self._cell_heights = cells // (num_grid * num_grid)
+        self._cell_piles = cells % (num_grid * num_grid)
+        self.board = np.zeros(num_grid ** 3, dtype=np.int8)
+        self.heights = np.zeros(num_grid * num_grid, dtype=np.intp)
+        self.line_counts = np.zeros((len(self._lines), 2), dtype=np.intp)
+        self.open_lines = np.zeros((2, num_win_seq + 1, num_grid ** 3), dtype=np.intp)
+        self.reset()
+
+    @property
+    def num_planes(self):
+        """
+        The number of the planes returned by planes.
+        """
+        return 2 * self.num_win_seq + 4
+
+    def reset(self):
+        """
+        Remove all the stones.
+        """
+        self.set_board(np.zeros((self.num_grid,) * 3, dtype=np.int8))
+
+    def set_board(self, board):
+        """
+        Recompute all the counts from the board.
+
+        Parameter
+        ---------
+        board : ndarray
+            A three-dimensional array representing the current state.
+        """
+        board = np.asarray(board)
+        self.board[:] = board.ravel()
+        self.heights[:] = np.count_nonzero(board, axis=0).ravel()
+        stones = self.board[self._lines]
+        self.line_counts[:, 0] = (stones == 1).sum(axis=1)
+        self.line_counts[:, 1] = (stones == -1).sum(axis=1)
+        self.open_lines[:] = 0
+        for player_id in range(2):
+            own, opponent = self.line_counts[:, player_id], self.line_counts[:, 1 - player_id]
+            is_open = opponent == 0
+            np.add.at(self.open_lines[player_id], (own[is_open, None], self._lines[is_open]), 1)
+
+    def place(self, cell, player_number):
+        """
+        Update the counts with a stone placed on the cell.
+
+        Parameters
+        ----------
+        cell : int
+            The flat index of the placed stone.
+        player_number : int
+            The player number of the placed stone.
+        """
+        player_id = 0 if player_number == 1 else 1
+        line_ids = self._cell_lines[cell]
+        line_ids = line_ids[line_ids >= 0]
+        counts = self.line_counts[line_ids]
+        own, opponent = counts[:, player_id], counts[:, 1 - player_id]
+        cells = self._lines[line_ids]
+
+        # 自分に開いているラインは石の数が1つ増える
+        is_open = opponent == 0
+        open_cells, open_own = cells[is_open], own[is_open, None]
+        np.subtract.at(self.open_lines[player_id], (open_own, open_cells), 1)
+        np.add.at(self.open_lines[player_id], (open_own + 1, open_cells), 1)
+        # 自分の石がなかったラインは相手にとって開いていたが、この石で塞がれる
+        was_open = own == 0
+        np.subtract.at(self.open_lines[1 - player_id], (opponent[was_open, None], cells[was_open]), 1)
+
+        self.line_counts[line_ids, player_id] += 1
+        self.board[cell] = player_number
+        self.heights[self._cell_piles[cell]] += 1
+
+    def winning_cells(self, player_number):
+        """
+        Parameter
+        ---------
+        player_number : int
+            The player number.
+
+        Return
+        ------
+        winning_cells : ndarray
+            The flat boolean array of the cells where the player wins by the next stone.
+        """
+        player_id = 0 if player_number == 1 else 1
+        playable = self.heights[self._cell_piles] == self._cell_heights
+        return playable & (self.open_lines[player_id, self.num_win_seq - 1] > 0)
+
+    def planes(self, player_number):
+        """
+        Build the feature planes from the perspective of the player to move.
+
+        Parameter
+        ---------
+        player_number : int
+            The player number to move.
+
+        Return
+        ------
+        planes : ndarray
+            A (2 * num_win_seq + 4, N, N, N) float32 array of
+            the own stones, the opponent's stones,
+            the own open lines with k = 1, ..., num_win_seq - 1 stones through each cell,
+            the opponent's open lines with k = 1, ..., num_win_seq - 1 stones,
+            the cells where the player to move wins immediately, the cells which block an immediate win
+            of the opponent, the height of each pile divided by N and the side to move
+            (1 for player 1, 0 for player -1).
+        """
+        num_grid, num_win_seq = self.num_grid, self.num_win_seq
+        player_id = 0 if player_number == 1 else 1
+        planes = np.empty((self.num_planes, num_grid ** 3), dtype=np.float32)
+        planes[0] = self.board == player_number
+        planes[1] = self.board == -player_number
+        planes[2:num_win_seq + 1] = self.open_lines[player_id, 1:num_win_seq]
+        planes[num_win_seq + 1:2 * num_win_seq] = self.open_lines[1 - player_id, 1:num_win_seq]
+        planes[2 * num_win_seq] = self.winning_cells(player_number)
+        planes[2 * num_win_seq + 1] = self.winning_cells(-player_number)
+        planes[2 * num_win_seq + 2] = self.heights[self._cell_piles] / num_grid
+        planes[2 * num_win_seq + 3] = player_number == 1
+        return planes.reshape((self.num_planes,) + (num_grid,) * 3)
@@ -0,0 +1,345 @@
+import collections
+import multiprocessing
+
+import numpy as np
+
+from gym_3d_connectX.envs.utility import UtilClass
+
+SearchStats = collections.namedtuple("SearchStats", ["visits", "value", "num_nodes"])
+
+
+def uniform_evaluator(boards, players):
+    """
+    An evaluator without knowledge: uniform priors and the value 0.
+
+    Parameters
+    ----------
+    boards : ndarray
+        A (B, N, N, N) int8 array of the leaf positions.
+    players : ndarray
+        The (B,) player numbers to move at the leaves.
+
+    Returns
+    -------
+    priors : ndarray
+        A (B, N * N) array of the prior probabilities of the actions.
+    values : ndarray
+        The (B,) values of the leaves from the perspective of the player to move, in [-1, 1].
+    """
+    num_actions = boards.shape[-1] * boards.shape[-1]
+    return np.full((len(boards), num_actions), 1 / num_actions), np.zeros(len(boards))
+
+
+class MCTS:
+    """
+    Monte Carlo tree search with PUCT selection, virtual loss and batched leaf evaluation.
+
+    The tree is stored in flat arrays indexed by the node number (the children of a node are contiguous),
+    instead of per-node Python objects. In each iteration, up to batch_size leaves are selected one after
+    another, with a virtual loss on their paths so that the following selections spread over the tree,
+    and then evaluated in one call of evaluator. The moves are applied with UtilClass.resolve_placing and
+    the end of the game is judged with UtilClass.is_done_at, the same rules as AnyNumberInARow3dEnv.
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    evaluator : callable
+        Called with (boards, players) of the leaves and returns (priors, values). See uniform_evaluator.
+    c_puct : float
+        The exploration constant.
+    virtual_loss : float
+        The loss added to the nodes on the path of a pending leaf.
+    batch_size : int
+        The maximum number of the leaves evaluated at once.
+    dirichlet_alpha : float or None
+        If given, Dirichlet noise of this concentration is mixed into the priors of the root.
+    dirichlet_fraction : float
+        The weight of the Dirichlet noise.
+    utils : UtilClass
+        The rules of the game.
+    """
+
+    def __init__(self, num_grid=4, num_win_seq=4, evaluator=uniform_evaluator, c_puct=1.5, virtual_loss=1.0,
+                 batch_size=16, dirichlet_alpha=None, dirichlet_fraction=0.25, seed=None):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        evaluator : callable
+            Called with (boards, players) of the leaves and returns (priors, values).
+        c_puct : float
+            The exploration constant.
+        virtual_loss : float
+            The loss added to the nodes on the path of a pending leaf.
+        batch_size : int
+            The maximum number of the leaves evaluated at once.
+        dirichlet_alpha : float, optional
+            If given, Dirichlet noise of this concentration is mixed into the priors of the root.
+        dirichlet_fraction : float
+            The weight of the Dirichlet noise.
+        seed : int, optional
+            The seed of the Dirichlet noise.
+        """
+        self.num_grid = num_grid
+        self.num_win_seq = num_win_seq
+        self.evaluator = evaluator
+        self.c_puct = c_puct
+        self.virtual_loss = virtual_loss
+        self.batch_size = batch_size
+        self.dirichlet_alpha = dirichlet_alpha
+        self.dirichlet_fraction = dirichlet_fraction
+        self.random_state = np.random.RandomState(seed)
+        # 報酬は使わないので0にしておく
+        self.utils = UtilClass(num_grid, num_win_seq, 0, 0, 0, 0, 0, 0)
+        self._allocate(1024)
+
+    def _allocate(self, capacity):
+        """
+        Allocate the node arrays, keeping the existing nodes.
+        """
+        old = getattr(self, "_num_nodes", 0)
+        fields = {
+            "_parents": (np.int32, -1),
+            "_actions": (np.int32, -1),
+            "_first_child": (np.int32, -1),
+            "_num_children": (np.int32, 0),
+            "_visits": (np.float64, 0),
+            "_value_sums": (np.float64, 0),
+            "_priors": (np.float64, 0),
+            # -1: 未判定, 0: 終局でない, 1: 終局
+            "_terminal": (np.int8, -1),
+            "_terminal_values": (np.float64, 0),
+        }
+        for name, (dtype, fill) in fields.items():
+            array = np.full(capacity, fill, dtype=dtype)
+            if old:
+                array[:old] = getattr(self, name)[:old]
+            setattr(self, name, array)
+        self._num_nodes = old
+
+    def _new_nodes(self, count):
+        """
+        Reserve count contiguous nodes and return the number of the first one.
+        """
+        first = self._num_nodes
+        if first + count > len(self._parents):
+            self._allocate(max(2 * len(self._parents), first + count))
+        self._num_nodes += count
+        return first
+
+    def search(self, board, player_number, num_simulations=800):
+        """
+        Search the position from scratch.
+
+        Parameters
+        ----------
+        board : ndarray
+            A three-dimensional array representing the current state. The game must not be finished.
+        player_number : int
+            The player number to move.
+        num_simulations : int
+            The number of the simulations (leaf evaluations and terminal visits).
+
+        Return
+        ------
+        stats : SearchStats
+            visits : ndarray
+                The (N * N,) visit counts of the actions of the root.
+            value : float
+                The mean value of the root from the perspective of player_number.
+            num_nodes : int
+                The number of the nodes in the tree.
+        """
+        root_board = np.array(board, dtype=np.int8)
+        root_heights = np.count_nonzero(root_board, axis=0)
+        self._num_nodes = 0
+        self._allocate(len(self._parents))
+        root = self._new_nodes(1)
+
+        num_done = 0
+        while num_done < num_simulations:
+            leaves = []
+            pending = set()
+            while len(leaves) < min(self.batch_size, num_simulations - num_done):
+                path, leaf_board, leaf_player = self._select(root_board, root_heights, player_number)
+                leaf = path[-1]
+                if self._terminal[leaf] == 1:
+                    self._backup(path, self._terminal_values[leaf])
+                    num_done += 1
+                    if num_done >= num_simulations:
+                        break
+                    continue
+                if leaf in pending:
+                    # 評価待ちの葉をもう一度選んだ場合は、仮想損失を戻して評価に進む
+                    self._revert(path)
+                    break
+                pending.add(leaf)
+                leaves.append((path, leaf_board, leaf_player))
+
+            if leaves:
+                boards = np.stack([leaf_board for _, leaf_board, _ in leaves])
+                players = np.array([leaf_player for _, _, leaf_player in leaves], dtype=np.int8)
+                priors, values = self.evaluator(boards, players)
+                priors = np.asarray(priors, dtype=np.float64).reshape(len(leaves), -1)
+                for (path, leaf_board, _), prior, value in zip(leaves, priors, np.asarray(values)):
+                    self._expand(path[-1], leaf_board, prior, is_root=path[-1] == root)
+                    self._backup(path, float(value))
+                num_done += len(leaves)
+
+        visits = np.zeros(self.num_grid * self.num_grid)
+        children = self._children(root)
+        visits[self._actions[children]] = self._visits[children]
+        child_visits = self._visits[children].sum()
+        value = self._value_sums[children].sum() / child_visits if child_visits else 0.0
+        return SearchStats(visits=visits, value=float(value), num_nodes=self._num_nodes)
+
+    def best_action(self, board, player_number, num_simulations=800):
+        """
+        Return
+        ------
+        action : int
+            The most visited action of the root. See search for the parameters.
+        """
+        return int(self.search(board, player_number, num_simulations).visits.argmax())
+
+    def _children(self, node):
+        """
+        Return the slice of the children of the node.
+        """
+        first = self._first_child[node]
+        return slice(first, first + self._num_children[node])
+
+    def _select(self, root_board, root_heights, player_number):
+        """
+        Descend from the root to a leaf with PUCT, applying the virtual loss on the path.
+        Return the path, the board of the leaf and the player number to move at the leaf.
+        """
+        board = root_board.copy()
+        heights = root_heights.copy()
+        node = 0
+        path = [node]
+        while self._first_child[node] >= 0 and self._terminal[node] != 1:
+            children = self._children(node)
+            visits = self._visits[children]
+            # 子の価値は、その子へ着手したプレーヤー(この節点の手番)から見た値
+            q = np.divide(self._value_sums[children], visits, out=np.zeros_like(visits), where=visits > 0)
+            u = self.c_puct * self._priors[children] * np.sqrt(self._visits[node]) / (1 + visits)
+            child = children.start + int(np.argmax(q + u))
+            wide, depth = divmod(int(self._actions[child]), self.num_grid)
+            self.utils.resolve_placing(wide, depth, player_number, board, heights)
+            if self._terminal[child] == -1:
+                self._judge(child, board, player_number)
+            node = child
+            path.append(node)
+            player_number = -player_number
+
+        self._visits[path] += 1
+        self._value_sums[path] -= self.virtual_loss
+        return path, board, player_number
+
+    def _judge(self, node, board, mover):
+        """
+        Judge whether the move into the node has finished the game.
+        """
+        if self.utils.is_done_at(board, *self.utils.last_position):
+            # 直前に着手したプレーヤーの勝ちなので、この節点の手番から見ると負け
+            self._terminal[node], self._terminal_values[node] = 1, -1.0
+        elif np.count_nonzero(board[-1]) == self.num_grid * self.num_grid:
+            self._terminal[node], self._terminal_values[node] = 1, 0.0
+        else:
+            self._terminal[node] = 0
+
+    def _expand(self, node, board, prior, is_root=False):
+        """
+        Create the children of the node for the legal actions with the priors.
+        """
+        if self._first_child[node] >= 0:
+            return
+        legal_actions = np.flatnonzero(board[-1].ravel() == 0)
+        prior = prior[legal_actions]
+        total = prior.sum()
+        prior = prior / total if total > 0 else np.full(len(legal_actions), 1 / len(legal_actions))
+        if is_root and self.dirichlet_alpha is not None:
+            noise = self.random_state.dirichlet([self.dirichlet_alpha] * len(legal_actions))
+            prior = (1 - self.dirichlet_fraction) * prior + self.dirichlet_fraction * noise
+
+        first = self._new_nodes(len(legal_actions))
+        children = slice(first, first + len(legal_actions))
+        self._parents[children] = node
+        self._actions[children] = legal_actions
+        self._priors[children] = prior
+        self._first_child[node] = first
+        self._num_children[node] = len(legal_actions)
+
+    def _backup(self, path, value):
+        """
+        Propagate the value of the leaf (from the perspective of the player to move at the leaf)
+        to the root, removing the virtual loss.
+        """
+        # 葉へ着手したプレーヤーから見た値から始め、親へ上るごとに視点を入れ替える
+        mover_value = -value
+        for node in reversed(path):
+            self._value_sums[node] += self.virtual_loss + mover_value
+            mover_value = -mover_value
+
+    def _revert(self, path):
+        """
+        Remove the virtual visit and the virtual loss of the path.
+        """
+        self._visits[path] -= 1
+        self._value_sums[path] += self.virtual_loss
+
+
+def _search_worker(args):
+    """
+    Run an independent search in a worker process and return the visit counts and the value of the root.
+    """
+    mcts_kwargs, seed, board, player_number, num_simulations = args
+    stats = MCTS(seed=seed, **mcts_kwargs).search(board, player_number, num_simulations)
+    return stats.visits, stats.value
+
+
+def parallel_search(board, player_number, num_simulations=800, num_workers=None, context=None, seed=0,
+                    **mcts_kwargs):
+    """
+    Root parallelism: run independent searches in worker processes and sum the visit counts of the roots.
+
+    The searches differ by the Dirichlet noise of the root, so set dirichlet_alpha (0.3 by default here).
+    The evaluator must be picklable.
+
+    Parameters
+    ----------
+    board : ndarray
+        A three-dimensional array representing the current state.
+    player_number : int
+        The player number to move.
+    num_simulations : int
+        The number of the simulations of each worker.
+    num_workers : int, optional
+        The number of the worker processes. Defaults to the number of CPUs.
+    context : str, optional
+        The start method of multiprocessing.
+    seed : int
+        The seed of the first worker. The i-th worker uses seed + i.
+    mcts_kwargs : dict
+        The keyword arguments of MCTS.
+
+    Return
+    ------
+    stats : SearchStats
+        The summed visit counts and the mean root value of the workers. num_nodes is None.
+    """
+    mcts_kwargs.setdefault("dirichlet_alpha", 0.3)
+    num_workers = num_workers or multiprocessing.cpu_count()
+    tasks = [(mcts_kwargs, seed + i, np.asarray(board), player_number, num_simulations) for i in range(num_workers)]
+    with multiprocessing.get_context(context).Pool(num_workers) as pool:
+        results = pool.map(_search_worker, tasks)
+    visits = np.sum([visits for visits, _ in results], axis=0)
+    value = float(np.mean([value for _, value in results]))
+    return SearchStats(visits=visits, value=value, num_nodes=None)
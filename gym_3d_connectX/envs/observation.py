@@ -0,0 +1,149 @@
+import gym
+import numpy as np
+
+_BACKENDS = ("torch", "numpy")
+_DTYPES = {"int8": np.int8, "float32": np.float32, "onehot": np.float32}
+
+
+class ObservationBuilder:
+    """
+    Build the observations from the board array.
+
+    The observation is returned as torch.Tensor or ndarray of int8, float32 or two-plane one-hot
+    ("own" and "opponent" channels), optionally from the perspective of the player to move.
+    A numpy int8 observation without perspective is a read-only view of the board itself,
+    and with reuse_buffer the other observations are written in place into one preallocated buffer.
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    backend : str
+        "torch" or "numpy".
+    dtype : str
+        "int8", "float32" or "onehot".
+    perspective : bool
+        If true, the stones of the player to move are 1 (or the first plane of one-hot) and
+        the opponent's stones are -1 (or the second plane).
+        Otherwise the stones of player 1 are 1 and the stones of player -1 are -1.
+    reuse_buffer : bool
+        If true, the observation is written into the same buffer at every call.
+    """
+
+    def __init__(self, num_grid, backend="torch", dtype="float32", perspective=False, reuse_buffer=False):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        backend : str
+            "torch" or "numpy".
+        dtype : str
+            "int8", "float32" or "onehot".
+        perspective : bool
+            Whether the observation is from the perspective of the player to move.
+        reuse_buffer : bool
+            Whether the observation is written into the same buffer at every call.
+        """
+        if backend not in _BACKENDS:
+            raise ValueError(f"backend must be one of {_BACKENDS}, but got {backend!r}")
+        if dtype not in _DTYPES:
+            raise ValueError(f"dtype must be one of {tuple(_DTYPES)}, but got {dtype!r}")
+        self.num_grid = num_grid
+        self.backend = backend
+        self.dtype = dtype
+        self.perspective = perspective
+        self.reuse_buffer = reuse_buffer
+        self._buffer = None
+        self._buffer_view = None
+
+    @property
+    def shape(self):
+        """
+        The shape of one observation, (2, N, N, N) for one-hot and (N, N, N) otherwise.
+        """
+        board_shape = (self.num_grid, self.num_grid, self.num_grid)
+        return (2,) + board_shape if self.dtype == "onehot" else board_shape
+
+    @property
+    def is_zero_copy(self):
+        """
+        Whether the observation is a view of the board.
+        """
+        return self.backend == "numpy" and self.dtype == "int8" and not self.perspective
+
+    def observation_space(self, batch_shape=()):
+        """
+        Parameter
+        ---------
+        batch_shape : tuple[int]
+            The leading dimensions of the batched observations.
+
+        Return
+        ------
+        observation_space : gym.spaces.Box
+            The space of the observations.
+        """
+        low = 0 if self.dtype == "onehot" else -1
+        return gym.spaces.Box(low=low, high=1, shape=tuple(batch_shape) + self.shape, dtype=_DTYPES[self.dtype])
+
+    def build(self, board, player, reuse_buffer=None):
+        """
+        Build the observation of the board.
+
+        Parameters
+        ----------
+        board : ndarray
+            A (..., N, N, N) int8 array representing the current states.
+        player : int or ndarray
+            The player number to move, of the shape of the leading dimensions of board.
+        reuse_buffer : bool, optional
+            Overrides self.reuse_buffer for this call.
+
+        Return
+        ------
+        obs : torch.Tensor or ndarray
+            The observation of the board.
+        """
+        if self.is_zero_copy:
+            view = board.view()
+            view.flags.writeable = False
+            return view
+
+        if reuse_buffer is None:
+            reuse_buffer = self.reuse_buffer
+        shape = board.shape[:-3] + self.shape
+        if reuse_buffer and self._buffer is not None and self._buffer_view.shape == shape:
+            obs, view = self._buffer, self._buffer_view
+        else:
+            obs, view = self._allocate(shape)
+            if reuse_buffer:
+                self._buffer, self._buffer_view = obs, view
+
+        # 自分の石の値。視点を固定する場合は常にプレーヤー1を自分とする。
+        own = np.reshape(player, np.shape(player) + (1, 1, 1)).astype(np.int8) if self.perspective else 1
+        if self.dtype == "onehot":
+            view[..., 0, :, :, :] = board == own
+            view[..., 1, :, :, :] = board == -own
+        else:
+            np.multiply(board, own, out=view, casting="unsafe")
+        return obs
+
+    def reset_buffer(self):
+        """
+        Forget the preallocated buffer, so that the next observation is written into a new one.
+        """
+        self._buffer = None
+        self._buffer_view = None
+
+    def _allocate(self, shape):
+        """
+        Allocate a new observation and its ndarray view sharing the same memory.
+        """
+        if self.backend == "torch":
+            # torch を使わない場合は読み込まない
+            import torch
+            obs = torch.empty(shape, dtype=torch.int8 if self.dtype == "int8" else torch.float32)
+            return obs, obs.numpy()
+        obs = np.empty(shape, dtype=_DTYPES[self.dtype])
+        return obs, obs
@@ -0,0 +1,359 @@
+"""
+Opening book: the search results of the early positions, stored in an on-disk hash table.
+
+The positions reachable within max_plies moves are enumerated with the rules of the environment, reduced by
+the 8 symmetries and by the side to move (each position is stored from the perspective of the player to move,
+whose stones are 1), and searched with NegamaxSolver. The results are written into an open-addressing hash
+table with linear probing keyed by symmetry.canonical_hash, which OpeningBook memory-maps, so a lookup reads
+a few records from the page cache instead of loading the book.
+
+File layout (little-endian):
+    header  (bytes[8] magic, int16 num_grid, int16 num_win_seq, int16 max_plies, int16 search_depth,
+             int64 capacity, int64 num_entries)
+    entries (uint64 key, int32 value, int16 action, int8 depth, uint8 flags)[capacity]
+
+The action of an entry is on the canonical form of the position, and is mapped back to the queried board
+with the inverse symmetry.
+
+    python -m gym_3d_connectX.envs.opening_book book.bin --max-plies 3 --search-depth 4
+"""
+import argparse
+import collections
+import math
+import multiprocessing
+
+import numpy as np
+
+from gym_3d_connectX.envs.solver import NegamaxSolver
+from gym_3d_connectX.envs.symmetry import canonical_hash, get_symmetry_table
+from gym_3d_connectX.envs.utility import UtilClass
+
+_MAGIC = b"3DCXBOOK"
+_HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("num_grid", "<i2"),
+    ("num_win_seq", "<i2"),
+    ("max_plies", "<i2"),
+    ("search_depth", "<i2"),
+    ("capacity", "<i8"),
+    ("num_entries", "<i8"),
+])
+_ENTRY_DTYPE = np.dtype([
+    ("key", "<u8"),
+    ("value", "<i4"),
+    ("action", "<i2"),
+    ("depth", "i1"),
+    ("flags", "u1"),
+])
+# flags のビット。使われていないスロットは 0。
+_OCCUPIED, _EXACT = 1, 2
+
+BookEntry = collections.namedtuple("BookEntry", ["value", "action", "depth", "exact"])
+
+
+def position_key(board, player_number):
+    """
+    Compute the key of the position in the book.
+
+    Parameters
+    ----------
+    board : ndarray
+        A three-dimensional array representing the current state.
+    player_number : int
+        The player number to move.
+
+    Returns
+    -------
+    key : int
+        The canonical hash of the board from the perspective of the player to move.
+    symmetry : int
+        The number of the symmetry which maps the board to its canonical form.
+    """
+    board = np.asarray(board).astype(np.int8) * np.int8(player_number)
+    key, symmetry = canonical_hash(board, return_symmetry=True)
+    return int(key), int(symmetry)
+
+
+def enumerate_positions(num_grid=4, num_win_seq=4, max_plies=4):
+    """
+    Enumerate the unfinished positions reachable within max_plies moves, one per symmetry class.
+
+    Parameters
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    max_plies : int
+        The maximum number of the stones on the positions.
+
+    Return
+    ------
+    boards : list[ndarray]
+        The (N, N, N) int8 boards from the perspective of the player to move, in the order of the number of stones.
+    """
+    # 報酬は使わないので0にしておく
+    utils = UtilClass(num_grid, num_win_seq, 0, 0, 0, 0, 0, 0)
+    level = [np.zeros((num_grid,) * 3, dtype=np.int8)]
+    boards = list(level)
+    for _ in range(max_plies):
+        children = []
+        for board in level:
+            heights = np.count_nonzero(board, axis=0)
+            for action in np.flatnonzero(heights.ravel() < num_grid):
+                child = board.copy()
+                wide, depth = divmod(int(action), num_grid)
+                utils.resolve_placing(wide, depth, 1, child, heights.copy())
+                if utils.is_done_at(child, *utils.last_position) or child.all():
+                    continue
+                # 手番が入れ替わるので、次の手番から見た盤面にする
+                children.append(-child)
+        if not children:
+            break
+        _, first = np.unique(canonical_hash(np.stack(children)), return_index=True)
+        level = [children[index] for index in np.sort(first)]
+        boards.extend(level)
+    return boards
+
+
+def _solve_positions(args):
+    """
+    Search the boards of a chunk in a worker process and return (value, action, depth, exact) of each board.
+    """
+    boards, num_grid, num_win_seq, search_depth, time_limit, table_size_bits = args
+    solver = NegamaxSolver(num_grid, num_win_seq, max_depth=search_depth, time_limit=time_limit,
+                           table_size_bits=table_size_bits)
+    results = []
+    for board in boards:
+        result = solver.search(board, 1)
+        results.append((result.value, result.action, result.depth, result.exact))
+    return results
+
+
+def build_book(path, num_grid=4, num_win_seq=4, max_plies=4, search_depth=6, time_limit=None, num_workers=None,
+               context=None, chunk_size=None, table_size_bits=20):
+    """
+    Enumerate and search the positions and write the book.
+
+    Parameters
+    ----------
+    path : str
+        The path of the book file.
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    max_plies : int
+        The maximum number of the stones on the positions.
+    search_depth : int
+        The maximum depth of the search of each position. The search stops earlier if the value is proven.
+    time_limit : float, optional
+        The time limit of the search of each position in seconds.
+    num_workers : int, optional
+        The number of the worker processes. Defaults to the number of CPUs, and 0 searches in this process.
+    context : str, optional
+        The start method of multiprocessing ("fork", "spawn" or "forkserver").
+    chunk_size : int, optional
+        The number of the positions sent to a worker at once.
+    table_size_bits : int
+        The transposition table of each solver has 2 ** table_size_bits slots.
+
+    Return
+    ------
+    num_entries : int
+        The number of the positions in the book.
+    """
+    boards = enumerate_positions(num_grid, num_win_seq, max_plies)
+    num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(len(boards) / (4 * max(num_workers, 1))))
+    chunks = [(boards[start:start + chunk_size], num_grid, num_win_seq, search_depth, time_limit, table_size_bits)
+              for start in range(0, len(boards), chunk_size)]
+
+    results = []
+    if num_workers == 0:
+        for chunk in chunks:
+            results.extend(_solve_positions(chunk))
+    else:
+        with multiprocessing.get_context(context).Pool(min(num_workers, len(chunks))) as pool:
+            # 盤面と結果の対応を保つため、順序どおりに受け取る
+            for chunk_results in pool.imap(_solve_positions, chunks):
+                results.extend(chunk_results)
+
+    # 負荷率を 1/2 以下にして、線形探査の列を短く保つ
+    capacity = 1 << max(1, (2 * len(boards) - 1).bit_length())
+    entries = np.zeros(capacity, dtype=_ENTRY_DTYPE)
+    keys, symmetries = canonical_hash(np.stack(boards), return_symmetry=True)
+    actions_table = get_symmetry_table(num_grid).actions
+    for key, symmetry, (value, action, depth, exact) in zip(keys.tolist(), symmetries.tolist(), results):
+        index = key & (capacity - 1)
+        while entries[index]["flags"] & _OCCUPIED:
+            index = (index + 1) & (capacity - 1)
+        # 手は正規形の盤面の上の番号で保存する
+        canonical_action = int(actions_table[symmetry][action]) if action >= 0 else -1
+        entries[index] = (key, value, canonical_action, depth, _OCCUPIED | (_EXACT if exact else 0))
+
+    header = np.array([(_MAGIC, num_grid, num_win_seq, max_plies, search_depth, capacity, len(boards))],
+                      dtype=_HEADER_DTYPE)
+    with open(path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(entries.tobytes())
+    return len(boards)
+
+
+class OpeningBook:
+    """
+    Read-only view of a book file written by build_book, memory-mapped for O(1) lookups.
+
+    Attributes
+    ----------
+    path : str
+        The path of the book file.
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    max_plies : int
+        The maximum number of the stones on the positions.
+    search_depth : int
+        The maximum depth of the search of each position.
+    capacity : int
+        The number of the slots of the hash table.
+    """
+
+    def __init__(self, path):
+        """
+        Parameter
+        ---------
+        path : str
+            The path of the book file.
+        """
+        header = np.fromfile(path, dtype=_HEADER_DTYPE, count=1)
+        if len(header) == 0 or header[0]["magic"] != _MAGIC:
+            raise ValueError(f"{path!r} is not an opening book")
+        header = header[0]
+        self.path = path
+        self.num_grid = int(header["num_grid"])
+        self.num_win_seq = int(header["num_win_seq"])
+        self.max_plies = int(header["max_plies"])
+        self.search_depth = int(header["search_depth"])
+        self.capacity = int(header["capacity"])
+        self._num_entries = int(header["num_entries"])
+        self._entries = np.memmap(path, dtype=_ENTRY_DTYPE, mode="r", offset=_HEADER_DTYPE.itemsize,
+                                  shape=(self.capacity,))
+        self._actions = get_symmetry_table(self.num_grid).actions
+        self._inverse = get_symmetry_table(self.num_grid).inverse
+
+    def __len__(self):
+        return self._num_entries
+
+    def __getstate__(self):
+        # メモリマップは複製せず、プロセスごとに開き直す
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def lookup(self, board, player_number):
+        """
+        Parameters
+        ----------
+        board : ndarray
+            A three-dimensional array representing the current state.
+        player_number : int
+            The player number to move.
+
+        Return
+        ------
+        entry : BookEntry or None
+            value : int
+                The evaluation value of NegamaxSolver from the perspective of the player to move.
+            action : int
+                The best action number on the given board, or -1 if there is no legal action.
+            depth : int
+                The depth of the search.
+            exact : bool
+                Whether the value is the game-theoretic value of the position.
+            None if the position is not in the book.
+        """
+        key, symmetry = position_key(board, player_number)
+        mask = self.capacity - 1
+        index = key & mask
+        while True:
+            entry = self._entries[index]
+            if not entry["flags"] & _OCCUPIED:
+                return None
+            if int(entry["key"]) == key:
+                break
+            index = (index + 1) & mask
+        action = int(entry["action"])
+        if action >= 0:
+            # 正規形の盤面の手を、逆変換で与えられた盤面の手に戻す
+            action = int(self._actions[self._inverse[symmetry]][action])
+        return BookEntry(value=int(entry["value"]), action=action, depth=int(entry["depth"]),
+                         exact=bool(entry["flags"] & _EXACT))
+
+
+class BookPolicy:
+    """
+    A policy for arena.play_match which plays the book move and falls back to another policy out of the book.
+
+    Attributes
+    ----------
+    book : OpeningBook
+        The opening book.
+    fallback : callable
+        The policy called with (obs, legal_mask) when the position is not in the book.
+    """
+
+    def __init__(self, book, fallback):
+        """
+        Parameters
+        ----------
+        book : OpeningBook or str
+            The opening book or the path of the book file.
+        fallback : callable
+            The policy called with (obs, legal_mask) when the position is not in the book.
+        """
+        self.book = OpeningBook(book) if isinstance(book, str) else book
+        self.fallback = fallback
+
+    def __call__(self, obs, legal_mask):
+        """
+        Parameters
+        ----------
+        obs : ndarray
+            The (N, N, N) observation from the perspective of the player to move.
+        legal_mask : ndarray
+            The N x N legal action mask.
+
+        Return
+        ------
+        action : int
+            The action number.
+        """
+        entry = self.book.lookup(obs, 1)
+        if entry is not None and entry.action >= 0 and np.asarray(legal_mask).ravel()[entry.action]:
+            return entry.action
+        return self.fallback(obs, legal_mask)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build an opening book by searching the early positions.")
+    parser.add_argument("output", help="path of the book file")
+    parser.add_argument("--num-grid", type=int, default=4)
+    parser.add_argument("--num-win-seq", type=int, default=4)
+    parser.add_argument("--max-plies", type=int, default=3)
+    parser.add_argument("--search-depth", type=int, default=6)
+    parser.add_argument("--time-limit", type=float, help="time limit of the search of each position in seconds")
+    parser.add_argument("--num-workers", type=int, help="0 searches in this process")
+    args = parser.parse_args(argv)
+
+    num_entries = build_book(args.output, num_grid=args.num_grid, num_win_seq=args.num_win_seq,
+                             max_plies=args.max_plies, search_depth=args.search_depth, time_limit=args.time_limit,
+                             num_workers=args.num_workers)
+    print(f"wrote {num_entries} positions to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import collections
+
+import numpy as np
+
+from gym_3d_connectX.envs.utility import get_line_table
+from gym_3d_connectX.envs.vector_env import sample_masked
+
+PlayoutResult = collections.namedtuple("PlayoutResult", ["winners", "lengths", "moves"])
+
+
+def random_playouts(num_games, num_grid=4, num_win_seq=4, board=None, player_number=1, prior=None, epsilon=1.0,
+                    batch_size=4096, return_moves=False, random_state=None):
+    """
+    Play games to the end with random moves in batches and return only the outcomes.
+
+    The moves follow the same rules as UtilClass.resolve_placing and is_done (a stone drops to the lowest empty
+    cell of the pile, and the game ends when a line of num_win_seq stones is completed or the board is full),
+    but the rewards and the observations are skipped. Only legal actions are chosen.
+    All the games of a batch move in lockstep, and the finished games are dropped from the batch.
+
+    Parameters
+    ----------
+    num_games : int
+        The number of the games.
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    board : ndarray, optional
+        The (N, N, N) position the games start from. Defaults to the empty board.
+        The game must not be finished.
+    player_number : int
+        The player number to move first.
+    prior : ndarray, optional
+        A (N * N,) array of the scores of the actions for the epsilon-greedy moves.
+    epsilon : float
+        The probability of a uniformly random move. Otherwise the legal action with the highest prior is chosen.
+        Ignored (always random) if prior is None.
+    batch_size : int
+        The number of the games played at once.
+    return_moves : bool
+        If true, the action numbers of the games are returned.
+    random_state : numpy.random.RandomState, optional
+        The random number generator. Defaults to the global one of numpy.
+
+    Return
+    ------
+    result : PlayoutResult
+        winners : ndarray
+            The (num_games,) int8 player numbers of the winners, or 0 for draws.
+        lengths : ndarray
+            The (num_games,) numbers of the moves played from the start position.
+        moves : ndarray or None
+            A (num_games, max_moves) int16 array of the action numbers, padded with -1, if return_moves is true.
+    """
+    random_state = np.random if random_state is None else random_state
+    num_cells, num_actions = num_grid ** 3, num_grid * num_grid
+    start_board = np.zeros(num_cells, dtype=np.int8) if board is None else np.asarray(board, dtype=np.int8).ravel()
+    start_heights = np.count_nonzero(start_board.reshape(num_grid, num_actions), axis=0)
+    max_moves = num_cells - int(start_heights.sum())
+    line_table = get_line_table(num_grid, num_win_seq)
+    if prior is not None:
+        prior = np.asarray(prior, dtype=np.float64).reshape(num_actions)
+
+    winners = np.zeros(num_games, dtype=np.int8)
+    lengths = np.zeros(num_games, dtype=np.intp)
+    moves = np.full((num_games, max_moves), -1, dtype=np.int16) if return_moves else None
+
+    for start in range(0, num_games, batch_size):
+        game_ids = np.arange(start, min(start + batch_size, num_games))
+        boards = np.tile(start_board, (len(game_ids), 1))
+        heights = np.tile(start_heights, (len(game_ids), 1))
+        player = player_number
+        for move in range(max_moves):
+            legal = heights < num_grid
+            actions = sample_masked(legal, random_state)
+            if prior is not None and epsilon < 1:
+                greedy = np.where(legal, prior, -np.inf).argmax(axis=1)
+                actions = np.where(random_state.random_sample(len(actions)) < epsilon, actions, greedy)
+
+            rows = np.arange(len(game_ids))
+            cells = heights[rows, actions] * num_actions + actions
+            boards[rows, cells] = player
+            heights[rows, actions] += 1
+            if return_moves:
+                moves[game_ids, move] = actions
+
+            won = _is_win_at(boards, cells, line_table, num_win_seq)
+            # 石の数はどのゲームも同じなので、最後の手で盤面が埋まる
+            finished = won | (move == max_moves - 1)
+            if finished.any():
+                winners[game_ids[finished]] = np.where(won[finished], player, 0)
+                lengths[game_ids[finished]] = move + 1
+                keep = ~finished
+                game_ids, boards, heights = game_ids[keep], boards[keep], heights[keep]
+                if len(game_ids) == 0:
+                    break
+            player = -player
+
+    return PlayoutResult(winners=winners, lengths=lengths, moves=moves)
+
+
+def _is_win_at(boards, cells, line_table, num_win_seq):
+    """
+    Judges whether the stone placed on the cell of each flat board completes a line.
+    """
+    if len(line_table.lines) == 0:
+        return np.zeros(len(boards), dtype=bool)
+    line_ids = line_table.cell_lines[cells]
+    sums = boards[np.arange(len(boards))[:, None, None], line_table.lines[line_ids]].sum(axis=2, dtype=np.intp)
+    sums[line_ids < 0] = 0
+    return (np.abs(sums) == num_win_seq).any(axis=1)
+
+
+def first_player_advantage(num_games, num_grid=4, num_win_seq=4, **kwargs):
+    """
+    Estimate the outcome rates of uniformly random games.
+
+    Parameters
+    ----------
+    num_games : int
+        The number of the games.
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    kwargs : dict
+        The other keyword arguments of random_playouts.
+
+    Return
+    ------
+    rates : dict[str, float]
+        The rates of "first" (the first player won), "second" and "draw", and the "mean_length" of the games.
+    """
+    result = random_playouts(num_games, num_grid=num_grid, num_win_seq=num_win_seq, **kwargs)
+    first = kwargs.get("player_number", 1)
+    return {
+        "first": float(np.mean(result.winners == first)),
+        "second": float(np.mean(result.winners == -first)),
+        "draw": float(np.mean(result.winners == 0)),
+        "mean_length": float(result.lengths.mean()),
+    }
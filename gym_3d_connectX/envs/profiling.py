@@ -0,0 +1,105 @@
+import time
+
+# step の各段階の名前。reset と render は呼び出し全体を1つの段階として記録する。
+STEP_PHASES = ("decode", "placing", "win_check", "history", "observation")
+
+
+class StepProfiler:
+    """
+    Accumulate the time and the number of calls of each phase of the environment.
+
+    The environment calls start at the beginning of step and lap at the end of each phase,
+    so that a phase costs one time.perf_counter call. The stats are plain dicts, which can be pulled
+    from each worker (e.g. through a pipe) and aggregated with merge_stats.
+
+    Attributes
+    ----------
+    callback : callable or None
+        If given, called with (phase, seconds) at the end of every phase.
+    """
+
+    def __init__(self, callback=None):
+        """
+        Parameter
+        ---------
+        callback : callable, optional
+            Called with (phase, seconds) at the end of every phase.
+        """
+        self.callback = callback
+        self._calls = {}
+        self._seconds = {}
+        self._last = 0.0
+
+    def start(self):
+        """
+        Start timing the first phase.
+        """
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        Record the time since the last start or lap as the phase, and start timing the next phase
+        after the callback has returned.
+
+        Parameter
+        ---------
+        phase : str
+            The name of the finished phase.
+        """
+        now = time.perf_counter()
+        self.record(phase, now - self._last)
+        # コールバックの時間を次の段階に含めないように、コールバックの後から計り直す
+        self._last = now if self.callback is None else time.perf_counter()
+
+    def record(self, phase, seconds):
+        """
+        Parameters
+        ----------
+        phase : str
+            The name of the phase.
+        seconds : float
+            The time spent in the phase.
+        """
+        self._calls[phase] = self._calls.get(phase, 0) + 1
+        self._seconds[phase] = self._seconds.get(phase, 0.0) + seconds
+        if self.callback is not None:
+            self.callback(phase, seconds)
+
+    def stats(self):
+        """
+        Return
+        ------
+        stats : dict[str, dict[str, float]]
+            {"calls": the number of calls, "seconds": the cumulative time} of each phase.
+        """
+        return {phase: {"calls": self._calls[phase], "seconds": self._seconds[phase]} for phase in self._calls}
+
+    def clear(self):
+        """
+        Forget the recorded stats.
+        """
+        self._calls.clear()
+        self._seconds.clear()
+
+
+def merge_stats(stats_list):
+    """
+    Aggregate the stats of several profilers, e.g. of the workers.
+
+    Parameter
+    ---------
+    stats_list : iterable[dict[str, dict[str, float]]]
+        The stats returned by StepProfiler.stats.
+
+    Return
+    ------
+    stats : dict[str, dict[str, float]]
+        The summed calls and seconds of each phase.
+    """
+    merged = {}
+    for stats in stats_list:
+        for phase, values in stats.items():
+            total = merged.setdefault(phase, {"calls": 0, "seconds": 0.0})
+            total["calls"] += values["calls"]
+            total["seconds"] += values["seconds"]
+    return merged
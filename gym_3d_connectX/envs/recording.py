@@ -0,0 +1,308 @@
+import collections
+import glob
+import os
+
+import numpy as np
+
+from gym_3d_connectX.envs.utility import iter_boards
+
+# インデックスファイルの1レコード。手の列は .moves ファイルの offset から length 個の int16。
+_INDEX_DTYPE = np.dtype([
+    ("offset", "<i8"),
+    ("length", "<i4"),
+    ("num_grid", "<i2"),
+    ("num_win_seq", "<i2"),
+    ("first_player", "i1"),
+    ("winner", "i1"),
+    ("win_reward", "<f4"),
+    ("draw_penalty", "<f4"),
+    ("lose_penalty", "<f4"),
+    ("could_locate_reward", "<f4"),
+    ("couldnt_locate_penalty", "<f4"),
+    ("time_penalty", "<f4"),
+])
+_REWARD_FIELDS = ["win_reward", "draw_penalty", "lose_penalty", "could_locate_reward", "couldnt_locate_penalty",
+                  "time_penalty"]
+_MOVES_DTYPE = np.dtype("<i2")
+
+Episode = collections.namedtuple("Episode", ["actions", "players", "winner", "num_grid", "num_win_seq", "rewards"])
+
+
+def _shard_paths(directory):
+    """
+    Return the paths of the shards in the directory without the extensions, in the order of writing.
+    """
+    return sorted(path[:-len(".index")] for path in glob.glob(os.path.join(directory, "shard-*.index")))
+
+
+class EpisodeRecorder:
+    """
+    Stream finished games to append-only shard files.
+
+    Each shard consists of two files. "shard-NNNNN.moves" is the concatenated actions of the games as int16,
+    and "shard-NNNNN.index" is a fixed-size record of each game (the offset and the length of its actions,
+    the first player, the winner, the board configuration and the reward parameters of UtilClass).
+    The actions are written before the index record, so a game is visible to the readers only when it is
+    completely written. A new recorder numbers its shards after the highest existing shard and never reopens
+    the existing shards (a name collision raises FileExistsError), but only one recorder at a time may write
+    to a directory.
+
+    Attributes
+    ----------
+    directory : str
+        The directory of the shards.
+    shard_size : int
+        The number of games in a shard.
+    num_recorded : int
+        The number of the games recorded by this recorder.
+    """
+
+    def __init__(self, directory, shard_size=100000):
+        """
+        Parameters
+        ----------
+        directory : str
+            The directory of the shards. It is created if it does not exist.
+        shard_size : int
+            The number of games in a shard.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_size = shard_size
+        self.num_recorded = 0
+        # 消されたシャードがあっても既存のシャードと番号が重ならないように、最大の番号の次から始める
+        shard_ids = [int(os.path.basename(path)[len("shard-"):].split(".")[0])
+                     for path in glob.glob(os.path.join(directory, "shard-*.*"))]
+        self._next_shard = max(shard_ids, default=-1) + 1
+        self._moves_file = None
+        self._index_file = None
+        self._shard_games = 0
+        self._shard_moves = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, actions, first_player, winner, utils):
+        """
+        Append a finished game.
+
+        Parameters
+        ----------
+        actions : array_like
+            The action numbers of the moves which placed a stone, in order.
+        first_player : int
+            The player number of the first move.
+        winner : int
+            The player number of the winning side, or 0 for a draw.
+        utils : UtilClass
+            The board configuration and the reward parameters of the game.
+        """
+        if self._moves_file is None or self._shard_games >= self.shard_size:
+            self._open_shard()
+
+        actions = np.asarray(actions, dtype=_MOVES_DTYPE)
+        record = np.zeros(1, dtype=_INDEX_DTYPE)
+        record["offset"] = self._shard_moves
+        record["length"] = len(actions)
+        record["num_grid"] = utils.num_grid
+        record["num_win_seq"] = utils.num_win_seq
+        record["first_player"] = first_player
+        record["winner"] = winner
+        for field in _REWARD_FIELDS:
+            record[field] = getattr(utils, field)
+
+        self._moves_file.write(actions.tobytes())
+        self._index_file.write(record.tobytes())
+        self._shard_games += 1
+        self._shard_moves += len(actions)
+        self.num_recorded += 1
+
+    def flush(self):
+        """
+        Flush the written games so that the readers opened after this call can see them.
+        """
+        if self._moves_file is not None:
+            self._moves_file.flush()
+            self._index_file.flush()
+
+    def close(self):
+        """
+        Close the current shard.
+        """
+        if self._moves_file is not None:
+            self._moves_file.close()
+            self._index_file.close()
+            self._moves_file = None
+            self._index_file = None
+
+    def _open_shard(self):
+        """
+        Close the current shard and start a new one.
+        """
+        self.close()
+        path = os.path.join(self.directory, f"shard-{self._next_shard:05d}")
+        self._next_shard += 1
+        # 手の列を先に開いておき、インデックスが存在するシャードは必ず手の列も存在するようにする。
+        # 既存のシャードに追記すると offset が合わなくなるので、同じ名前のファイルがあれば例外にする。
+        self._moves_file = open(path + ".moves", "xb")
+        self._index_file = open(path + ".index", "xb")
+        self._shard_games = 0
+        self._shard_moves = 0
+
+
+class EpisodeReader:
+    """
+    Read the games written by EpisodeRecorder.
+
+    The shards are memory-mapped, and the boards and (state, action, return) tuples are reconstructed
+    lazily from the actions, so the datasets are never loaded into RAM as a whole.
+    """
+
+    def __init__(self, directory):
+        """
+        Parameter
+        ---------
+        directory : str
+            The directory of the shards.
+        """
+        self._indices = []
+        self._moves = []
+        for path in _shard_paths(directory):
+            num_games = os.path.getsize(path + ".index") // _INDEX_DTYPE.itemsize
+            num_moves = os.path.getsize(path + ".moves") // _MOVES_DTYPE.itemsize
+            if num_games == 0:
+                continue
+            self._indices.append(np.memmap(path + ".index", dtype=_INDEX_DTYPE, mode="r", shape=(num_games,)))
+            self._moves.append(np.memmap(path + ".moves", dtype=_MOVES_DTYPE, mode="r", shape=(num_moves,))
+                               if num_moves else np.zeros(0, dtype=_MOVES_DTYPE))
+        self._offsets = np.cumsum([0] + [len(index) for index in self._indices])
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __iter__(self):
+        for episode_id in range(len(self)):
+            yield self.episode(episode_id)
+
+    def _record(self, episode_id):
+        """
+        Return the index record and the memory-mapped actions of the game.
+        """
+        if not 0 <= episode_id < len(self):
+            raise IndexError(f"episode {episode_id} is out of range for {len(self)} episodes")
+        shard = int(np.searchsorted(self._offsets, episode_id, side="right")) - 1
+        record = self._indices[shard][episode_id - self._offsets[shard]]
+        actions = self._moves[shard][record["offset"]:record["offset"] + record["length"]]
+        return record, actions
+
+    def episode(self, episode_id):
+        """
+        Parameter
+        ---------
+        episode_id : int
+            The number of the game in the order of writing.
+
+        Return
+        ------
+        episode : Episode
+            actions : ndarray
+                The memory-mapped action numbers of the game.
+            players : ndarray
+                The player number of each move.
+            winner : int
+                The player number of the winning side, or 0 for a draw.
+            num_grid, num_win_seq : int
+                The board configuration.
+            rewards : dict[str, float]
+                The reward parameters of UtilClass.
+        """
+        record, actions = self._record(episode_id)
+        # 石を置けた手だけが記録されているので、手番は交互に入れ替わる
+        players = np.where(np.arange(len(actions)) % 2 == 0, record["first_player"], -record["first_player"])
+        return Episode(actions, players.astype(np.int8), int(record["winner"]), int(record["num_grid"]),
+                       int(record["num_win_seq"]), {field: float(record[field]) for field in _REWARD_FIELDS})
+
+    def boards(self, episode_id):
+        """
+        Parameter
+        ---------
+        episode_id : int
+            The number of the game in the order of writing.
+
+        Yields
+        ------
+        board : ndarray
+            The three-dimensional int8 array after each move.
+        """
+        episode = self.episode(episode_id)
+        return iter_boards(np.stack([episode.actions, episode.players], axis=1), episode.num_grid)
+
+    def returns(self, episode_id, gamma=1.0):
+        """
+        Compute the return of each move from the perspective of the player who made it.
+
+        The rewards are the ones AnyNumberInARow3dEnv gives (could_locate_reward for each move, win_reward for
+        the winning move and -draw_penalty for the last move of a draw). In addition, -lose_penalty is given
+        to the last move of the loser. The return of a move is the discounted sum of the rewards of the same
+        player's moves from that move on.
+
+        Parameters
+        ----------
+        episode_id : int
+            The number of the game in the order of writing.
+        gamma : float
+            The discount factor per own move.
+
+        Return
+        ------
+        returns : ndarray
+            The return of each move.
+        """
+        episode = self.episode(episode_id)
+        num_moves = len(episode.actions)
+        rewards = np.full(num_moves, episode.rewards["could_locate_reward"], dtype=np.float64)
+        if num_moves:
+            if episode.winner != 0:
+                rewards[-1] = episode.rewards["win_reward"]
+                if num_moves > 1:
+                    rewards[-2] -= episode.rewards["lose_penalty"]
+            else:
+                rewards[-1] = -episode.rewards["draw_penalty"]
+
+        returns = np.zeros(num_moves, dtype=np.float64)
+        for t in range(num_moves - 1, -1, -1):
+            returns[t] = rewards[t] + (gamma * returns[t + 2] if t + 2 < num_moves else 0)
+        return returns
+
+    def transitions(self, episode_id, gamma=1.0):
+        """
+        Reconstruct (state, action, return) of each move lazily.
+
+        Parameters
+        ----------
+        episode_id : int
+            The number of the game in the order of writing.
+        gamma : float
+            The discount factor per own move. See returns.
+
+        Yields
+        ------
+        state : ndarray
+            The board before the move, from the perspective of the player to move
+            (the stones of the player to move are 1 and the opponent's stones are -1).
+        action : int
+            The action number of the move.
+        return : float
+            The return of the move.
+        """
+        episode = self.episode(episode_id)
+        returns = self.returns(episode_id, gamma)
+        board = np.zeros((episode.num_grid,) * 3, dtype=np.int8)
+        for board_after, action, player_number, move_return in zip(
+                iter_boards(np.stack([episode.actions, episode.players], axis=1), episode.num_grid),
+                episode.actions, episode.players, returns):
+            yield board * player_number, int(action), float(move_return)
+            board = board_after
@@ -0,0 +1,222 @@
+import json
+import os
+
+import numpy as np
+
+# プレーヤー番号ごとの石の色。空のマスは透明にする。
+DEFAULT_COLORS = {0: "rgba(0,0,0,0)", 1: "red", -1: "blue"}
+
+
+def scatter_data(boards, drop_empty=True):
+    """
+    Build the data of the 3D scatter plot of the boards in one vectorized pass.
+
+    Parameters
+    ----------
+    boards : array_like
+        A (N, N, N) board or a (num_frames, N, N, N) sequence of boards, indexed by [height][wide][depth].
+    drop_empty : bool
+        If true, the empty cells are left out.
+
+    Return
+    ------
+    data : dict[str, ndarray]
+        The columns "W", "D", "H", "Player" and "frame" of the cells, sorted by frame.
+    """
+    boards = np.asarray(boards)
+    if boards.ndim == 3:
+        boards = boards[None]
+    num_frames, num_grid = boards.shape[0], boards.shape[-1]
+    height, wide, depth = np.indices((num_grid,) * 3)
+    shape = boards.shape
+    data = {
+        "W": np.broadcast_to(wide, shape).ravel(),
+        "D": np.broadcast_to(depth, shape).ravel(),
+        "H": np.broadcast_to(height, shape).ravel(),
+        "Player": boards.ravel(),
+        "frame": np.broadcast_to(np.arange(num_frames)[:, None, None, None], shape).ravel(),
+    }
+    if drop_empty:
+        occupied = data["Player"] != 0
+        data = {key: value[occupied] for key, value in data.items()}
+    return data
+
+
+def to_dataframe(boards, drop_empty=True):
+    """
+    Parameters
+    ----------
+    boards : array_like
+        A (N, N, N) board or a (num_frames, N, N, N) sequence of boards.
+    drop_empty : bool
+        If true, the empty cells are left out.
+
+    Return
+    ------
+    data : pandas.DataFrame
+        The data of scatter_data as a DataFrame.
+    """
+    import pandas as pd
+
+    return pd.DataFrame(scatter_data(boards, drop_empty=drop_empty))
+
+
+def make_figure(boards, animate=False, drop_empty=True, colors=None, width=854, height=480):
+    """
+    Make the plotly figure of a board, or of the animation of a sequence of boards.
+
+    Each frame is a single trace colored per cell, so the frames may have different numbers of stones.
+
+    Parameters
+    ----------
+    boards : array_like
+        A (N, N, N) board or a (num_frames, N, N, N) sequence of boards.
+    animate : bool
+        If true, the boards are the frames of an animation. Otherwise only the last board is drawn.
+    drop_empty : bool
+        If true, the empty cells are left out.
+    colors : dict[int, str], optional
+        The color of each player number (0 for the empty cells). Defaults to DEFAULT_COLORS.
+    width : int
+        The width of the figure in pixels.
+    height : int
+        The height of the figure in pixels.
+
+    Return
+    ------
+    fig : plotly.graph_objects.Figure
+        The figure.
+    """
+    import plotly.graph_objects as go
+
+    boards = np.asarray(boards)
+    if boards.ndim == 3:
+        boards = boards[None]
+    if not animate:
+        boards = boards[-1:]
+    colors = DEFAULT_COLORS if colors is None else colors
+    num_frames, num_grid = boards.shape[0], boards.shape[-1]
+
+    data = scatter_data(boards, drop_empty=drop_empty)
+    color_table = np.array([colors[-1], colors[0], colors[1]], dtype=object)
+    cell_colors = color_table[data["Player"].astype(np.intp) + 1]
+    # frame の昇順に並んでいるので、各フレームの範囲は二分探索で求まる
+    bounds = np.searchsorted(data["frame"], np.arange(num_frames + 1))
+
+    def trace(frame):
+        cells = slice(bounds[frame], bounds[frame + 1])
+        return go.Scatter3d(x=data["W"][cells], y=data["D"][cells], z=data["H"][cells], mode="markers",
+                            marker={"color": cell_colors[cells], "opacity": 0.95},
+                            customdata=data["Player"][cells], hovertemplate="W=%{x}<br>D=%{y}<br>H=%{z}"
+                                                                           "<br>Player=%{customdata}<extra></extra>")
+
+    range_list = [-0.4, num_grid - 0.6]
+    axis = {"range": range_list, "autorange": False}
+    layout = go.Layout(width=width, height=height, showlegend=False,
+                       scene={"xaxis": {"title": "W", **axis}, "yaxis": {"title": "D", **axis},
+                              "zaxis": {"title": "H", **axis}, "aspectmode": "cube"})
+    if not animate:
+        return go.Figure(data=[trace(0)], layout=layout)
+
+    frames = [go.Frame(data=[trace(frame)], name=str(frame)) for frame in range(num_frames)]
+    frame_args = {"frame": {"duration": 500, "redraw": True}, "mode": "immediate", "transition": {"duration": 0}}
+    layout.updatemenus = [{
+        "type": "buttons",
+        "buttons": [{"label": "Play", "method": "animate", "args": [None, frame_args]},
+                    {"label": "Pause", "method": "animate", "args": [[None], {**frame_args, "frame": {"duration": 0}}]}],
+    }]
+    layout.sliders = [{
+        "currentvalue": {"prefix": "frame="},
+        "steps": [{"label": str(frame), "method": "animate", "args": [[str(frame)], frame_args]}
+                  for frame in range(num_frames)],
+    }]
+    return go.Figure(data=[trace(0)], layout=layout, frames=frames)
+
+
+def export_json(path, boards, drop_empty=True):
+    """
+    Write the scatter data of the boards as JSON, without plotly.
+
+    Parameters
+    ----------
+    path : str
+        The path of the JSON file.
+    boards : array_like
+        A (N, N, N) board or a (num_frames, N, N, N) sequence of boards.
+    drop_empty : bool
+        If true, the empty cells are left out.
+    """
+    boards = np.asarray(boards)
+    data = scatter_data(boards, drop_empty=drop_empty)
+    document = {"num_grid": int(boards.shape[-1]), "num_frames": 1 if boards.ndim == 3 else int(boards.shape[0])}
+    document.update({key: value.tolist() for key, value in data.items()})
+    with open(path, "w") as f:
+        json.dump(document, f)
+
+
+def export_html(path, boards, animate=True, drop_empty=True, colors=None, include_plotlyjs="cdn"):
+    """
+    Write the figure of make_figure as a standalone HTML file, without opening a browser.
+
+    Parameters
+    ----------
+    path : str
+        The path of the HTML file.
+    boards : array_like
+        A (N, N, N) board or a (num_frames, N, N, N) sequence of boards.
+    animate : bool
+        If true, the boards are the frames of an animation.
+    drop_empty : bool
+        If true, the empty cells are left out.
+    colors : dict[int, str], optional
+        The color of each player number. Defaults to DEFAULT_COLORS.
+    include_plotlyjs : bool or str
+        Passed to plotly. "cdn" keeps the files small by loading plotly.js from the CDN.
+    """
+    fig = make_figure(boards, animate=animate, drop_empty=drop_empty, colors=colors)
+    fig.write_html(path, include_plotlyjs=include_plotlyjs, auto_play=False)
+
+
+def export_episodes(reader, directory, episode_ids=None, fmt="html", drop_empty=True, colors=None):
+    """
+    Export the games recorded by EpisodeRecorder for offline review.
+
+    Parameters
+    ----------
+    reader : EpisodeReader
+        The reader of the recorded games.
+    directory : str
+        The output directory. It is created if it does not exist.
+    episode_ids : iterable[int], optional
+        The games to export. Defaults to all the games.
+    fmt : str
+        "html" for the animations or "json" for the scatter data.
+    drop_empty : bool
+        If true, the empty cells are left out.
+    colors : dict[int, str], optional
+        The color of each player number, used for "html".
+
+    Return
+    ------
+    paths : list[str]
+        The paths of the written files. A game without moves is written as one frame of the empty board.
+    """
+    if fmt not in ("html", "json"):
+        raise ValueError(f"fmt must be 'html' or 'json', but got {fmt!r}")
+    os.makedirs(directory, exist_ok=True)
+    episode_ids = range(len(reader)) if episode_ids is None else episode_ids
+    paths = []
+    for episode_id in episode_ids:
+        boards = list(reader.boards(episode_id))
+        if not boards:
+            # 手のないゲームは空の盤面1枚として書き出す
+            num_grid = reader.episode(episode_id).num_grid
+            boards = [np.zeros((num_grid, num_grid, num_grid), dtype=np.int8)]
+        boards = np.stack(boards)
+        path = os.path.join(directory, f"episode-{episode_id:06d}.{fmt}")
+        if fmt == "html":
+            export_html(path, boards, drop_empty=drop_empty, colors=colors)
+        else:
+            export_json(path, boards, drop_empty=drop_empty)
+        paths.append(path)
+    return paths
@@ -0,0 +1,551 @@
+"""
+Local asyncio server hosting many concurrent matches.
+
+Agents connect through localhost TCP or a Unix socket, join matches and exchange small binary messages.
+Every message is a little-endian uint32 length followed by the payload:
+
+    client -> server
+        JOIN   (uint8 1, uint8 opponent, int8 seat)      opponent: 0 = the server's model, 1 = another client
+                                                         seat: 1 = first, -1 = second, 0 = either
+        MOVE   (uint8 2, uint32 match_id, uint16 action)
+    server -> client
+        STATE  (uint8 1, uint32 match_id, int8 you, int8 to_move, uint8 done, int8 winner, int16 last_action,
+                int8[N ** 3] board)
+
+A STATE is sent when it is the client's turn and when the match has finished. An illegal move (a full pile,
+a position off the board, or a move out of turn) and a disconnection lose the match. A connection waits for
+at most one remote opponent at a time, so a JOIN "remote" while it is already waiting is ignored.
+With seat 0 the server alternates the seats of the matches against the model, and of the pairs of clients
+which both accept either seat, so that an agent is evaluated on both sides. Two clients asking for the same
+seat are not paired with each other.
+An empty or unknown message closes the connection. If batch_policy raises, the model forfeits the matches
+of the batch.
+The moves of the server's model are gathered from all the matches and answered by one batched call of
+batch_policy, so a single model process serves thousands of matches. After each batch the server waits for
+the connections whose send buffers are above the high-water mark, so that clients which read slowly slow the
+model down instead of growing the buffers without bound.
+
+    python -m gym_3d_connectX.envs.server --port 5000
+"""
+import argparse
+import asyncio
+import collections
+import inspect
+import itertools
+import struct
+
+import numpy as np
+
+from gym_3d_connectX.envs.utility import UtilClass
+from gym_3d_connectX.envs.vector_env import sample_masked
+
+_HEADER = struct.Struct("<I")
+_JOIN = struct.Struct("<BBb")
+_MOVE = struct.Struct("<BIH")
+_STATE = struct.Struct("<BIbbBbh")
+MSG_JOIN, MSG_MOVE, MSG_STATE = 1, 2, 1
+OPPONENT_MODEL, OPPONENT_REMOTE = 0, 1
+_OPPONENTS = {"model": OPPONENT_MODEL, "remote": OPPONENT_REMOTE}
+# サーバー側のモデルが担当する手番を表す値
+_MODEL = "model"
+
+GameState = collections.namedtuple("GameState", ["match_id", "player", "to_move", "done", "winner", "last_action",
+                                                 "board"])
+
+
+async def _read_message(reader):
+    """
+    Read a length-prefixed message.
+    """
+    length, = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return await reader.readexactly(length)
+
+
+def _write_message(writer, payload):
+    """
+    Write a length-prefixed message.
+    """
+    writer.write(_HEADER.pack(len(payload)) + payload)
+
+
+def random_batch_policy(boards, players, legal_masks):
+    """
+    A batch policy choosing uniformly random legal actions.
+
+    Parameters
+    ----------
+    boards : ndarray
+        A (B, N, N, N) int8 array of the positions.
+    players : ndarray
+        The (B,) player numbers to move.
+    legal_masks : ndarray
+        A (B, N, N) boolean array of the legal actions.
+
+    Return
+    ------
+    actions : ndarray
+        The (B,) action numbers.
+    """
+    return sample_masked(legal_masks.reshape(len(legal_masks), -1), np.random)
+
+
+class _Match:
+    """
+    The state of a match hosted by GameServer.
+    """
+
+    def __init__(self, match_id, num_grid, sides):
+        self.match_id = match_id
+        self.board = np.zeros((num_grid, num_grid, num_grid), dtype=np.int8)
+        self.heights = np.zeros((num_grid, num_grid), dtype=np.intp)
+        self.num_stones = 0
+        self.player = 1
+        # プレーヤー番号ごとの担当 (接続、またはサーバーのモデル)
+        self.sides = sides
+        self.done = False
+        self.winner = 0
+        self.last_action = -1
+
+
+class GameServer:
+    """
+    Host matches of "Any Number in a Row" for remote agents.
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    batch_policy : callable
+        Called with (boards, players, legal_masks) of the pending moves of the model and returns the actions.
+        It may be a coroutine function.
+    max_batch_size : int
+        The maximum number of the moves answered at once.
+    max_wait : float
+        The time in seconds to wait for more pending moves after the first one.
+    utils : UtilClass
+        The rules of the game.
+    num_batches : int
+        The number of the calls of batch_policy.
+    num_model_moves : int
+        The number of the moves answered by batch_policy.
+    num_finished : int
+        The number of the finished matches.
+    num_policy_errors : int
+        The number of the calls of batch_policy which raised an exception.
+    """
+
+    def __init__(self, num_grid=4, num_win_seq=4, batch_policy=random_batch_policy, max_batch_size=1024,
+                 max_wait=0.002):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        batch_policy : callable
+            Called with (boards, players, legal_masks) and returns the actions.
+        max_batch_size : int
+            The maximum number of the moves answered at once.
+        max_wait : float
+            The time in seconds to wait for more pending moves after the first one.
+        """
+        self.num_grid = num_grid
+        self.num_win_seq = num_win_seq
+        self.batch_policy = batch_policy
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # 報酬は使わないので0にしておく
+        self.utils = UtilClass(num_grid, num_win_seq, 0, 0, 0, 0, 0, 0)
+        self.num_batches = 0
+        self.num_model_moves = 0
+        self.num_finished = 0
+        self.num_policy_errors = 0
+        self._matches = {}
+        self._match_ids = itertools.count()
+        self._waiting = collections.deque()
+        self._next_seat = 1
+        self._queue = None
+        self._server = None
+        self._batch_task = None
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        """
+        Start listening.
+
+        Parameters
+        ----------
+        host : str
+            The host of the TCP server.
+        port : int
+            The port of the TCP server. 0 chooses a free port.
+        path : str, optional
+            If given, listen on this Unix socket instead of TCP.
+
+        Return
+        ------
+        address : tuple or str
+            The (host, port) of the TCP server or the path of the Unix socket.
+        """
+        self._queue = asyncio.Queue()
+        self._batch_task = asyncio.ensure_future(self._batch_loop())
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+            return path
+        self._server = await asyncio.start_server(self._handle, host=host, port=port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """
+        Stop listening and the batch loop.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        self._batch_task.cancel()
+        try:
+            await self._batch_task
+        except asyncio.CancelledError:
+            pass
+
+    async def _handle(self, reader, writer):
+        """
+        Serve a connection until it is closed.
+        """
+        try:
+            while True:
+                payload = await _read_message(reader)
+                if not payload:
+                    break
+                if payload[0] == MSG_JOIN and len(payload) == _JOIN.size:
+                    _, opponent, seat = _JOIN.unpack(payload)
+                    self._join(writer, opponent, seat)
+                elif payload[0] == MSG_MOVE and len(payload) == _MOVE.size:
+                    _, match_id, action = _MOVE.unpack(payload)
+                    match = self._matches.get(match_id)
+                    if match is None:
+                        pass
+                    elif match.sides[match.player] is writer:
+                        self._play(match, action)
+                    elif match.sides[-match.player] is writer:
+                        # 手番でない手は反則負け
+                        self._finish(match, match.player)
+                else:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # 切断した接続の試合は負けにする
+            for match in list(self._matches.values()):
+                for player, side in match.sides.items():
+                    if side is writer and not match.done:
+                        self._finish(match, -player)
+            self._waiting = collections.deque(entry for entry in self._waiting if entry[0] is not writer)
+            writer.close()
+
+    def _join(self, writer, opponent, seat):
+        """
+        Start a match against the model, or pair the connection with a waiting one.
+        """
+        if seat not in (-1, 0, 1):
+            seat = 0
+        if opponent == OPPONENT_REMOTE:
+            # 自分自身と対戦しないように、待機中の接続からの2回目の参加は受け付けない
+            if any(waiting is writer for waiting, _ in self._waiting):
+                return
+            # 同じ席を希望する接続同士は組まない
+            partner = next((entry for entry in self._waiting if seat == 0 or entry[1] != seat), None)
+            if partner is None:
+                self._waiting.append((writer, seat))
+                return
+            self._waiting.remove(partner)
+            waiting, waiting_seat = partner
+            if waiting_seat == 0:
+                waiting_seat = -seat if seat != 0 else self._alternate_seat()
+            sides = {waiting_seat: waiting, -waiting_seat: writer}
+        else:
+            seat = seat if seat != 0 else self._alternate_seat()
+            sides = {seat: writer, -seat: _MODEL}
+        match = _Match(next(self._match_ids), self.num_grid, sides)
+        self._matches[match.match_id] = match
+        self._advance(match)
+
+    def _alternate_seat(self):
+        """
+        Return 1 and -1 in turn, the seat of the matches whose clients accept either seat.
+        """
+        seat = self._next_seat
+        self._next_seat = -seat
+        return seat
+
+    def _play(self, match, action):
+        """
+        Apply the action of the player to move, or the forfeit for an illegal action.
+        """
+        if not 0 <= action < self.num_grid * self.num_grid:
+            self._finish(match, -match.player)
+            return
+        wide, depth = divmod(int(action), self.num_grid)
+        _, _, is_couldnt_locate = self.utils.resolve_placing(wide, depth, match.player, match.board, match.heights)
+        if is_couldnt_locate:
+            self._finish(match, -match.player)
+            return
+        match.num_stones += 1
+        match.last_action = int(action)
+        if self.utils.is_done_at(match.board, *self.utils.last_position):
+            self._finish(match, match.player)
+        elif match.num_stones == self.num_grid ** 3:
+            self._finish(match, 0)
+        else:
+            match.player = -match.player
+            self._advance(match)
+
+    def _advance(self, match):
+        """
+        Ask the side to move for an action.
+        """
+        side = match.sides[match.player]
+        if side is _MODEL:
+            self._queue.put_nowait(match)
+        else:
+            self._send_state(side, match, match.player)
+
+    def _finish(self, match, winner):
+        """
+        Finish the match and notify the clients.
+        """
+        match.done = True
+        match.winner = winner
+        del self._matches[match.match_id]
+        self.num_finished += 1
+        for player, side in match.sides.items():
+            if side is not _MODEL and not side.is_closing():
+                self._send_state(side, match, player)
+
+    def _send_state(self, writer, match, player):
+        """
+        Send the state of the match to the client playing player.
+        """
+        header = _STATE.pack(MSG_STATE, match.match_id, player, match.player, match.done, match.winner,
+                             match.last_action)
+        _write_message(writer, header + match.board.tobytes())
+
+    async def _batch_loop(self):
+        """
+        Gather the pending moves of the model from all the matches and answer them in one call.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [match for match in batch if not match.done]
+            if not batch:
+                continue
+            boards = np.stack([match.board for match in batch])
+            players = np.array([match.player for match in batch], dtype=np.int8)
+            legal_masks = np.stack([match.heights < self.num_grid for match in batch])
+            try:
+                actions = self.batch_policy(boards, players, legal_masks)
+                if inspect.isawaitable(actions):
+                    actions = await actions
+                actions = np.asarray(actions).reshape(len(batch))
+            except Exception:
+                # モデルが手を返せなければ、ループを止めずにその試合をモデルの反則負けにする
+                self.num_policy_errors += 1
+                for match in batch:
+                    if not match.done:
+                        self._finish(match, -match.player)
+                await self._drain(batch)
+                continue
+            self.num_batches += 1
+            self.num_model_moves += len(batch)
+            for match, action in zip(batch, actions):
+                self._play(match, int(action))
+            await self._drain(batch)
+
+    async def _drain(self, batch):
+        """
+        Wait for the connections of the batch whose send buffers are above the high-water mark, so that the
+        model does not run ahead of the clients which do not read their states.
+        """
+        writers = {id(side): side for match in batch for side in match.sides.values()
+                   if side is not _MODEL and not side.is_closing()}
+        # バッファが上限を超えた接続だけを待ち、ほかの接続は待たない
+        writers = [writer for writer in writers.values()
+                   if writer.transport.get_write_buffer_size() > writer.transport.get_write_buffer_limits()[1]]
+        results = await asyncio.gather(*(writer.drain() for writer in writers), return_exceptions=True)
+        for result in results:
+            # 切断した接続は _handle が片付ける
+            if isinstance(result, BaseException) and not isinstance(result, ConnectionError):
+                raise result
+
+
+class GameClient:
+    """
+    Client of GameServer. A client can play many matches at the same time on one connection.
+    """
+
+    def __init__(self, reader, writer):
+        """
+        Parameters
+        ----------
+        reader : asyncio.StreamReader
+            The stream from the server.
+        writer : asyncio.StreamWriter
+            The stream to the server.
+        """
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=None, path=None):
+        """
+        Parameters
+        ----------
+        host : str
+            The host of the TCP server.
+        port : int, optional
+            The port of the TCP server.
+        path : str, optional
+            The path of the Unix socket, instead of TCP.
+
+        Return
+        ------
+        client : GameClient
+            The connected client.
+        """
+        if path is not None:
+            return cls(*await asyncio.open_unix_connection(path))
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def join(self, opponent="model", seat=0):
+        """
+        Ask for a new match. Its first STATE arrives by receive when it is the client's turn.
+
+        Parameters
+        ----------
+        opponent : str
+            "model" plays against the server's model, "remote" against another client.
+        seat : int
+            1 to move first, -1 to move second, or 0 to let the server alternate the seats.
+        """
+        _write_message(self._writer, _JOIN.pack(MSG_JOIN, _OPPONENTS[opponent], seat))
+        await self._writer.drain()
+
+    async def move(self, match_id, action):
+        """
+        Parameters
+        ----------
+        match_id : int
+            The match.
+        action : int
+            The action number.
+        """
+        _write_message(self._writer, _MOVE.pack(MSG_MOVE, match_id, action))
+        await self._writer.drain()
+
+    async def receive(self):
+        """
+        Return
+        ------
+        state : GameState
+            The next state sent by the server. board is a (N, N, N) int8 array.
+        """
+        payload = await _read_message(self._reader)
+        _, match_id, player, to_move, done, winner, last_action = _STATE.unpack_from(payload)
+        board = np.frombuffer(payload, dtype=np.int8, offset=_STATE.size)
+        num_grid = int(round(len(board) ** (1 / 3)))
+        return GameState(match_id, player, to_move, bool(done), winner, last_action,
+                         board.reshape(num_grid, num_grid, num_grid))
+
+    async def close(self):
+        """
+        Close the connection.
+        """
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+async def play_games(policy, num_games, host="127.0.0.1", port=None, path=None, opponent="model", concurrency=1,
+                     seat=0):
+    """
+    Connect to a server and play games with a policy.
+
+    Parameters
+    ----------
+    policy : callable
+        Called with (board, player, legal_mask) and returns the action number.
+    num_games : int
+        The number of the games.
+    host, port, path
+        The address of the server. See GameClient.connect.
+    opponent : str
+        "model" or "remote". See GameClient.join.
+    seat : int
+        1, -1 or 0 for every match. See GameClient.join.
+    concurrency : int
+        The number of the matches played at the same time. It must be 1 against remote opponents,
+        since a connection waits for one remote opponent at a time.
+
+    Return
+    ------
+    results : list[int]
+        1 for a win, 0 for a draw and -1 for a loss of each game, in the order of finishing.
+    """
+    if opponent == "remote" and concurrency != 1:
+        raise ValueError(f"concurrency must be 1 against remote opponents, but got {concurrency}")
+    client = await GameClient.connect(host=host, port=port, path=path)
+    results = []
+    num_joined = min(concurrency, num_games)
+    for _ in range(num_joined):
+        await client.join(opponent, seat)
+    try:
+        while len(results) < num_games:
+            state = await client.receive()
+            if state.done:
+                results.append(int(np.sign(state.winner * state.player)))
+                if num_joined < num_games:
+                    num_joined += 1
+                    await client.join(opponent, seat)
+            else:
+                legal_mask = state.board[-1] == 0
+                await client.move(state.match_id, int(policy(state.board, state.player, legal_mask)))
+    finally:
+        await client.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Host matches against a random model.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--path", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--num-grid", type=int, default=4)
+    parser.add_argument("--num-win-seq", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    async def serve():
+        server = GameServer(num_grid=args.num_grid, num_win_seq=args.num_win_seq)
+        address = await server.start(host=args.host, port=args.port, path=args.path)
+        print(f"listening on {address}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
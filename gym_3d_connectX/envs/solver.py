@@ -0,0 +1,411 @@
+import collections
+import time
+
+import numpy as np
+
+from gym_3d_connectX.envs.bitboard import BitBoard
+from gym_3d_connectX.envs.utility import get_zobrist_keys
+
+# 勝ちの評価値。勝ちまでの手数が短いほど大きくなるように、WIN_VALUE - (勝ちが決まる手数) を返す。
+WIN_VALUE = 1000000
+# 手番がプレーヤー-1のときにハッシュに加える値
+_SIDE_KEY = 0x9E3779B97F4A7C15
+
+SearchResult = collections.namedtuple("SearchResult", ["value", "action", "depth", "exact", "nodes"])
+
+
+class _Timeout(Exception):
+    """
+    Raised inside the search when the time limit is exceeded.
+    """
+
+
+def is_win_value(value):
+    """
+    Parameter
+    ---------
+    value : int
+        An evaluation value returned by NegamaxSolver.
+
+    Return
+    ------
+    is_win_value : bool
+        Whether the value means a proven win or loss.
+    """
+    return abs(value) > WIN_VALUE // 2
+
+
+class TranspositionTable:
+    """
+    Transposition table of a fixed number of slots indexed by the lower bits of the Zobrist hash.
+
+    When two positions share a slot, the new entry replaces the old one if the old one is from a previous
+    search, or if the new one is searched at least as deep (depth-preferred replacement).
+
+    Attributes
+    ----------
+    size : int
+        The number of slots.
+    generation : int
+        The number of the current search, used to age out the entries of previous searches.
+    """
+    EXACT, LOWER, UPPER = 0, 1, 2
+
+    def __init__(self, size_bits=20):
+        """
+        Parameter
+        ---------
+        size_bits : int
+            The table has 2 ** size_bits slots.
+        """
+        self.size = 1 << size_bits
+        self._mask = self.size - 1
+        self._entries = [None] * self.size
+        self.generation = 0
+
+    def new_search(self):
+        """
+        Start a new search. The entries of the previous searches are kept but replaced first.
+        """
+        self.generation += 1
+
+    def clear(self):
+        """
+        Remove all the entries.
+        """
+        self._entries = [None] * self.size
+
+    def lookup(self, key):
+        """
+        Parameter
+        ---------
+        key : int
+            The Zobrist hash of the position.
+
+        Return
+        ------
+        entry : tuple or None
+            (key, depth, value, flag, action, generation) of the position, or None if it is not stored.
+        """
+        entry = self._entries[key & self._mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    def store(self, key, depth, value, flag, action):
+        """
+        Store the search result of the position according to the replacement policy.
+
+        Parameters
+        ----------
+        key : int
+            The Zobrist hash of the position.
+        depth : int
+            The remaining search depth of the result.
+        value : int
+            The evaluation value from the perspective of the player to move.
+        flag : int
+            EXACT, LOWER (fail-high) or UPPER (fail-low).
+        action : int
+            The best action found, or -1.
+        """
+        index = key & self._mask
+        old = self._entries[index]
+        if old is None or old[0] == key or old[5] != self.generation or depth >= old[1]:
+            self._entries[index] = (key, depth, value, flag, action, self.generation)
+
+
+class NegamaxSolver:
+    """
+    Search-based player of "Any Number in a Row" with negamax and alpha-beta pruning.
+
+    The search uses iterative deepening, move ordering (the best action of the transposition table,
+    the history heuristic and closeness to the center) and a Zobrist-hashed transposition table.
+    Moves are made and unmade on a BitBoard instead of copying the board.
+    It can be used as a baseline opponent (best_action) and to label positions with exact or
+    depth-limited values (search).
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    max_depth : int
+        The default maximum depth of the search.
+    time_limit : float or None
+        The default time limit of the search in seconds.
+    table : TranspositionTable
+        The transposition table shared among the searches.
+    book : OpeningBook or None
+        The opening book answering the positions in it without searching.
+    """
+
+    def __init__(self, num_grid=4, num_win_seq=4, max_depth=4, time_limit=None, table_size_bits=20, book=None):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        max_depth : int
+            The default maximum depth of the search.
+        time_limit : float, optional
+            The default time limit of the search in seconds.
+        table_size_bits : int
+            The transposition table has 2 ** table_size_bits slots.
+        book : OpeningBook, optional
+            If given, the positions in the book searched at least as deep as max_depth (or solved) are answered
+            from the book without searching.
+        """
+        self.num_grid = num_grid
+        self.num_win_seq = num_win_seq
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.table = TranspositionTable(table_size_bits)
+        self.book = book
+
+        keys = get_zobrist_keys(num_grid)
+        self._keys = {1: [int(key) for key in keys[0]], -1: [int(key) for key in keys[1]]}
+        # 中央に近い柱から調べる
+        center = (num_grid - 1) / 2
+        self._static_order = sorted(range(num_grid * num_grid),
+                                    key=lambda action: (action // num_grid - center) ** 2
+                                    + (action % num_grid - center) ** 2)
+        # 途中までそろったラインの評価値。石の数が多いほど大きくする。
+        self._line_weights = [0] + [4 ** count for count in range(1, num_win_seq)] + [0]
+        self._bitboard = None
+        self._history = None
+        self._hash = 0
+        self._nodes = 0
+        self._deadline = None
+
+    def best_action(self, board, player_number, max_depth=None, time_limit=None):
+        """
+        Return the best action found by the search.
+
+        Parameters
+        ----------
+        board : list[list[list[int]]] or ndarray
+            A three-dimensional array representing the current state.
+        player_number : int
+            The player number to move.
+        max_depth : int, optional
+            Overrides self.max_depth.
+        time_limit : float, optional
+            Overrides self.time_limit.
+
+        Return
+        ------
+        action : int
+            The action number.
+        """
+        return self.search(board, player_number, max_depth=max_depth, time_limit=time_limit).action
+
+    def search(self, board, player_number, max_depth=None, time_limit=None):
+        """
+        Search the position with iterative deepening.
+
+        Parameters
+        ----------
+        board : list[list[list[int]]] or ndarray
+            A three-dimensional array representing the current state. The game must not be finished.
+        player_number : int
+            The player number to move.
+        max_depth : int, optional
+            Overrides self.max_depth.
+        time_limit : float, optional
+            Overrides self.time_limit. The result of the last completed depth is returned.
+
+        Return
+        ------
+        result : SearchResult
+            value : int
+                The evaluation value from the perspective of the player to move.
+                WIN_VALUE - n (or -(WIN_VALUE - n)) means a win (or a loss) at the n-th move from now,
+                and 0 with exact=True means a draw.
+            action : int
+                The best action number, or -1 if there is no legal action.
+            depth : int
+                The depth of the last completed iteration.
+            exact : bool
+                Whether the value is the game-theoretic value of the position.
+            nodes : int
+                The number of searched nodes, or 0 if the position is answered from the book.
+        """
+        max_depth = self.max_depth if max_depth is None else max_depth
+        time_limit = self.time_limit if time_limit is None else time_limit
+
+        if self.book is not None:
+            entry = self.book.lookup(board, player_number)
+            if entry is not None and (entry.exact or entry.depth >= max_depth):
+                return SearchResult(entry.value, entry.action, entry.depth, entry.exact, 0)
+
+        self._bitboard = BitBoard.from_board(board, self.num_win_seq)
+        self._hash = self._board_hash(player_number)
+        self._history = [0] * (self.num_grid * self.num_grid)
+        self._nodes = 0
+        self._deadline = None if time_limit is None else time.perf_counter() + time_limit
+        self.table.new_search()
+
+        num_empty = self.num_grid ** 3 - self._bitboard.num_stones
+        result = SearchResult(0, -1, 0, num_empty == 0, 0)
+        for depth in range(1, min(max_depth, num_empty) + 1):
+            try:
+                value, action = self._search_root(player_number, depth)
+            except _Timeout:
+                break
+            exact = is_win_value(value) or depth >= num_empty
+            result = SearchResult(value, action, depth, exact, self._nodes)
+            if exact:
+                break
+        return result._replace(nodes=self._nodes)
+
+    def _board_hash(self, player_number):
+        """
+        Compute the Zobrist hash of the bitboard and the player to move from scratch.
+        """
+        key = _SIDE_KEY if player_number == -1 else 0
+        for stones_player in (1, -1):
+            stones = self._bitboard.stones[stones_player]
+            keys = self._keys[stones_player]
+            while stones:
+                low = stones & -stones
+                key ^= keys[low.bit_length() - 1]
+                stones ^= low
+        return key
+
+    def _ordered_actions(self, tt_action):
+        """
+        Return the legal actions in the order of the search.
+        """
+        heights = self._bitboard.heights
+        history = self._history
+        actions = [action for action in self._static_order if heights[action] < self.num_grid]
+        # sorted は安定なので、履歴の値が同じ場合は中央に近い順のまま
+        actions.sort(key=lambda action: -history[action])
+        if tt_action in actions:
+            actions.remove(tt_action)
+            actions.insert(0, tt_action)
+        return actions
+
+    def _search_root(self, player_number, depth):
+        """
+        Search the root position to the depth and return (value, action).
+        """
+        entry = self.table.lookup(self._hash)
+        best_value, best_action = -WIN_VALUE - 1, -1
+        alpha, beta = -WIN_VALUE - 1, WIN_VALUE + 1
+        for action in self._ordered_actions(-1 if entry is None else entry[4]):
+            value = self._try_action(action, player_number, depth, alpha, beta, 0)
+            if value > best_value:
+                best_value, best_action = value, action
+            alpha = max(alpha, value)
+        self.table.store(self._hash, depth, best_value, TranspositionTable.EXACT, best_action)
+        return best_value, best_action
+
+    def _try_action(self, action, player_number, depth, alpha, beta, ply):
+        """
+        Make the action, search the next position and unmake the action.
+        Return the value from the perspective of player_number.
+        """
+        bitboard = self._bitboard
+        wide, depth_coord = divmod(action, self.num_grid)
+        cell = bitboard.place(wide, depth_coord, player_number)
+        self._hash ^= self._keys[player_number][cell] ^ _SIDE_KEY
+        try:
+            if bitboard.is_win_at(cell, player_number):
+                return WIN_VALUE - (ply + 1)
+            if bitboard.is_full():
+                return 0
+            return -self._negamax(-player_number, depth - 1, -beta, -alpha, ply + 1)
+        finally:
+            bitboard.undo(wide, depth_coord, player_number)
+            self._hash ^= self._keys[player_number][cell] ^ _SIDE_KEY
+
+    def _negamax(self, player_number, depth, alpha, beta, ply):
+        """
+        Negamax search with alpha-beta pruning. Return the value from the perspective of player_number.
+        """
+        self._nodes += 1
+        if self._deadline is not None and self._nodes & 1023 == 0 and time.perf_counter() > self._deadline:
+            raise _Timeout()
+
+        if depth == 0:
+            return self._evaluate(player_number)
+
+        alpha_orig = alpha
+        key = self._hash
+        entry = self.table.lookup(key)
+        tt_action = -1
+        if entry is not None:
+            tt_action = entry[4]
+            if entry[1] >= depth:
+                value = self._value_from_table(entry[2], ply)
+                flag = entry[3]
+                if flag == TranspositionTable.EXACT:
+                    return value
+                if flag == TranspositionTable.LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        best_value, best_action = -WIN_VALUE - 1, -1
+        for action in self._ordered_actions(tt_action):
+            value = self._try_action(action, player_number, depth, alpha, beta, ply)
+            if value > best_value:
+                best_value, best_action = value, action
+            if value > alpha:
+                alpha = value
+            if alpha >= beta:
+                self._history[action] += depth * depth
+                break
+
+        if best_value <= alpha_orig:
+            flag = TranspositionTable.UPPER
+        elif best_value >= beta:
+            flag = TranspositionTable.LOWER
+        else:
+            flag = TranspositionTable.EXACT
+        self.table.store(key, depth, self._value_to_table(best_value, ply), flag, best_action)
+        return best_value
+
+    @staticmethod
+    def _value_to_table(value, ply):
+        """
+        Convert the win/loss value from the root to the value from the stored position.
+        """
+        if is_win_value(value):
+            return value + ply if value > 0 else value - ply
+        return value
+
+    @staticmethod
+    def _value_from_table(value, ply):
+        """
+        Convert the stored win/loss value to the value from the root.
+        """
+        if is_win_value(value):
+            return value - ply if value > 0 else value + ply
+        return value
+
+    def _evaluate(self, player_number):
+        """
+        Static evaluation from the perspective of player_number.
+        Each line which is not blocked by the opponent is scored by the number of stones on it.
+        """
+        own = self._bitboard.stones[player_number]
+        opponent = self._bitboard.stones[-player_number]
+        weights = self._line_weights
+        score = 0
+        for mask in self._bitboard.line_masks:
+            own_stones = own & mask
+            opponent_stones = opponent & mask
+            if not opponent_stones:
+                if own_stones:
+                    score += weights[bin(own_stones).count("1")]
+            elif not own_stones:
+                score -= weights[bin(opponent_stones).count("1")]
+        return score
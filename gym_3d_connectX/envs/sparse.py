@@ -0,0 +1,537 @@
+import gym
+import numpy as np
+
+from gym_3d_connectX.envs.observation import ObservationBuilder
+from gym_3d_connectX.envs.rendering import make_figure
+from gym_3d_connectX.envs.utility import DIRECTIONS, UtilClass
+
+_OBS_MODES = ("dense", "coords", None)
+
+
+class SparseBoard:
+    """
+    Game engine for large and mostly empty boards, which stores only the occupied cells.
+
+    The stones are kept in a dict from the flat cell index to the player number, so the memory grows with
+    the number of moves instead of N^3. A win is detected by walking the 13 directions from the last placed
+    stone, which costs O(13 * num_win_seq) without the line table (whose size grows with N^3 as well).
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+    stones : dict[int, int]
+        The player number of each occupied cell, keyed by the flat index (height * num_grid + wide) * num_grid + depth,
+        in the order of the moves.
+    heights : list[int]
+        The number of stones in each pile, indexed by wide * num_grid + depth.
+    num_stones : int
+        The number of stones on the board.
+    """
+
+    def __init__(self, num_grid, num_win_seq):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        """
+        self.num_grid = num_grid
+        self.num_win_seq = num_win_seq
+        self.stones = {}
+        self.heights = []
+        self.num_stones = 0
+        self.reset()
+
+    @classmethod
+    def from_board(cls, board, num_win_seq):
+        """
+        Build the sparse board from a three-dimensional array.
+
+        Parameters
+        ----------
+        board : list[list[list[int]]] or ndarray
+            A three-dimensional array representing the current state.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+
+        Return
+        ------
+        sparse_board : SparseBoard
+            The sparse board holding the same stones as board. The order of the stones is the flat index order.
+        """
+        board = np.asarray(board)
+        sparse_board = cls(board.shape[0], num_win_seq)
+        flat_board = board.ravel()
+        cells = np.flatnonzero(flat_board)
+        sparse_board.stones = dict(zip(cells.tolist(), flat_board[cells].tolist()))
+        sparse_board.heights = np.count_nonzero(board, axis=0).ravel().tolist()
+        sparse_board.num_stones = len(cells)
+        return sparse_board
+
+    def copy(self):
+        """
+        Return
+        ------
+        sparse_board : SparseBoard
+            A new sparse board holding the same stones.
+        """
+        sparse_board = object.__new__(type(self))
+        sparse_board.__dict__.update(self.__dict__)
+        sparse_board.stones = dict(self.stones)
+        sparse_board.heights = list(self.heights)
+        return sparse_board
+
+    def reset(self):
+        """
+        Remove all the stones.
+        """
+        self.stones = {}
+        self.heights = [0] * (self.num_grid * self.num_grid)
+        self.num_stones = 0
+
+    def place(self, wide, depth, player_number):
+        """
+        Drop a stone into the pile.
+
+        Parameters
+        ----------
+        wide : int
+            The horizontal coordinates of the pile.
+        depth : int
+            The vertical coordinate of the pile.
+        player_number : int
+            The first player's number is 1, and the next is -1.
+
+        Return
+        ------
+        cell : int
+            The flat index of the placed stone, or -1 if the pile is full.
+        """
+        pile = wide * self.num_grid + depth
+        height = self.heights[pile]
+        if height >= self.num_grid:
+            return -1
+        cell = height * self.num_grid * self.num_grid + pile
+        self.stones[cell] = player_number
+        self.heights[pile] = height + 1
+        self.num_stones += 1
+        return cell
+
+    def undo(self, wide, depth):
+        """
+        Remove the top stone of the pile placed by place.
+
+        Parameters
+        ----------
+        wide : int
+            The horizontal coordinates of the pile.
+        depth : int
+            The vertical coordinate of the pile.
+        """
+        pile = wide * self.num_grid + depth
+        height = self.heights[pile] - 1
+        del self.stones[height * self.num_grid * self.num_grid + pile]
+        self.heights[pile] = height
+        self.num_stones -= 1
+
+    def is_win_at(self, cell, player_number):
+        """
+        Judges whether the player has completed a line passing through the cell.
+
+        Parameters
+        ----------
+        cell : int
+            The flat index of the last placed stone.
+        player_number : int
+            The player number of the last placed stone.
+
+        Return
+        ------
+        done : bool
+            The flag of whether the episode has finished or not.
+        """
+        num_grid, stones = self.num_grid, self.stones
+        height, rest = divmod(cell, num_grid * num_grid)
+        wide, depth = divmod(rest, num_grid)
+        for dh, dw, dd in DIRECTIONS:
+            # 置いた石から両方向へ、同じプレーヤーの石が途切れるまで数える
+            count = 1
+            for sign in (1, -1):
+                h, w, d = height + sign * dh, wide + sign * dw, depth + sign * dd
+                while (0 <= h < num_grid and 0 <= w < num_grid and 0 <= d < num_grid
+                       and stones.get((h * num_grid + w) * num_grid + d) == player_number):
+                    count += 1
+                    h, w, d = h + sign * dh, w + sign * dw, d + sign * dd
+            if count >= self.num_win_seq:
+                return True
+        return False
+
+    def is_done(self):
+        """
+        Judges whether either player has completed a line, walking from every stone on the board.
+
+        Return
+        ------
+        done : bool
+            The flag of whether the episode has finished or not.
+        """
+        return any(self.is_win_at(cell, player_number) for cell, player_number in self.stones.items())
+
+    def to_dense(self, dtype=np.int8):
+        """
+        Return
+        ------
+        board : ndarray
+            A new (N, N, N) array of the stones, indexed by [height][wide][depth].
+        """
+        board = np.zeros(self.num_grid ** 3, dtype=dtype)
+        if self.stones:
+            board[np.fromiter(self.stones.keys(), dtype=np.intp, count=self.num_stones)] = \
+                np.fromiter(self.stones.values(), dtype=np.int8, count=self.num_stones)
+        return board.reshape((self.num_grid,) * 3)
+
+    def coordinates(self):
+        """
+        Return
+        ------
+        coordinates : ndarray
+            A (num_stones, 4) int32 array of (height, wide, depth, player number) of the stones in the order of
+            the moves.
+        """
+        coordinates = np.empty((self.num_stones, 4), dtype=np.int32)
+        cells = np.fromiter(self.stones.keys(), dtype=np.int32, count=self.num_stones)
+        coordinates[:, 0], rest = np.divmod(cells, self.num_grid * self.num_grid)
+        coordinates[:, 1], coordinates[:, 2] = np.divmod(rest, self.num_grid)
+        coordinates[:, 3] = np.fromiter(self.stones.values(), dtype=np.int32, count=self.num_stones)
+        return coordinates
+
+
+class CoordinateSpace(gym.Space):
+    """
+    The space of the variable-length coordinate lists returned by SparseAnyNumberInARow3dEnv with obs_mode="coords",
+    i.e. (num_stones, 4) int32 arrays of (height, wide, depth, player number) with 0 <= num_stones <= N^3.
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    """
+
+    def __init__(self, num_grid):
+        """
+        Parameter
+        ---------
+        num_grid : int
+            Length of a side.
+        """
+        self.num_grid = num_grid
+        super().__init__(None, np.int32)
+
+    def sample(self, mask=None):
+        """
+        Return
+        ------
+        coordinates : ndarray
+            A coordinate list of random length, cells and player numbers. The cells may repeat.
+        """
+        # np_random は gym の版によって Generator か RandomState なので、両方にある random だけを使う
+        num_stones = int(self.np_random.random() * (self.num_grid ** 3 + 1))
+        coordinates = np.empty((num_stones, 4), dtype=np.int32)
+        coordinates[:, :3] = self.np_random.random((num_stones, 3)) * self.num_grid
+        coordinates[:, 3] = np.where(self.np_random.random(num_stones) < 0.5, 1, -1)
+        return coordinates
+
+    def contains(self, x):
+        """
+        Parameter
+        ---------
+        x : ndarray
+            The candidate coordinate list.
+
+        Return
+        ------
+        contains : bool
+            Whether x is a (num_stones, 4) integer array of cells on the board and player numbers 1 or -1.
+        """
+        if not isinstance(x, np.ndarray) or x.ndim != 2 or x.shape[1] != 4 or x.shape[0] > self.num_grid ** 3:
+            return False
+        if not np.issubdtype(x.dtype, np.integer):
+            return False
+        return bool(((x[:, :3] >= 0) & (x[:, :3] < self.num_grid)).all() and (np.abs(x[:, 3]) == 1).all())
+
+    def __repr__(self):
+        return f"CoordinateSpace({self.num_grid})"
+
+    def __eq__(self, other):
+        return isinstance(other, CoordinateSpace) and other.num_grid == self.num_grid
+
+
+class SparseAnyNumberInARow3dEnv(gym.Env):
+    """
+    "Any Number in a Row" environment for large and mostly empty boards (e.g. num_grid=32).
+
+    The rules and the rewards are the same as AnyNumberInARow3dEnv, but the stones are kept in a SparseBoard,
+    so neither the N^3 board nor the line table is allocated, and a step costs O(13 * num_win_seq)
+    plus the observation. The observations are built only when asked for: obs_mode selects what step and reset
+    return, and observation builds either kind on demand.
+
+    Attributes
+    ----------
+    num_grid : int
+        The number of intersections in a board.
+    step_number : int
+        The number of current turns.
+    sparse_board : SparseBoard
+        The stones on the board.
+    obs_mode : str or None
+        What step and reset return as the observation ("dense", "coords" or None).
+    action_space : gym.spaces
+        Define an NxN discrete action space.
+    observation_space : gym.spaces
+        The space of the dense observation, or a CoordinateSpace of the coordinate list.
+    player : int
+        Define which is the first player.
+    utils : UtilClass
+        Utility class implemented in utility.py.
+    obs_builder : ObservationBuilder
+        Build the dense observations.
+    """
+
+    def __init__(self, num_grid=32, num_win_seq=5, win_reward=10, draw_penalty=5, lose_penalty=10,
+                 could_locate_reward=0.1, couldnt_locate_penalty=0.1, time_penalty=0.1, first_player=1,
+                 obs_mode="coords", obs_backend="numpy", obs_dtype="int8", obs_perspective=False):
+        """
+        Parameters
+        ----------
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        win_reward : float
+            The reward agent gets when win the game.
+        draw_penalty : float
+            The penalty agent gets when it draw the game.
+        lose_penalty : float
+            The penalty agent gets when it lose the game.
+        could_locate_reward : float
+            The additional reward for agent being able to put the stone.
+        couldnt_locate_penalty : float
+            The penalty agent gets when it choose the location where the stone cannot be placed.
+        time_penalty : float
+            The penalty agents gets along with timesteps.
+        first_player : int
+            Define which is the first player.
+        obs_mode : str or None
+            "dense" returns the (N, N, N) observation built by ObservationBuilder,
+            "coords" returns the coordinate list of the stones (see observation),
+            None returns None and leaves the observations to observation.
+        obs_backend : str
+            "torch" or "numpy", for the dense observations.
+        obs_dtype : str
+            "int8", "float32" or "onehot", for the dense observations.
+        obs_perspective : bool
+            If true, the observations are from the perspective of the player to move.
+        """
+        super().__init__()
+
+        if obs_mode not in _OBS_MODES:
+            raise ValueError(f"obs_mode must be 'dense', 'coords' or None, but got {obs_mode!r}")
+        self.obs_mode = obs_mode
+        self.num_grid = num_grid
+        self.step_number = 0
+        self.sparse_board = SparseBoard(num_grid, num_win_seq)
+
+        self.action_space = gym.spaces.Discrete(self.num_grid * self.num_grid)
+        self.obs_builder = ObservationBuilder(num_grid, backend=obs_backend, dtype=obs_dtype,
+                                              perspective=obs_perspective)
+        if obs_mode == "coords":
+            self.observation_space = CoordinateSpace(num_grid)
+        else:
+            self.observation_space = self.obs_builder.observation_space()
+
+        self.player = first_player
+
+        self.utils = UtilClass(
+            num_grid=num_grid,
+            num_win_seq=num_win_seq,
+            win_reward=win_reward,
+            draw_penalty=draw_penalty,
+            lose_penalty=lose_penalty,
+            could_locate_reward=could_locate_reward,
+            couldnt_locate_penalty=couldnt_locate_penalty,
+            time_penalty=time_penalty
+        )
+
+        self.reset()
+
+    @property
+    def board(self):
+        """
+        The dense (N, N, N) int8 board built from the sparse board on each access.
+        """
+        return self.sparse_board.to_dense()
+
+    @property
+    def num_stones(self):
+        """
+        The number of stones on the board.
+        """
+        return self.sparse_board.num_stones
+
+    @property
+    def moves(self):
+        """
+        The moves of the episode.
+
+        Return
+        ------
+        moves : ndarray
+            A (num_stones, 2) int16 array of (action, player) of the moves which placed a stone.
+        """
+        coordinates = self.sparse_board.coordinates()
+        return np.stack([coordinates[:, 1] * self.num_grid + coordinates[:, 2], coordinates[:, 3]],
+                        axis=1).astype(np.int16)
+
+    def observation(self, mode="dense"):
+        """
+        Build the observation of the current state.
+
+        Parameter
+        ---------
+        mode : str
+            "dense" or "coords".
+
+        Return
+        ------
+        obs : torch.Tensor or ndarray
+            The dense observation built by ObservationBuilder, or a (num_stones, 4) int32 array of
+            (height, wide, depth, player number) of the stones in the order of the moves.
+            With obs_perspective, the player numbers of the coordinates are from the perspective of the player
+            to move as well.
+        """
+        if mode == "dense":
+            return self.obs_builder.build(self.sparse_board.to_dense(), self.player)
+        if mode == "coords":
+            coordinates = self.sparse_board.coordinates()
+            if self.obs_builder.perspective:
+                coordinates[:, 3] *= self.player
+            return coordinates
+        raise ValueError(f"mode must be 'dense' or 'coords', but got {mode!r}")
+
+    def reset(self):
+        """
+        Reset the board to the initial state.
+
+        Returns
+        -------
+        reset : torch.Tensor, ndarray or None
+            The observation of the empty board according to obs_mode.
+        """
+        self.step_number = 0
+        self.sparse_board.reset()
+        return None if self.obs_mode is None else self.observation(self.obs_mode)
+
+    def step(self, action):
+        """
+        OpenAI gym style step function
+
+        Receive the action and make transition.
+
+        Parameter
+        ---------
+        action : int
+            Elected aciton number (range from 0 to self.num_grid**2).
+
+        Returns
+        -------
+        obs : torch.Tensor, ndarray or None
+            The observation agents get after the transition according to obs_mode.
+        reward : float
+            The total reward agents get through the transition.
+        done : bool
+            The flag of whether the episode has finished or not.
+        info : dict
+            A dictionary containing the following information.
+            "turn", "winner", "is_couldnt_locate" and "action_mask" (the N x N legal action mask
+            for the next move).
+        """
+        W, D = self.utils.decode_action(action)
+
+        cell = self.sparse_board.place(W, D, self.player)
+        is_couldnt_locate = cell < 0
+        if is_couldnt_locate:
+            fixment_reward = -self.utils.couldnt_locate_penalty
+            is_done = False
+        else:
+            fixment_reward = self.utils.could_locate_reward
+            # 置いた石を通る直線だけを、盤面を作らずに調べる
+            is_done = self.sparse_board.is_win_at(cell, self.player)
+        done, reward, winner = self.utils.resolve_winning(is_done, self.player, None,
+                                                          num_stones=self.sparse_board.num_stones)
+
+        info = {"turn": self.player, "winner": winner, "is_couldnt_locate": is_couldnt_locate}
+
+        # プレーヤーの交代(置けない場所に置いていた場合は、プレーヤーは交代しない)
+        if not is_couldnt_locate:
+            self.step_number += 1
+            self.player *= -1
+
+        info["action_mask"] = self.action_mask()
+
+        obs = None if self.obs_mode is None else self.observation(self.obs_mode)
+        return obs, reward + fixment_reward, done, info
+
+    def clone(self):
+        """
+        Return
+        ------
+        env : SparseAnyNumberInARow3dEnv
+            A copy of the environment sharing the utils and the spaces.
+        """
+        env = object.__new__(type(self))
+        env.__dict__.update(self.__dict__)
+        env.sparse_board = self.sparse_board.copy()
+        return env
+
+    def action_mask(self):
+        """
+        Return the mask of the actions which can place a stone.
+
+        Return
+        ------
+        action_mask : ndarray
+            An N x N boolean array indexed by [wide][depth], which is true for the piles that are not full.
+        """
+        return (np.array(self.sparse_board.heights) < self.num_grid).reshape(self.num_grid, self.num_grid)
+
+    def legal_actions(self):
+        """
+        Return the actions which can place a stone.
+
+        Return
+        ------
+        legal_actions : ndarray
+            The action numbers of the piles that are not full.
+        """
+        return np.flatnonzero(np.array(self.sparse_board.heights) < self.num_grid)
+
+    def render(self, mode="print"):
+        """
+        The function to draw the observation result of one step according to mode.
+
+        Parameters
+        ----------
+        mode : str
+            "print" prints the coordinates of the stones, "plot" shows the 3D plot of the dense board.
+        """
+        if mode == "print":
+            for height, wide, depth, player_number in self.sparse_board.coordinates().tolist():
+                print(f"{height}F ({wide}, {depth}): {player_number}")
+
+        elif mode == "plot":
+            make_figure(self.board).show()
@@ -0,0 +1,353 @@
+import multiprocessing
+import multiprocessing.connection
+import traceback
+
+import gym
+import numpy as np
+
+from gym_3d_connectX.envs.observation import ObservationBuilder
+from gym_3d_connectX.envs.vector_env import VectorAnyNumberInARow3dEnv
+
+# プロセス間で共有する配列の名前と型。観測以外は (B,) の配列。
+_SHARED_FIELDS = [
+    ("actions", np.int64),
+    ("rewards", np.float64),
+    ("dones", np.bool_),
+    ("turn", np.int8),
+    ("winner", np.int8),
+    ("players", np.int8),
+    ("is_couldnt_locate", np.bool_),
+]
+
+
+def _as_numpy(shared_arrays, num_envs, num_grid):
+    """
+    Wrap the shared memory blocks with ndarrays without copying.
+
+    Parameters
+    ----------
+    shared_arrays : dict[str, multiprocessing.RawArray]
+        The shared memory blocks.
+    num_envs : int
+        The number of games held in all the workers.
+    num_grid : int
+        Length of a side.
+
+    Return
+    ------
+    arrays : dict[str, ndarray]
+        The ndarray views of the shared memory blocks.
+    """
+    board_shape = (num_envs, num_grid, num_grid, num_grid)
+    arrays = {name: np.frombuffer(shared_arrays[name], dtype=dtype) for name, dtype in _SHARED_FIELDS}
+    arrays["boards"] = np.frombuffer(shared_arrays["boards"], dtype=np.int8).reshape(board_shape)
+    arrays["terminal_boards"] = np.frombuffer(shared_arrays["terminal_boards"], dtype=np.int8).reshape(board_shape)
+    arrays["legal_masks"] = np.frombuffer(shared_arrays["legal_masks"], dtype=np.bool_).reshape(board_shape[:3])
+    return arrays
+
+
+def _worker(conn, start, stop, shared_arrays, num_envs, env_kwargs):
+    """
+    The main loop of a worker process, which owns the games [start, stop).
+    Commands are received through the pipe, and the results are written to the shared memory.
+    An exception is sent back as ("error", traceback) instead of the reply, and raised in the parent.
+    """
+    try:
+        arrays = _as_numpy(shared_arrays, num_envs, env_kwargs.get("num_grid", 4))
+        # ワーカー内の盤面は共有メモリ上に直接置き、観測は盤面のビューとしてコピーをなくす
+        env = VectorAnyNumberInARow3dEnv(stop - start, obs_backend="numpy", obs_dtype="int8", **env_kwargs)
+        env.boards = arrays["boards"][start:stop]
+        env.reset()
+        arrays["players"][start:stop] = env.players
+        arrays["legal_masks"][start:stop] = env.legal_masks
+    except Exception:
+        # 初期化に失敗した場合は、親が最初の返事を待つときに例外を受け取る
+        conn.send(("error", traceback.format_exc()))
+        conn.close()
+        return
+    conn.send(True)
+    try:
+        while True:
+            command = conn.recv()
+            if command == "close":
+                break
+            try:
+                _run_command(command, env, arrays, start, stop)
+            except Exception:
+                conn.send(("error", traceback.format_exc()))
+            else:
+                conn.send(True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+
+
+def _run_command(command, env, arrays, start, stop):
+    """
+    Run a command of the parent on the games [start, stop) of the worker.
+    """
+    if command == "step":
+        # 終了したゲームは step 内で初期化されるので、最終盤面は terminal_boards に書き出す
+        _, rewards, dones, info = env.step(arrays["actions"][start:stop])
+        arrays["rewards"][start:stop] = rewards
+        arrays["dones"][start:stop] = dones
+        for name in ["turn", "winner", "is_couldnt_locate"]:
+            arrays[name][start:stop] = info[name]
+        if dones.any():
+            arrays["terminal_boards"][start:stop][dones] = info["terminal_observation"]
+    elif command == "reset":
+        env.reset()
+    else:
+        raise ValueError(f"unknown command {command!r}")
+    arrays["players"][start:stop] = env.players
+    arrays["legal_masks"][start:stop] = env.legal_masks
+
+
+class SubprocVectorAnyNumberInARow3dEnv(gym.vector.VectorEnv):
+    """
+    The process-parallel version of VectorAnyNumberInARow3dEnv for "3d-connectX-v0".
+
+    The games are split among K worker processes, each of which steps its slice with
+    VectorAnyNumberInARow3dEnv. Actions, boards, rewards and flags are exchanged through shared memory,
+    and only short commands go through the pipes.
+    The games can be stepped synchronously with step, or asynchronously by step_async and step_any,
+    which returns the results of whichever workers are ready.
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    num_workers : int
+        The number of worker processes.
+    worker_slices : list[tuple[int, int]]
+        The range [start, stop) of the games owned by each worker.
+    obs_builder : ObservationBuilder
+        Build the batched observations from the shared boards.
+    """
+
+    def __init__(self, num_envs, num_workers=None, context=None, obs_backend="torch", obs_dtype="float32",
+                 obs_perspective=False, obs_reuse_buffer=False, **env_kwargs):
+        """
+        Parameters
+        ----------
+        num_envs : int
+            The number of games held in all the workers.
+        num_workers : int, optional
+            The number of worker processes. Defaults to min(num_envs, cpu_count).
+        context : str, optional
+            The start method of multiprocessing ("fork", "spawn" or "forkserver").
+        obs_backend : str
+            "torch" or "numpy". See AnyNumberInARow3dEnv.
+        obs_dtype : str
+            "int8", "float32" or "onehot". See AnyNumberInARow3dEnv.
+        obs_perspective : bool
+            Whether the observations are from the perspective of the player to move in each game.
+        obs_reuse_buffer : bool
+            Whether the observations of step and reset are written in place into one preallocated buffer.
+        env_kwargs : dict
+            The keyword arguments of VectorAnyNumberInARow3dEnv (num_grid, num_win_seq, rewards, ...).
+        """
+        num_grid = env_kwargs.get("num_grid", 4)
+        self.obs_builder = ObservationBuilder(num_grid, backend=obs_backend, dtype=obs_dtype,
+                                              perspective=obs_perspective, reuse_buffer=obs_reuse_buffer)
+        super().__init__(num_envs, self.obs_builder.observation_space(), gym.spaces.Discrete(num_grid * num_grid))
+        self.num_grid = num_grid
+        self.num_workers = min(num_envs, num_workers or multiprocessing.cpu_count())
+
+        ctx = multiprocessing.get_context(context)
+        shared_arrays = {name: ctx.RawArray(np.ctypeslib.as_ctypes_type(dtype), num_envs)
+                         for name, dtype in _SHARED_FIELDS}
+        for name in ["boards", "terminal_boards"]:
+            shared_arrays[name] = ctx.RawArray(np.ctypeslib.as_ctypes_type(np.int8), num_envs * num_grid ** 3)
+        shared_arrays["legal_masks"] = ctx.RawArray(np.ctypeslib.as_ctypes_type(np.bool_), num_envs * num_grid ** 2)
+        self._arrays = _as_numpy(shared_arrays, num_envs, num_grid)
+
+        bounds = np.linspace(0, num_envs, self.num_workers + 1).astype(int)
+        self.worker_slices = list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+        self._conns = []
+        self._processes = []
+        for start, stop in self.worker_slices:
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(child_conn, start, stop, shared_arrays, num_envs, env_kwargs),
+                                  daemon=True)
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._processes.append(process)
+        self._pending = set()
+
+        # 全てのワーカーの初期化を待つ (ワーカーは初期化の中でゲームを初期化している)
+        try:
+            self._wait(range(self.num_workers))
+        except BaseException:
+            # 起動したワーカーを残さないように止めてから送出し、close でもう一度止めないようにする
+            self._stop_workers()
+            self.closed = True
+            raise
+
+    def reset(self, **kwargs):
+        """
+        Reset all the boards to the initial state.
+
+        Returns
+        -------
+        reset : torch.Tensor or ndarray
+            The (B, N, N, N) initial board tensor filled with 0.
+        """
+        self._wait(self._pending)
+        for conn in self._conns:
+            conn.send("reset")
+        self._wait(range(self.num_workers))
+        # 共有メモリはワーカーに書き換えられるので、観測には盤面のコピーを渡す
+        return self.obs_builder.build(self._arrays["boards"].copy(), self._arrays["players"].copy())
+
+    def step(self, actions):
+        """
+        Step all the games synchronously.
+
+        Parameter
+        ---------
+        actions : array_like
+            A (B,) array of elected action numbers (range from 0 to self.num_grid**2).
+
+        Returns
+        -------
+        obs, rewards, dones, info
+            The same as VectorAnyNumberInARow3dEnv.step.
+        """
+        self.step_async(actions)
+        return self.step_wait()
+
+    def step_async(self, actions, worker_ids=None):
+        """
+        Send the actions to the workers without waiting for the results.
+
+        Parameters
+        ----------
+        actions : array_like
+            A (B,) array of elected action numbers. Only the games of the selected workers are read.
+        worker_ids : list[int], optional
+            The workers to be stepped. Defaults to all the workers which are not running.
+        """
+        if worker_ids is None:
+            worker_ids = [i for i in range(self.num_workers) if i not in self._pending]
+        actions = np.asarray(actions)
+        for worker_id in worker_ids:
+            if worker_id in self._pending:
+                raise RuntimeError(f"worker {worker_id} is still running the previous step")
+            # 実行中のワーカーが読んでいる範囲は書き換えない
+            start, stop = self.worker_slices[worker_id]
+            self._arrays["actions"][start:stop] = actions[start:stop]
+            self._conns[worker_id].send("step")
+            self._pending.add(worker_id)
+
+    def step_wait(self):
+        """
+        Wait for all the running workers and return the results of all the games.
+
+        Returns
+        -------
+        obs, rewards, dones, info
+            The same as VectorAnyNumberInARow3dEnv.step.
+        """
+        self._wait(list(self._pending))
+        return self._results(np.arange(self.num_envs))
+
+    def step_any(self, timeout=None):
+        """
+        Wait for whichever running workers are ready and return the results of their games.
+
+        Parameter
+        ---------
+        timeout : float, optional
+            The maximum number of seconds to wait. Defaults to waiting until a worker is ready.
+
+        Returns
+        -------
+        env_ids : ndarray
+            The game numbers of the returned results, which may be empty on timeout.
+        obs, rewards, dones, info
+            The same as VectorAnyNumberInARow3dEnv.step, restricted to env_ids.
+        """
+        if not self._pending:
+            raise RuntimeError("no worker is running; call step_async before step_any")
+        conns = {self._conns[worker_id]: worker_id for worker_id in self._pending}
+        ready = multiprocessing.connection.wait(list(conns), timeout=timeout)
+        worker_ids = sorted(conns[conn] for conn in ready)
+        self._wait(worker_ids)
+        env_ids = np.concatenate([np.arange(*self.worker_slices[worker_id]) for worker_id in worker_ids]
+                                 + [np.zeros(0, dtype=int)])
+        return (env_ids,) + self._results(env_ids)
+
+    def action_masks(self):
+        """
+        Return the masks of the actions which can place a stone.
+        The games of the running workers are not up to date until their results are received.
+
+        Return
+        ------
+        action_masks : ndarray
+            A (B, N, N) boolean array which is true for the piles that are not full.
+        """
+        return self._arrays["legal_masks"].copy()
+
+    def _wait(self, worker_ids):
+        """
+        Wait for the replies of the selected workers, and raise the first error sent by them.
+        """
+        errors = []
+        for worker_id in list(worker_ids):
+            reply = self._conns[worker_id].recv()
+            self._pending.discard(worker_id)
+            if isinstance(reply, tuple) and reply[0] == "error":
+                errors.append((worker_id, reply[1]))
+        # 全てのワーカーの返事を受け取ってから例外にして、パイプの送受信の対応を保つ
+        if errors:
+            worker_id, worker_traceback = errors[0]
+            raise RuntimeError(f"worker {worker_id} failed:\n{worker_traceback}")
+
+    def _results(self, env_ids):
+        """
+        Read the results of the selected games from the shared memory.
+        """
+        arrays = self._arrays
+        dones = arrays["dones"][env_ids]
+        info = {name: arrays[name][env_ids] for name in ["turn", "winner", "is_couldnt_locate"]}
+        info["action_mask"] = arrays["legal_masks"][env_ids]
+        # 終了したゲームは石を置いた直後に終わるので、次に打つのは石を置いたプレーヤーの相手
+        info["terminal_observation"] = self.obs_builder.build(arrays["terminal_boards"][env_ids[dones]],
+                                                              -info["turn"][dones], reuse_buffer=False)
+        obs = self.obs_builder.build(arrays["boards"][env_ids], arrays["players"][env_ids])
+        return obs, arrays["rewards"][env_ids], dones, info
+
+    def close_extras(self, **kwargs):
+        """
+        Stop all the worker processes.
+        """
+        try:
+            self._wait(list(self._pending))
+        except (RuntimeError, EOFError, OSError):
+            # 失敗したワーカーや終了したワーカーの返事は捨てて、停止に進む
+            self._pending.clear()
+        self._stop_workers()
+
+    def _stop_workers(self, timeout=1.0):
+        """
+        Ask the workers which are alive to stop, terminate the ones still running after the timeout,
+        and close the pipes.
+        """
+        for conn, process in zip(self._conns, self._processes):
+            if conn.closed or not process.is_alive():
+                continue
+            try:
+                conn.send("close")
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for conn in self._conns:
+            conn.close()
@@ -0,0 +1,243 @@
+import collections
+
+import numpy as np
+
+from gym_3d_connectX.envs.utility import get_zobrist_keys
+
+# 重力の向き(H軸)を保つ8つの対称変換 (W軸とD軸の入れ替え, W軸の反転, D軸の反転)。0番は恒等変換。
+SYMMETRIES = [(transpose, flip_wide, flip_depth)
+              for transpose in (False, True) for flip_wide in (False, True) for flip_depth in (False, True)]
+NUM_SYMMETRIES = len(SYMMETRIES)
+
+# 盤面の大きさごとに一度だけ作成し、共有する対称変換の表
+_SYMMETRY_TABLE_CACHE = {}
+
+SymmetryTable = collections.namedtuple("SymmetryTable", ["cells", "actions", "inverse"])
+
+
+def get_symmetry_table(num_grid):
+    """
+    Return the index tables of the 8 symmetries, shared among the same board size.
+
+    Parameter
+    ---------
+    num_grid : int
+        Length of a side.
+
+    Return
+    ------
+    symmetry_table : SymmetryTable
+        cells : ndarray
+            (8, num_grid ** 3) array. cells[s][i] is the flat cell index of the original board
+            which moves to the flat cell index i by the symmetry s.
+        actions : ndarray
+            (8, num_grid ** 2) array. actions[s][a] is the action number which corresponds to the action a
+            of the original board on the transformed board.
+        inverse : ndarray
+            (8,) array of the number of the inverse symmetry of each symmetry.
+    """
+    if num_grid not in _SYMMETRY_TABLE_CACHE:
+        _SYMMETRY_TABLE_CACHE[num_grid] = _build_symmetry_table(num_grid)
+    return _SYMMETRY_TABLE_CACHE[num_grid]
+
+
+def _build_symmetry_table(num_grid):
+    """
+    Build the SymmetryTable for the board size. See get_symmetry_table.
+    """
+    flat_cells = np.arange(num_grid ** 3).reshape(num_grid, num_grid, num_grid)
+    cells = np.stack([_transform(flat_cells, symmetry).ravel() for symmetry in range(NUM_SYMMETRIES)])
+    # 変換後の盤面で元の action の柱がある位置。cells の逆置換を最下段の柱について取る。
+    actions = np.argsort(cells[:, :num_grid * num_grid], axis=1)
+    identity = np.arange(num_grid ** 3)
+    inverse = np.array([next(other for other in range(NUM_SYMMETRIES)
+                             if (cells[symmetry][cells[other]] == identity).all())
+                        for symmetry in range(NUM_SYMMETRIES)])
+
+    for table in (cells, actions, inverse):
+        table.setflags(write=False)
+    return SymmetryTable(cells=cells, actions=actions, inverse=inverse)
+
+
+def _transform(array, symmetry):
+    """
+    Apply the symmetry to the last two axes (wide and depth) of the array.
+    """
+    transpose, flip_wide, flip_depth = SYMMETRIES[symmetry]
+    if transpose:
+        array = np.swapaxes(array, -1, -2)
+    if flip_wide:
+        array = array[..., ::-1, :]
+    if flip_depth:
+        array = array[..., ::-1]
+    return array
+
+
+def transform_board(board, symmetry):
+    """
+    Parameters
+    ----------
+    board : ndarray
+        A (..., N, N, N) array of one board or a batch of boards, indexed by [height][wide][depth].
+    symmetry : int
+        The number of the symmetry (0 to 7).
+
+    Return
+    ------
+    board : ndarray
+        A new array of the transformed boards.
+    """
+    board = np.asarray(board)
+    num_grid = board.shape[-1]
+    cells = get_symmetry_table(num_grid).cells[symmetry]
+    return board.reshape(board.shape[:-3] + (-1,))[..., cells].reshape(board.shape)
+
+
+def transform_action(action, symmetry, num_grid):
+    """
+    Parameters
+    ----------
+    action : int or ndarray
+        The action number(s) on the original board.
+    symmetry : int
+        The number of the symmetry (0 to 7).
+    num_grid : int
+        Length of a side.
+
+    Return
+    ------
+    action : int or ndarray
+        The action number(s) dropping a stone into the same pile on the transformed board.
+    """
+    return get_symmetry_table(num_grid).actions[symmetry][action]
+
+
+def transform_plane(plane, symmetry, num_grid=None):
+    """
+    Transform per-action values such as action masks or policy targets.
+
+    Parameters
+    ----------
+    plane : ndarray
+        A (..., N, N) array indexed by [wide][depth], or a (..., N * N) array indexed by the action number.
+    symmetry : int
+        The number of the symmetry (0 to 7).
+    num_grid : int, optional
+        Length of a side. If given, a last axis of length N * N means the action number, so a batch of
+        flat planes whose batch size happens to be N * N is not mistaken for one (N * N, N * N) plane.
+        Otherwise the layout is inferred from the shape, which is ambiguous for such batches.
+
+    Return
+    ------
+    plane : ndarray
+        A new array of the same shape whose values follow the actions of the transformed board.
+    """
+    plane = np.asarray(plane)
+    if num_grid is None:
+        is_flat = plane.ndim < 2 or plane.shape[-2] != plane.shape[-1]
+        num_grid = int(round(np.sqrt(plane.shape[-1]))) if is_flat else plane.shape[-1]
+    else:
+        is_flat = plane.shape[-1] == num_grid * num_grid and num_grid != 1
+    if not is_flat:
+        return np.ascontiguousarray(_transform(plane, symmetry))
+    # 最下段のマスの番号は action の番号と同じ
+    return plane[..., get_symmetry_table(num_grid).cells[symmetry][:num_grid * num_grid]]
+
+
+def all_symmetries(board):
+    """
+    Parameter
+    ---------
+    board : ndarray
+        A (..., N, N, N) array of one board or a batch of boards.
+
+    Return
+    ------
+    boards : ndarray
+        A (..., 8, N, N, N) array of the board under every symmetry, in the order of SYMMETRIES.
+    """
+    board = np.asarray(board)
+    num_grid = board.shape[-1]
+    cells = get_symmetry_table(num_grid).cells
+    flat_board = board.reshape(board.shape[:-3] + (-1,))
+    return flat_board[..., cells].reshape(board.shape[:-3] + (NUM_SYMMETRIES,) + board.shape[-3:])
+
+
+def augment(boards, actions=None, planes=None):
+    """
+    Multiply the training samples by 8 with the symmetries.
+
+    Parameters
+    ----------
+    boards : ndarray
+        A (B, N, N, N) array of boards.
+    actions : ndarray, optional
+        A (B,) array of the action numbers taken on the boards.
+    planes : ndarray, optional
+        A (B, N, N) or (B, N * N) array of per-action values such as policy targets.
+
+    Returns
+    -------
+    boards : ndarray
+        A (8 * B, N, N, N) array. The i-th symmetry of the b-th board is at i * B + b.
+    actions : ndarray
+        A (8 * B,) array of the transformed actions, if actions is given.
+    planes : ndarray
+        The (8 * B, ...) transformed planes, if planes is given.
+    """
+    boards = np.asarray(boards)
+    num_grid = boards.shape[-1]
+    results = [np.concatenate([transform_board(boards, symmetry) for symmetry in range(NUM_SYMMETRIES)])]
+    if actions is not None:
+        actions = np.asarray(actions)
+        results.append(get_symmetry_table(num_grid).actions[:, actions].reshape(-1))
+    if planes is not None:
+        results.append(np.concatenate([transform_plane(planes, symmetry, num_grid)
+                                       for symmetry in range(NUM_SYMMETRIES)]))
+    return results[0] if len(results) == 1 else tuple(results)
+
+
+def board_hash(board):
+    """
+    Compute the Zobrist hash of the boards with the keys of get_zobrist_keys.
+    It equals the hash NegamaxSolver uses when player 1 is to move.
+
+    Parameter
+    ---------
+    board : ndarray
+        A (..., N, N, N) array of one board or a batch of boards.
+
+    Return
+    ------
+    key : numpy.uint64 or ndarray
+        The hash of each board.
+    """
+    board = np.asarray(board)
+    keys = get_zobrist_keys(board.shape[-1])
+    flat_board = board.reshape(board.shape[:-3] + (-1,))
+    cell_keys = np.where(flat_board == 1, keys[0], np.where(flat_board == -1, keys[1], np.uint64(0)))
+    return np.bitwise_xor.reduce(cell_keys, axis=-1)
+
+
+def canonical_hash(board, return_symmetry=False):
+    """
+    Compute the hash shared by all the symmetric positions, the minimum of board_hash over the 8 symmetries.
+
+    Parameters
+    ----------
+    board : ndarray
+        A (..., N, N, N) array of one board or a batch of boards.
+    return_symmetry : bool
+        If true, also return the symmetry which gives the canonical hash.
+
+    Returns
+    -------
+    key : numpy.uint64 or ndarray
+        The canonical hash of each board.
+    symmetry : int or ndarray
+        The number of the symmetry which maps the board to its canonical form, if return_symmetry is true.
+    """
+    keys = board_hash(all_symmetries(board))
+    symmetry = keys.argmin(axis=-1)
+    key = np.take_along_axis(keys, np.expand_dims(symmetry, -1), axis=-1)[..., 0]
+    return (key, symmetry) if return_symmetry else key
@@ -1,10 +1,17 @@
+import collections
 import copy
+
 import gym
-import torch
-import pandas as pd
-import plotly.express as px
+import numpy as np
+
+from gym_3d_connectX.envs.bitboard import BitBoard
+from gym_3d_connectX.envs.features import FeatureExtractor
+from gym_3d_connectX.envs.observation import ObservationBuilder
+from gym_3d_connectX.envs.profiling import StepProfiler
+from gym_3d_connectX.envs.rendering import make_figure
+from gym_3d_connectX.envs.utility import UtilClass, iter_boards
 
-from gym_3d_connectX.envs.utility import UtilClass
+EnvState = collections.namedtuple("EnvState", ["board", "player", "step_number", "history_length"])
 
 
 class AnyNumberInARow3dEnv(gym.Env):
@@ -27,22 +34,54 @@ class AnyNumberInARow3dEnv(gym.Env):
         The number of intersections in a board.
     step_number : int
         The number of current turns.
-    obs_history : list[list[list[list[int]]]]
-        An array containing the observations of one episode.
-    board : list[list[list[int]]]
-        A three-dimensional array representing the current state.
+    obs_history : list[ndarray]
+        An array containing the observations of one episode, rebuilt from move_history on each access.
+        Assigning [] clears the recorded moves.
+    record_history : bool
+        Whether the moves of the episode are recorded.
+    move_history : ndarray or None
+        A (N^3, 2) int16 array of (action, player) of the moves which placed a stone,
+        of which the first num_moves rows are valid. None unless record_history.
+    first_player : int
+        The player who moves first in the current episode, set at reset and at the first recorded move.
+    num_moves : int
+        The number of the recorded moves.
+    recorder : EpisodeRecorder or None
+        The recorder to which the finished games are streamed.
+    board : ndarray
+        A three-dimensional int8 array representing the current state, indexed by [height][wide][depth].
+    heights : ndarray
+        An N x N array of the number of stones in each pile.
+    num_stones : int
+        The number of stones on the board.
+    legal_mask : ndarray
+        An N x N boolean array which is true for the piles that are not full.
     action_space : gym.spaces
         Define an NxN discrete action space.
     observation_space : gym.spaces
-        Define an N x N x N discrete space with three values (-1, 0, 1).
+        Define an N x N x N discrete space with three values (-1, 0, 1),
+        or a 2 x N x N x N space of the one-hot observation.
     player : int
         Define which is the first player.
     utils : UtilClass
         Utility class implemented in utility.py.
+    win_check : str
+        How to judge the end of the game ("incremental" or "full").
+    backend : str
+        The game engine used to judge the end of the game ("numpy" or "bitboard").
+    bitboard : BitBoard or None
+        The bitboard holding the same stones as board when backend is "bitboard".
+    obs_builder : ObservationBuilder
+        Build the observations from board.
+    profiler : StepProfiler or None
+        The time and the number of calls of each phase of step, reset and render, if profiling is enabled.
     """
 
     def __init__(self, num_grid=4, num_win_seq=4, win_reward=10, draw_penalty=5, lose_penalty=10,
-                 could_locate_reward=0.1, couldnt_locate_penalty=0.1, time_penalty=0.1, first_player=1):
+                 could_locate_reward=0.1, couldnt_locate_penalty=0.1, time_penalty=0.1, first_player=1,
+                 win_check="incremental", backend="numpy", obs_backend="torch", obs_dtype="float32",
+                 obs_perspective=False, obs_reuse_buffer=False, record_history=False, recorder=None,
+                 profile=False, profile_callback=None):
         """
         Parameters
         ----------
@@ -64,18 +103,66 @@ class AnyNumberInARow3dEnv(gym.Env):
             The penalty agents gets along with timesteps.
         first_player : int
             Define which is the first player.
+        win_check : str
+            "incremental" checks only the lines passing through the last placed stone,
+            "full" scans the whole board after every step. Both give the same result.
+        backend : str
+            "numpy" judges the end of the game with UtilClass on the board array,
+            "bitboard" keeps each player's stones as bitmasks and judges it with the precomputed line masks.
+            Both give the same result.
+        obs_backend : str
+            "torch" returns the observations as torch.Tensor, "numpy" returns them as ndarray.
+        obs_dtype : str
+            "int8", "float32" or "onehot" (two float32 planes of "own" and "opponent" stones).
+            With obs_backend="numpy", obs_dtype="int8" and obs_perspective=False,
+            the observation is a read-only view of board without any copy.
+        obs_perspective : bool
+            If true, the observations are from the perspective of the player to move,
+            i.e. the stones of the player to move are 1 and the opponent's stones are -1.
+        obs_reuse_buffer : bool
+            If true, the observations are written in place into one preallocated buffer
+            instead of allocating a new one at every step.
+        record_history : bool
+            If true, the moves of the episode are recorded as (action, player) pairs,
+            from which obs_history and animation rebuild the boards.
+        recorder : EpisodeRecorder, optional
+            If given, every finished game is streamed to it. This turns record_history on.
+        profile : bool
+            If true, the time and the number of calls of each phase of step ("decode", "placing", "win_check",
+            "history" and "observation"), reset and render are recorded. See profile_stats.
+        profile_callback : callable, optional
+            Called with (phase, seconds) at the end of every phase. This turns profile on.
         """
         super().__init__()
 
+        if win_check not in ("incremental", "full"):
+            raise ValueError(f"win_check must be 'incremental' or 'full', but got {win_check!r}")
+        self.win_check = win_check
+        if backend not in ("numpy", "bitboard"):
+            raise ValueError(f"backend must be 'numpy' or 'bitboard', but got {backend!r}")
+        self.backend = backend
+        self.bitboard = BitBoard(num_grid, num_win_seq) if backend == "bitboard" else None
+
         self.num_grid = num_grid
         self.step_number = 0
-        self.obs_history = []
-        self.board = []
+        # 計測しない場合の負荷は、各段階の終わりの None との比較だけ
+        self.profiler = StepProfiler(profile_callback) if profile or profile_callback is not None else None
+        self.recorder = recorder
+        self.record_history = record_history or recorder is not None
+        # 記録しない場合は配列を確保しない
+        self.move_history = np.zeros((num_grid ** 3, 2), dtype=np.int16) if self.record_history else None
+        self.num_moves = 0
+        self.board = None
+        self.heights = None
+        self.num_stones = 0
+        self.legal_mask = None
 
         # 重力がある設定（高さ方向は石を置く位置を指定できない）ので、N×Nの離散空間。
         self.action_space = gym.spaces.Discrete(self.num_grid * self.num_grid)
         # 自分の色の石が置かれている状態、石の置かれていない状態、相手プレイヤーの石が置かれている状態の3つをそれぞれ-1,0,1の値で表す。
-        self.observation_space = gym.spaces.Box(low=-1, high=1, shape=(self.num_grid, self.num_grid, self.num_grid))
+        self.obs_builder = ObservationBuilder(num_grid, backend=obs_backend, dtype=obs_dtype,
+                                              perspective=obs_perspective, reuse_buffer=obs_reuse_buffer)
+        self.observation_space = self.obs_builder.observation_space()
 
         self.player = first_player
 
@@ -100,13 +187,26 @@ class AnyNumberInARow3dEnv(gym.Env):
 
         Returns
         -------
-        reset : torch.Tensor
+        reset : torch.Tensor or ndarray
             The initial board tensor filled with 0 (0 means empty, 1 or -1 means the stone is put).
         """
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
         self.step_number = 0
-        self.obs_history = []
-        self.board = [[[0] * self.num_grid for _ in range(self.num_grid)] for _ in range(self.num_grid)]
-        return torch.tensor(self.board).float()
+        self.num_moves = 0
+        # reset は手番を戻さないので、このエピソードの先手をここで覚えておく
+        self.first_player = self.player
+        self.board = np.zeros((self.num_grid, self.num_grid, self.num_grid), dtype=np.int8)
+        self.heights = np.zeros((self.num_grid, self.num_grid), dtype=np.intp)
+        self.num_stones = 0
+        self.legal_mask = np.ones((self.num_grid, self.num_grid), dtype=bool)
+        if self.bitboard is not None:
+            self.bitboard.reset()
+        obs = self.obs_builder.build(self.board, self.player)
+        if profiler is not None:
+            profiler.lap("reset")
+        return obs
 
     def step(self, action):
         """
@@ -121,7 +221,7 @@ class AnyNumberInARow3dEnv(gym.Env):
 
         Returns
         -------
-        obs : torch.Tensor
+        obs : torch.Tensor or ndarray
             The observation agents get after the transition.
         reward : float
             The total reward agents get through the transition.
@@ -129,43 +229,234 @@ class AnyNumberInARow3dEnv(gym.Env):
             The flag of whether the episode has finished or not.
         info : dict
             A dictionary containing the following information.
+            "turn", "winner", "is_couldnt_locate" and "action_mask" (the N x N legal action mask
+            for the next move).
         """
-        # 1~self.num_grid**2 の数値で表される action を、「升目のどの位置か」と言う情報に変換
-        action = self.utils.base_change(action, self.num_grid).zfill(2)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
 
-        # 上記変換後、 action は縦横何マス目かを表す2文字の文字列（ex. '13'なら横2マス目、縦4マス目）になっているので、
-        # それぞれの次元について位置を整数型にして取得。
-        W = int(action[0])
-        D = int(action[1])
+        # 0~self.num_grid**2-1 の数値で表される action を、「升目のどの位置か」と言う情報に変換
+        W, D = self.utils.decode_action(action)
+        if profiler is not None:
+            profiler.lap("decode")
 
         # 石の配置のダイナミクスを司る部分。石を配置し、次状態を返す。また、石を置ける場所を選択したかどうかに基づいて、追加情報（及び調整報酬）を返す。
         fixment_reward, self.board, is_couldnt_locate = self.utils.resolve_placing(
             wide=W,
             depth=D,
             player_number=self.player,
-            board=self.board
-        )
-
-        # 現在のボードの状態から、ゲーム終了判定をし、（もし終了している場合）試合結果に応じた報酬および勝者情報を返す。
-        done, reward, winner = self.utils.is_game_end(
-            player_number=self.player,
-            board=self.board
+            board=self.board,
+            heights=self.heights
         )
+        if not is_couldnt_locate:
+            self.num_stones += 1
+            # 柱が満杯になったら、その柱は選べなくなる
+            if self.heights[W, D] == self.num_grid:
+                self.legal_mask[W, D] = False
+        if profiler is not None:
+            profiler.lap("placing")
+
+        # 石を置けた場合は、置いた石を通る直線だけを調べれば終了判定ができる。
+        position = None
+        if self.win_check == "incremental" and not is_couldnt_locate:
+            position = self.utils.last_position
+
+        if self.bitboard is not None:
+            # ビットボードにも同じ石を置き、ラインのビットマスクとの比較で終了判定をする。
+            if not is_couldnt_locate:
+                self.bitboard.place(W, D, self.player)
+            if position is None:
+                is_done = self.bitboard.is_done()
+            else:
+                height, wide, depth = position
+                is_done = self.bitboard.is_win_at((height * self.num_grid + wide) * self.num_grid + depth, self.player)
+            done, reward, winner = self.utils.resolve_winning(is_done, self.player, self.board,
+                                                              num_stones=self.num_stones)
+        else:
+            # 現在のボードの状態から、ゲーム終了判定をし、（もし終了している場合）試合結果に応じた報酬および勝者情報を返す。
+            done, reward, winner = self.utils.is_game_end(
+                player_number=self.player,
+                board=self.board,
+                position=position,
+                num_stones=self.num_stones
+            )
+        if profiler is not None:
+            profiler.lap("win_check")
 
         # このステップがどちらのプレーヤーによってなされたか、勝者はどちらか、このステップでプレーヤーは石の置ける場所を選択したか、の3つの情報を格納した辞書。
         info = {"turn": self.player, "winner": winner, "is_couldnt_locate": is_couldnt_locate}
 
         # プレーヤーの交代(置けない場所に置いていた場合は、プレーヤーは交代しない)
         if not is_couldnt_locate:
-            # 両方のプレイヤーが一度置いてから格納する.(プレイヤーが表示されないバグが発生するため)
-            if self.step_number > 0:
-                # 参照渡しだと格納したデータが更新されてしまうため, アドレスを変更させる.
-                self.obs_history.append(copy.deepcopy(self.board))
+            # 盤面ではなく (action, player) だけを記録し、盤面は必要な時に再構成する
+            if self.record_history:
+                if self.num_moves == 0:
+                    # reset の後に手番を入れ替える呼び出し側もあるので、最初の手で先手を確定する
+                    self.first_player = self.player
+                self.move_history[self.num_moves] = (action, self.player)
+                self.num_moves += 1
             self.step_number += 1
 
             self.player *= -1
 
-        return torch.tensor(self.board).float(), reward + fixment_reward, done, info
+        info["action_mask"] = self.legal_mask.copy()
+
+        if done and self.recorder is not None:
+            self.recorder.record(self.moves[:, 0], self.first_player, winner, self.utils)
+        if profiler is not None:
+            profiler.lap("history")
+
+        obs = self.obs_builder.build(self.board, self.player)
+        if profiler is not None:
+            profiler.lap("observation")
+        return obs, reward + fixment_reward, done, info
+
+    @property
+    def moves(self):
+        """
+        The recorded moves of the episode.
+
+        Return
+        ------
+        moves : ndarray
+            A (num_moves, 2) view of (action, player) of the moves which placed a stone,
+            empty unless record_history.
+        """
+        if self.move_history is None:
+            return np.zeros((0, 2), dtype=np.int16)
+        return self.move_history[:self.num_moves]
+
+    @property
+    def obs_history(self):
+        """
+        The boards of the episode, rebuilt from the recorded moves.
+        As before, the boards are the ones after the second and later moves.
+
+        Return
+        ------
+        obs_history : list[ndarray]
+            The list of three-dimensional int8 arrays.
+        """
+        return list(iter_boards(self.moves, self.num_grid))[1:]
+
+    @obs_history.setter
+    def obs_history(self, obs_history):
+        """
+        Clear the recorded moves, for the callers which reset the history with env.obs_history = [].
+        The boards cannot be turned back into moves, so only an empty history can be assigned.
+        While a recorder is attached, the history can only be cleared before the first move of the episode,
+        since the recorder needs all the moves of the episode.
+
+        Parameter
+        ---------
+        obs_history : list
+            An empty list.
+        """
+        if len(obs_history) != 0:
+            raise ValueError("obs_history is rebuilt from the recorded moves and can only be cleared with []")
+        if self.recorder is not None and self.num_moves:
+            raise ValueError("the moves of the episode cannot be cleared while a recorder is attached")
+        self.num_moves = 0
+
+    def get_state(self):
+        """
+        Take a snapshot of the game state.
+
+        Return
+        ------
+        state : EnvState
+            An immutable snapshot holding the board as bytes, the player to move, the number of turns
+            and the number of the recorded moves.
+        """
+        return EnvState(self.board.tobytes(), self.player, self.step_number, self.num_moves)
+
+    def set_state(self, state):
+        """
+        Restore the game state taken by get_state in O(size of board) without any deep copy.
+        The move history is truncated to the length at the snapshot, so it is restored correctly
+        when the snapshot was taken earlier in the same episode.
+
+        Parameter
+        ---------
+        state : EnvState
+            The snapshot returned by get_state.
+        """
+        self.board[...] = np.frombuffer(state.board, dtype=np.int8).reshape(self.board.shape)
+        # 石は下から詰めて置かれるので、各柱の石の数がそのまま高さになる
+        self.heights[...] = np.count_nonzero(self.board, axis=0)
+        self.num_stones = int(self.heights.sum())
+        self.legal_mask[...] = self.heights < self.num_grid
+        self.player = state.player
+        self.step_number = state.step_number
+        self.num_moves = state.history_length
+        if self.bitboard is not None:
+            self.bitboard = BitBoard.from_board(self.board, self.utils.num_win_seq)
+
+    def clone(self):
+        """
+        Return a copy of the environment for tree search.
+        The game state and the move history are copied, while the utils (reward settings), the spaces
+        and the profiler are shared with the original. The recorder is not shared, so that the games played
+        on the clone (e.g. by tree search) are not streamed into the original's dataset.
+
+        Return
+        ------
+        env : AnyNumberInARow3dEnv
+            The cloned environment.
+        """
+        env = copy.copy(self)
+        env.board = self.board.copy()
+        env.heights = self.heights.copy()
+        env.legal_mask = self.legal_mask.copy()
+        if self.move_history is not None:
+            env.move_history = self.move_history.copy()
+        env.recorder = None
+        env.obs_builder = copy.copy(self.obs_builder)
+        env.obs_builder.reset_buffer()
+        if self.bitboard is not None:
+            env.bitboard = self.bitboard.copy()
+        return env
+
+    def action_mask(self):
+        """
+        Return the mask of the actions which can place a stone.
+
+        Return
+        ------
+        action_mask : ndarray
+            An N x N boolean array indexed by [wide][depth], which is true for the piles that are not full.
+            Its flattened index is the action number.
+        """
+        return self.legal_mask.copy()
+
+    def legal_actions(self):
+        """
+        Return the actions which can place a stone.
+
+        Return
+        ------
+        legal_actions : ndarray
+            The action numbers of the piles that are not full.
+        """
+        return np.flatnonzero(self.legal_mask)
+
+    def sample_legal_action(self, random_state=None):
+        """
+        Sample an action uniformly from the legal actions.
+
+        Parameter
+        ---------
+        random_state : numpy.random.RandomState, optional
+            The random number generator. Defaults to the global one of numpy.
+
+        Return
+        ------
+        action : int
+            The sampled action number.
+        """
+        random_state = np.random if random_state is None else random_state
+        return int(random_state.choice(self.legal_actions()))
 
     def render(self, mode="print"):
         """
@@ -176,60 +467,55 @@ class AnyNumberInARow3dEnv(gym.Env):
         mode : str
             The flag to determine the content to be drawn.
         """
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start()
 
         if mode == "print":
             for i, square in enumerate(self.board):
                 print(f"{i}F")
                 for line in square:
-                    print(line)
+                    print(line.tolist())
 
         elif mode == "plot":
-            data = pd.DataFrame(index=[], columns=["W", "D", "H", "Player"])
-            index = 0
-            for i in range(self.num_grid):
-                for j in range(self.num_grid):
-                    for k in range(self.num_grid):
-                        data.loc[index] = ([j, k, i, self.board[i][j][k]])
-                        index += 1
-
-            range_list = [-0.4, self.num_grid - 0.6]
-            fig = px.scatter_3d(data, x="W", y="D", z="H", color="Player",
-                                range_x=range_list, range_y=range_list, range_z=range_list,
-                                color_discrete_map={0: "rgba(0,0,0,0)", 1: "red", -1: "blue"},
-                                opacity=0.95, width=854, height=480)
-            fig.show()
+            make_figure(self.board).show()
+
+        if profiler is not None:
+            profiler.lap("render")
+
+    def profile_stats(self):
+        """
+        Return
+        ------
+        stats : dict[str, dict[str, float]]
+            {"calls": the number of calls, "seconds": the cumulative time} of each phase,
+            which can be aggregated over the workers with profiling.merge_stats.
+            Empty if profiling is disabled.
+        """
+        return {} if self.profiler is None else self.profiler.stats()
 
     def animation(self):
         """
         The function to draw the result of one episode of observation.
+        The environment must be created with record_history=True.
         """
-        data = pd.DataFrame(index=[], columns=["W", "D", "H", "Player", "frame"])
-        index = 0
-        for frame, obs_history in enumerate(self.obs_history):
-            for i in range(self.num_grid):
-                for j in range(self.num_grid):
-                    for k in range(self.num_grid):
-                        data.loc[index] = ([j, k, i, obs_history[i][j][k], frame])
-                        index += 1
-
-        range_list = [-0.4, self.num_grid - 0.6]
-        fig = px.scatter_3d(data, x="W", y="D", z="H", color="Player",
-                            animation_frame="frame",
-                            color_discrete_map={0: "rgba(0,0,0,0)", -1: "red", 1: "blue"},
-                            range_color=[-1, 1],
-                            range_x=range_list, range_y=range_list, range_z=range_list,
-                            opacity=0.95, width=854, height=480)
-        fig.show()
+        if not self.record_history:
+            raise ValueError("animation needs the moves of the episode, create the environment with record_history=True")
+        boards = np.stack(self.obs_history) if self.num_moves else self.board[None]
+        make_figure(boards, animate=True, colors={0: "rgba(0,0,0,0)", -1: "red", 1: "blue"}).show()
 
 
 class Conv3dObsWrapper(gym.ObservationWrapper):
     """
     Define the wrapper class when using Conv3d.
 
-    Attribute
-    ---------
+    Attributes
+    ----------
     observation_space : gym.space
-        Define an N x N x N discrete space with three values (-1, 0, 1).
+        Define a 1 x N x N x N discrete space with three values (-1, 0, 1),
+        or the same space as env for the one-hot observation.
+    has_channel : bool
+        Whether the observations of env already have the channel dimension.
     """
     def __init__(self, env):
         """
@@ -239,7 +525,13 @@ class Conv3dObsWrapper(gym.ObservationWrapper):
             The gym environment.
         """
         super().__init__(env)
-        self.observation_space = gym.spaces.Box(low=-1, high=1, shape=(1, self.num_grid, self.num_grid, self.num_grid))
+        # one-hot の観測は既にチャンネルの次元を持っている
+        self.has_channel = self.obs_builder.dtype == "onehot"
+        if self.has_channel:
+            self.observation_space = env.observation_space
+        else:
+            self.observation_space = gym.spaces.Box(low=-1, high=1, shape=(1,) + env.observation_space.shape,
+                                                    dtype=env.observation_space.dtype)
 
     def observation(self, obs):
         """
@@ -247,12 +539,67 @@ class Conv3dObsWrapper(gym.ObservationWrapper):
 
         Parameter
         ---------
-        obs : torch.Tensor
+        obs : torch.Tensor or ndarray
             The observation agents get after the transition.
 
         Return
         ------
-        obs : torch.Tensor
+        obs : torch.Tensor or ndarray
             The observation agents get after the transition.
         """
-        return torch.unsqueeze(obs, 0)
+        if self.has_channel:
+            return obs
+        return obs[None]
+
+
+class FeaturePlanesWrapper(gym.Wrapper):
+    """
+    Define the wrapper class returning the feature planes of FeatureExtractor as the observation.
+
+    The planes are updated incrementally from the last placed stone (env.utils.last_position) at every step.
+    Call sync after changing the board of env directly (e.g. set_state).
+
+    Attributes
+    ----------
+    observation_space : gym.space
+        A (2 * num_win_seq + 4) x N x N x N float32 space.
+    extractor : FeatureExtractor
+        The feature planes of the current board.
+    """
+    def __init__(self, env):
+        """
+        Parameter
+        ---------
+        env : AnyNumberInARow3dEnv
+            The gym environment.
+        """
+        super().__init__(env)
+        self.extractor = FeatureExtractor(env.num_grid, env.utils.num_win_seq)
+        max_lines = max(len(env.utils.line_table.lines), 1)
+        self.observation_space = gym.spaces.Box(low=0, high=max_lines,
+                                                shape=(self.extractor.num_planes,) + (env.num_grid,) * 3,
+                                                dtype=np.float32)
+
+    def reset(self, **kwargs):
+        self.env.reset(**kwargs)
+        self.extractor.reset()
+        return self.extractor.planes(self.env.player)
+
+    def step(self, action):
+        _, reward, done, info = self.env.step(action)
+        if not info["is_couldnt_locate"]:
+            height, wide, depth = self.env.utils.last_position
+            self.extractor.place((height * self.env.num_grid + wide) * self.env.num_grid + depth, info["turn"])
+        return self.extractor.planes(self.env.player), reward, done, info
+
+    def sync(self):
+        """
+        Recompute the planes from the board of env.
+
+        Return
+        ------
+        obs : ndarray
+            The feature planes of the current board.
+        """
+        self.extractor.set_board(self.env.board)
+        return self.extractor.planes(self.env.player)
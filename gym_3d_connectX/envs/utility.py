@@ -1,5 +1,126 @@
+import collections
+import operator
+
 import numpy as np
 
+# 1つのマスを通る直線の13方向 (height, wide, depth)。逆向きは同じ直線なので、辞書順で正のものだけを残す。
+DIRECTIONS = [(dh, dw, dd)
+              for dh in (-1, 0, 1) for dw in (-1, 0, 1) for dd in (-1, 0, 1)
+              if (dh, dw, dd) > (0, 0, 0)]
+
+# 盤面の設定 (num_grid, num_win_seq) ごとに一度だけ作成し、全ての UtilClass で共有する勝利ラインの表
+_LINE_TABLE_CACHE = {}
+
+LineTable = collections.namedtuple("LineTable", ["lines", "cell_lines"])
+
+# 盤面の大きさごとに共有する Zobrist ハッシュの乱数表
+_ZOBRIST_CACHE = {}
+
+
+def get_line_table(num_grid, num_win_seq):
+    """
+    Return the table of every winning line on the board, shared among the same board configuration.
+    Each cell is indexed by the flat index (height * num_grid + wide) * num_grid + depth.
+
+    Parameters
+    ----------
+    num_grid : int
+        Length of a side.
+    num_win_seq : int
+        The number of sequence necessary for winning.
+
+    Return
+    ------
+    line_table : LineTable
+        lines : ndarray
+            (num_lines, num_win_seq) array of the flat cell indices forming each winning line.
+        cell_lines : ndarray
+            (num_grid ** 3, max_lines_per_cell) array of the line numbers passing through each cell,
+            padded with -1.
+    """
+    key = (num_grid, num_win_seq)
+    if key not in _LINE_TABLE_CACHE:
+        _LINE_TABLE_CACHE[key] = _build_line_table(num_grid, num_win_seq)
+    return _LINE_TABLE_CACHE[key]
+
+
+def _build_line_table(num_grid, num_win_seq):
+    """
+    Build the LineTable for the board configuration. See get_line_table.
+    """
+    coords = np.indices((num_grid, num_grid, num_grid)).reshape(3, -1).T
+    steps = np.arange(num_win_seq)
+
+    lines = []
+    # 13方向それぞれについて、盤面からはみ出さない全ての始点を列挙する
+    for direction in np.array(DIRECTIONS):
+        ends = coords + (num_win_seq - 1) * direction
+        starts = coords[np.all((ends >= 0) & (ends < num_grid), axis=1)]
+        cells = starts[:, None, :] + steps[None, :, None] * direction
+        lines.append((cells[..., 0] * num_grid + cells[..., 1]) * num_grid + cells[..., 2])
+    lines = np.concatenate(lines).astype(np.intp)
+
+    # セルから、そのセルを通るラインへの逆引き表
+    flat_cells = lines.ravel()
+    line_ids = np.repeat(np.arange(len(lines)), num_win_seq)
+    order = np.argsort(flat_cells, kind="stable")
+    counts = np.bincount(flat_cells, minlength=num_grid ** 3)
+    cell_lines = np.full((num_grid ** 3, max(counts.max(), 1)), -1, dtype=np.intp)
+    slots = np.arange(len(flat_cells)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell_lines[flat_cells[order], slots] = line_ids[order]
+
+    lines.setflags(write=False)
+    cell_lines.setflags(write=False)
+    return LineTable(lines=lines, cell_lines=cell_lines)
+
+
+def get_zobrist_keys(num_grid):
+    """
+    Return the random keys of Zobrist hashing, shared among the same board size.
+    The keys are generated from a fixed seed, so the hashes are the same in every process.
+
+    Parameters
+    ----------
+    num_grid : int
+        Length of a side.
+
+    Return
+    ------
+    keys : ndarray
+        A (2, num_grid ** 3) uint64 array. keys[0] is for the stones of player 1 and keys[1] is for player -1,
+        indexed by the flat cell index.
+    """
+    if num_grid not in _ZOBRIST_CACHE:
+        keys = np.random.RandomState(num_grid).randint(0, 2 ** 64, size=(2, num_grid ** 3), dtype=np.uint64)
+        keys.setflags(write=False)
+        _ZOBRIST_CACHE[num_grid] = keys
+    return _ZOBRIST_CACHE[num_grid]
+
+
+def iter_boards(moves, num_grid):
+    """
+    Replay the moves from the empty board and yield the board after each move.
+
+    Parameters
+    ----------
+    moves : array_like
+        A (num_moves, 2) array of (action, player_number) of the moves which placed a stone.
+    num_grid : int
+        Length of a side.
+
+    Yields
+    ------
+    board : ndarray
+        A new three-dimensional int8 array representing the state after each move.
+    """
+    board = np.zeros((num_grid, num_grid, num_grid), dtype=np.int8)
+    heights = np.zeros((num_grid, num_grid), dtype=np.intp)
+    for action, player_number in moves:
+        wide, depth = divmod(int(action), num_grid)
+        board[heights[wide, depth], wide, depth] = player_number
+        heights[wide, depth] += 1
+        yield board.copy()
+
 
 class UtilClass:
     """
@@ -29,6 +150,10 @@ class UtilClass:
         Player A's judgment constant.
     WIN_B : ndarray
         Player B's judgment constant.
+    line_table : LineTable
+        The table of every winning line shared among the same board configuration.
+    last_position : tuple[int, int, int] or None
+        The position (height, wide, depth) where the last stone was placed by resolve_placing.
     """
 
     def __init__(self, num_grid, num_win_seq, win_reward, draw_penalty, lose_penalty,
@@ -63,8 +188,16 @@ class UtilClass:
         self.time_penalty = time_penalty  # 未使用
         self.WIN_A = np.full(num_win_seq, 1)
         self.WIN_B = np.full(num_win_seq, -1)
+        self.last_position = None
+
+    @property
+    def line_table(self):
+        """
+        The table of every winning line, built on the first access and cached per (num_grid, num_win_seq).
+        """
+        return get_line_table(self.num_grid, self.num_win_seq)
 
-    def resolve_placing(self, wide, depth, player_number, board):
+    def resolve_placing(self, wide, depth, player_number, board, heights=None):
         """
         Places a stone and returns the next state.
         It also returns additional information (and an adjustment reward) based on whether
@@ -78,32 +211,50 @@ class UtilClass:
             The vertical coordinate specified by action.
         player_number : int
             The first player's number is 1, and the next is -1.
-        board : list[list[list[int]]]
+        board : list[list[list[int]]] or ndarray
             A three-dimensional array representing the current state.
+        heights : ndarray, optional
+            An N x N array of the number of stones in each pile, updated in place.
+            If given, the stone is placed in O(1) without scanning the pile, and board must be an ndarray.
 
         Returns
         -------
         reward : float
             The total reward agents get through the transition.
-        board : list[list[list[int]]]
+        board : list[list[list[int]]] or ndarray
             A three-dimensional array representing the current state.
         couldnt_locate : bool
             The flag that is true when it cannot be placed.
         """
         couldnt_locate = False
+        if heights is not None:
+            height = heights[wide, depth]
+            if height < self.num_grid:
+                board[height, wide, depth] = player_number
+                heights[wide, depth] = height + 1
+                reward = self.could_locate_reward
+                self.last_position = (int(height), wide, depth)
+            else:
+                reward = -self.couldnt_locate_penalty
+                couldnt_locate = True
+                self.last_position = None
+            return reward, board, couldnt_locate
+
         for height in range(self.num_grid):
             if board[height][wide][depth] == 0:  # 空いていたら置く
                 board[height][wide][depth] = player_number
                 reward = self.could_locate_reward
+                self.last_position = (height, wide, depth)
                 break
         # その柱(pile)が満杯で置けなかった場合。（height=0~self.num_grid-1 まで埋まっていた場合）
         else:
             reward = -self.couldnt_locate_penalty
             couldnt_locate = True
+            self.last_position = None
 
         return reward, board, couldnt_locate
 
-    def resolve_winning(self, done, player_number, board):
+    def resolve_winning(self, done, player_number, board, num_stones=None):
         """
         Return the reward and winner information based on the game result.
 
@@ -113,8 +264,10 @@ class UtilClass:
             The flag of whether the episode has finished or not.
         player_number : int
             The first player's number is 1, and the next is -1.
-        board : list[list[list[int]]]
+        board : list[list[list[int]]] or ndarray
             A three-dimensional array representing the current state.
+        num_stones : int, optional
+            The number of stones on the board. If given, a draw is judged in O(1) without scanning the board.
 
         Returns
         -------
@@ -127,13 +280,16 @@ class UtilClass:
         """
         reward = 0
         winner = 0
+        # 石の数が与えられていない場合は盤面から数える
+        if num_stones is None:
+            num_stones = np.count_nonzero(board)
         # stepを実行した側（player_number側）は勝つ以外ありえない
         if done:
             # どちらのプレーヤーが勝利したかにかかわらず、勝利報酬を設定。resolve_placing内で石を置くことによって得た報酬を引いておく。
             reward = self.win_reward - self.could_locate_reward
             winner = player_number
         # 全てのマスが非ゼロにもかかわらず、doneになっていない場合（引き分けの場合）
-        elif not (0 in np.array(board).flatten()):
+        elif num_stones == self.num_grid ** 3:
             done = True
             # 引き分けによって課せられる罰。resolve_placing内で石を置くことによって得た報酬を引いておく。
             reward = -self.draw_penalty - self.could_locate_reward
@@ -156,38 +312,38 @@ class UtilClass:
         done : bool
             The flag of whether the episode has finished or not.
         """
-        cube = np.array(cube)
-        num_stride = self.num_grid - self.num_win_seq + 1
-
-        # 1辺self.num_gridマスの格子内で、1辺self.num_win_seqマスのcubeを1マスずつずらしていく
-        for dim_H_stride_id in range(num_stride):
-            for dim_W_stride_id in range(num_stride):
-                for dim_D_stride_id in range(num_stride):
-                    searching_cube = cube[
-                                     dim_H_stride_id:dim_H_stride_id + self.num_win_seq,
-                                     dim_W_stride_id:dim_W_stride_id + self.num_win_seq,
-                                     dim_D_stride_id:dim_D_stride_id + self.num_win_seq
-                                     ]
-
-                    # x,y,z軸各方向に垂直な面について解析
-                    cube_list = [
-                        searching_cube,
-                        np.rot90(searching_cube, axes=(0, 1)),
-                        searching_cube.T
-                    ]
-
-                    # cube内の考えうる全ての二次元平面上でループ
-                    for each_cube in cube_list:
-                        for plane in each_cube:
-                            # 2次元平面上でビンゴしていないか確認
-                            if self.is_end_on_2d_plane(plane):
-                                return True
-
-                    # 立体的な斜め
-                    if self.is_diag_on_3d_cube(each_cube):
-                        return True
+        lines = self.line_table.lines
+        # 全ての勝利ラインの石の和を一度に計算する。和の絶対値が num_win_seq ならそのラインは同じ色で揃っている。
+        sums = np.asarray(cube).ravel()[lines].sum(axis=1)
+        return bool((np.abs(sums) == self.num_win_seq).any())
 
-        return False
+    def is_done_at(self, cube, height, wide, depth):
+        """
+        Judges the end of the game only along the lines passing through the specified cell.
+        Since only the last placed stone can complete a new sequence, this gives the same result as is_done
+        when it is called with the position of the last placed stone.
+
+        Parameters
+        ----------
+        cube : list[list[list[int]]] or ndarray
+            A three-dimensional array representing the current state.
+        height : int
+            The height coordinate of the last placed stone.
+        wide : int
+            The horizontal coordinate of the last placed stone.
+        depth : int
+            The vertical coordinate of the last placed stone.
+
+        Return
+        ------
+        done : bool
+            The flag of whether the episode has finished or not.
+        """
+        line_table = self.line_table
+        line_ids = line_table.cell_lines[(height * self.num_grid + wide) * self.num_grid + depth]
+        line_ids = line_ids[line_ids >= 0]
+        sums = np.asarray(cube).ravel()[line_table.lines[line_ids]].sum(axis=1)
+        return bool((np.abs(sums) == self.num_win_seq).any())
 
     def is_end_on_2d_plane(self, org_plane):
         """
@@ -233,8 +389,8 @@ class UtilClass:
         """
         assert org_cube.shape == (self.num_win_seq, self.num_win_seq, self.num_win_seq)
 
-        for cube in [org_cube, np.rot90(org_cube, axes=(1, 2)), np.rot90(org_cube, axes=(0, 1)),
-                     np.rot90(org_cube.T, axes=(0, 1))]:
+        # 4本の立体的な対角線は、W軸・D軸を反転させた4つのcubeの主対角線に対応する
+        for cube in [org_cube, org_cube[:, ::-1, :], org_cube[:, :, ::-1], org_cube[:, ::-1, ::-1]]:
 
             oblique_elements = np.empty(0)
             for f in range(self.num_win_seq):
@@ -249,9 +405,78 @@ class UtilClass:
 
         return False
 
+    def decode_action(self, action):
+        """
+        Convert the action number to the position of the pile.
+
+        Parameter
+        ---------
+        action : int
+            Elected action number (range from 0 to self.num_grid**2).
+
+        Returns
+        -------
+        wide : int
+            The horizontal coordinate of the pile.
+        depth : int
+            The vertical coordinate of the pile.
+        """
+        action = operator.index(action)
+        if not 0 <= action < self.num_grid * self.num_grid:
+            raise ValueError(f"action must be in [0, {self.num_grid * self.num_grid}), but got {action}")
+        return divmod(action, self.num_grid)
+
+    def decode_actions(self, actions):
+        """
+        Convert the action numbers to the positions of the piles at once.
+
+        Parameter
+        ---------
+        actions : array_like
+            An integer array of elected action numbers (range from 0 to self.num_grid**2).
+
+        Returns
+        -------
+        wide : ndarray
+            The horizontal coordinates of the piles.
+        depth : ndarray
+            The vertical coordinates of the piles.
+        """
+        actions = np.asarray(actions)
+        if not np.issubdtype(actions.dtype, np.integer):
+            raise TypeError(f"actions must be integers, but got {actions.dtype}")
+        if actions.size and (actions.min() < 0 or actions.max() >= self.num_grid * self.num_grid):
+            raise ValueError(f"actions must be in [0, {self.num_grid * self.num_grid})")
+        return np.divmod(actions.astype(np.intp, copy=False), self.num_grid)
+
+    def encode_action(self, wide, depth):
+        """
+        Convert the position of the pile to the action number. The inverse of decode_action.
+
+        Parameters
+        ----------
+        wide : int or array_like
+            The horizontal coordinate(s) of the pile.
+        depth : int or array_like
+            The vertical coordinate(s) of the pile.
+
+        Return
+        ------
+        action : int or ndarray
+            The action number(s).
+        """
+        if np.ndim(wide) == 0 and np.ndim(depth) == 0:
+            wide, depth = operator.index(wide), operator.index(depth)
+        else:
+            wide, depth = np.asarray(wide), np.asarray(depth)
+        if np.any((wide < 0) | (wide >= self.num_grid) | (depth < 0) | (depth >= self.num_grid)):
+            raise ValueError(f"wide and depth must be in [0, {self.num_grid})")
+        return wide * self.num_grid + depth
+
     def base_change(self, value, base):
         """
         Convert the input to the decimal number specified by base.
+        Each digit is a single character, so it only works for base <= 10. Use decode_action for actions.
 
         Parameters
         ----------
@@ -269,7 +494,7 @@ class UtilClass:
             return self.base_change(value // base, base) + str(value % base)
         return str(value % base)
 
-    def is_game_end(self, player_number, board):
+    def is_game_end(self, player_number, board, position=None, num_stones=None):
         """
         Judges the end of the game based on the current state of the board,
         and returns the reward and winner information according to the result of the game.
@@ -280,6 +505,11 @@ class UtilClass:
             The first player's number is 1, and the next is -1.
         board : list[list[list[int]]]
             A three-dimensional array representing the current state.
+        position : tuple[int, int, int] or None
+            The position (height, wide, depth) of the last placed stone.
+            If given, only the lines passing through it are checked, otherwise the whole board is scanned.
+        num_stones : int, optional
+            The number of stones on the board, used to judge a draw in O(1).
 
         Returns
         -------
@@ -290,7 +520,10 @@ class UtilClass:
         winner : int
             The player number of the winning side.
         """
-        done = self.is_done(board)
-        is_end, reward, winner = self.resolve_winning(done, player_number, board)
+        if position is None:
+            done = self.is_done(board)
+        else:
+            done = self.is_done_at(board, *position)
+        is_end, reward, winner = self.resolve_winning(done, player_number, board, num_stones=num_stones)
 
         return is_end, reward, winner
@@ -0,0 +1,300 @@
+import gym
+import numpy as np
+
+from gym_3d_connectX.envs.observation import ObservationBuilder
+from gym_3d_connectX.envs.utility import UtilClass
+
+
+def sample_masked(masks, random_state):
+    """
+    Sample an index uniformly from the true entries of each row.
+
+    Parameters
+    ----------
+    masks : ndarray
+        A (B, M) boolean array. Each row must have at least one true entry.
+    random_state : numpy.random.RandomState
+        The random number generator.
+
+    Return
+    ------
+    indices : ndarray
+        The (B,) sampled indices.
+    """
+    # 一様乱数のうち、選べない要素は -1 にして argmax を取る
+    scores = random_state.random_sample(masks.shape)
+    scores[~masks] = -1
+    return scores.argmax(axis=1)
+
+
+class VectorAnyNumberInARow3dEnv(gym.vector.VectorEnv):
+    """
+    The batched implementation of AnyNumberInARow3dEnv.
+
+    This class holds B games as one (B, N, N, N) array and steps all of them in one call.
+    Placement, the penalty for illegal moves and the win check are vectorized across the batch,
+    and the finished games are reset automatically.
+
+    Attributes
+    ----------
+    num_grid : int
+        Length of a side.
+    boards : ndarray
+        A (B, N, N, N) int8 array representing the current states, indexed by [env][height][wide][depth].
+    heights : ndarray
+        A (B, N, N) array of the number of stones in each pile.
+    num_stones : ndarray
+        The number of stones on each board.
+    legal_masks : ndarray
+        A (B, N, N) boolean array which is true for the piles that are not full.
+    players : ndarray
+        The player number to move in each game.
+    step_numbers : ndarray
+        The number of current turns in each game.
+    first_player : int
+        Define which is the first player.
+    utils : UtilClass
+        Utility class implemented in utility.py. The reward settings are shared by all the games.
+    obs_builder : ObservationBuilder
+        Build the batched observations from boards.
+    recorder : EpisodeRecorder or None
+        The recorder to which the finished games are streamed.
+    """
+
+    def __init__(self, num_envs, num_grid=4, num_win_seq=4, win_reward=10, draw_penalty=5, lose_penalty=10,
+                 could_locate_reward=0.1, couldnt_locate_penalty=0.1, time_penalty=0.1, first_player=1,
+                 obs_backend="torch", obs_dtype="float32", obs_perspective=False, obs_reuse_buffer=False,
+                 recorder=None):
+        """
+        Parameters
+        ----------
+        num_envs : int
+            The number of games held in the batch.
+        num_grid : int
+            Length of a side.
+        num_win_seq : int
+            The number of sequence necessary for winning.
+        win_reward : float
+            The reward agent gets when win the game.
+        draw_penalty : float
+            The penalty agent gets when it draw the game.
+        lose_penalty : float
+            The penalty agent gets when it lose the game.
+        could_locate_reward : float
+            The additional reward for agent being able to put the stone.
+        couldnt_locate_penalty : float
+            The penalty agent gets when it choose the location where the stone cannot be placed.
+        time_penalty : float
+            The penalty agents gets along with timesteps.
+        first_player : int
+            Define which is the first player.
+        obs_backend : str
+            "torch" or "numpy". See AnyNumberInARow3dEnv.
+        obs_dtype : str
+            "int8", "float32" or "onehot". See AnyNumberInARow3dEnv.
+        obs_perspective : bool
+            Whether the observations are from the perspective of the player to move in each game.
+        obs_reuse_buffer : bool
+            Whether the observations are written in place into one preallocated buffer.
+        recorder : EpisodeRecorder, optional
+            If given, every finished game is streamed to it.
+        """
+        self.obs_builder = ObservationBuilder(num_grid, backend=obs_backend, dtype=obs_dtype,
+                                              perspective=obs_perspective, reuse_buffer=obs_reuse_buffer)
+        super().__init__(num_envs, self.obs_builder.observation_space(), gym.spaces.Discrete(num_grid * num_grid))
+        self._no_terminal_observation = self.obs_builder.build(np.zeros((0,) + (num_grid,) * 3, dtype=np.int8),
+                                                               np.zeros(0, dtype=np.int8), reuse_buffer=False)
+
+        self.num_grid = num_grid
+        self.first_player = first_player
+        self.boards = np.zeros((num_envs, num_grid, num_grid, num_grid), dtype=np.int8)
+        self.heights = np.zeros((num_envs, num_grid, num_grid), dtype=np.intp)
+        self.num_stones = np.zeros(num_envs, dtype=np.intp)
+        self.legal_masks = np.ones((num_envs, num_grid, num_grid), dtype=bool)
+        self.players = np.full(num_envs, first_player, dtype=np.int8)
+        self.step_numbers = np.zeros(num_envs, dtype=np.intp)
+        self.recorder = recorder
+        # 記録する場合だけ、各ゲームの手の列を保持する
+        self._actions = np.zeros((num_envs, num_grid ** 3), dtype=np.int16) if recorder is not None else None
+
+        self.utils = UtilClass(
+            num_grid=num_grid,
+            num_win_seq=num_win_seq,
+            win_reward=win_reward,
+            draw_penalty=draw_penalty,
+            lose_penalty=lose_penalty,
+            could_locate_reward=could_locate_reward,
+            couldnt_locate_penalty=couldnt_locate_penalty,
+            time_penalty=time_penalty
+        )
+
+        self.reset()
+
+    def reset(self, **kwargs):
+        """
+        Reset all the boards to the initial state.
+
+        Returns
+        -------
+        reset : torch.Tensor or ndarray
+            The (B, N, N, N) initial board tensor filled with 0.
+        """
+        self.reset_envs(np.ones(self.num_envs, dtype=bool))
+        return self.obs_builder.build(self.boards, self.players)
+
+    def reset_envs(self, mask):
+        """
+        Reset the selected boards to the initial state.
+
+        Parameter
+        ---------
+        mask : ndarray
+            A (B,) boolean array which is true for the games to be reset.
+        """
+        self.boards[mask] = 0
+        self.heights[mask] = 0
+        self.num_stones[mask] = 0
+        self.legal_masks[mask] = True
+        self.players[mask] = self.first_player
+        self.step_numbers[mask] = 0
+
+    def step(self, actions):
+        """
+        Step all the games in one call.
+
+        Parameter
+        ---------
+        actions : array_like
+            A (B,) array of elected action numbers (range from 0 to self.num_grid**2).
+
+        Returns
+        -------
+        obs : torch.Tensor or ndarray
+            The (B, N, N, N) observations agents get after the transition.
+            The finished games are already reset.
+        rewards : ndarray
+            The (B,) total rewards agents get through the transition.
+        dones : ndarray
+            The (B,) flags of whether each episode has finished or not.
+        info : dict
+            A dictionary of (B,) arrays "turn", "winner" and "is_couldnt_locate", which are the same as
+            the info of AnyNumberInARow3dEnv, "action_mask", the (B, N, N) legal action masks for the next move
+            (after the finished games are reset), and "terminal_observation", the last boards of the finished
+            games in the order of np.flatnonzero(dones).
+        """
+        actions = np.asarray(actions)
+        wide, depth = self.utils.decode_actions(actions)
+        env_ids = np.arange(self.num_envs)
+        utils = self.utils
+
+        # 石の配置。柱が満杯の場合は置けない。
+        heights = self.heights[env_ids, wide, depth]
+        is_couldnt_locate = heights >= self.num_grid
+        placed = ~is_couldnt_locate
+        placed_ids, placed_heights = env_ids[placed], heights[placed]
+        placed_wide, placed_depth = wide[placed], depth[placed]
+        self.boards[placed_ids, placed_heights, placed_wide, placed_depth] = self.players[placed]
+        self.heights[placed_ids, placed_wide, placed_depth] += 1
+        self.num_stones[placed] += 1
+        if self.recorder is not None:
+            self._actions[placed_ids, self.num_stones[placed] - 1] = actions[placed]
+        # 柱が満杯になったら、その柱は選べなくなる
+        self.legal_masks[placed_ids, placed_wide, placed_depth] = placed_heights + 1 < self.num_grid
+        fixment_rewards = np.where(placed, utils.could_locate_reward, -utils.couldnt_locate_penalty)
+
+        # 置いた石を通るラインだけを調べて勝利判定をする
+        won = np.zeros(self.num_envs, dtype=bool)
+        won[placed_ids] = self._is_done_at(placed_ids, placed_heights, placed_wide, placed_depth)
+        draw = ~won & (self.num_stones == self.num_grid ** 3)
+        dones = won | draw
+
+        # resolve_winning と同様に、石を置くことによって得た報酬を引いておく
+        rewards = fixment_rewards + np.where(
+            won, utils.win_reward - utils.could_locate_reward,
+            np.where(draw, -utils.draw_penalty - utils.could_locate_reward, 0)
+        )
+        info = {
+            "turn": self.players.copy(),
+            "winner": np.where(won, self.players, 0),
+            "is_couldnt_locate": is_couldnt_locate,
+        }
+
+        # プレーヤーの交代(置けない場所に置いていた場合は、プレーヤーは交代しない)
+        self.players[placed] *= -1
+        self.step_numbers[placed] += 1
+
+        if dones.any():
+            # 終了したゲームだけ、最終盤面を info に残してから初期化する
+            finished = np.flatnonzero(dones)
+            info["terminal_observation"] = self.obs_builder.build(self.boards[finished], self.players[finished],
+                                                                  reuse_buffer=False)
+            if self.recorder is not None:
+                for env_id in finished:
+                    self.recorder.record(self._actions[env_id, :self.num_stones[env_id]], self.first_player,
+                                         info["winner"][env_id], utils)
+            self.reset_envs(dones)
+        else:
+            # 終了したゲームがなければ、初期化時に作った空の観測を使い回す
+            info["terminal_observation"] = self._no_terminal_observation
+        info["action_mask"] = self.legal_masks.copy()
+
+        return self.obs_builder.build(self.boards, self.players), rewards, dones, info
+
+    def action_masks(self):
+        """
+        Return the masks of the actions which can place a stone.
+
+        Return
+        ------
+        action_masks : ndarray
+            A (B, N, N) boolean array which is true for the piles that are not full.
+        """
+        return self.legal_masks.copy()
+
+    def sample_legal_actions(self, random_state=None):
+        """
+        Sample an action uniformly from the legal actions of each game.
+
+        Parameter
+        ---------
+        random_state : numpy.random.RandomState, optional
+            The random number generator. Defaults to the global one of numpy.
+
+        Return
+        ------
+        actions : ndarray
+            The (B,) sampled action numbers.
+        """
+        random_state = np.random if random_state is None else random_state
+        return sample_masked(self.legal_masks.reshape(self.num_envs, -1), random_state)
+
+    def _is_done_at(self, env_ids, heights, wide, depth):
+        """
+        Judges the end of the selected games along the lines passing through the specified cells.
+
+        Parameters
+        ----------
+        env_ids : ndarray
+            The game numbers to be judged.
+        heights : ndarray
+            The height coordinates of the last placed stones.
+        wide : ndarray
+            The horizontal coordinates of the last placed stones.
+        depth : ndarray
+            The vertical coordinates of the last placed stones.
+
+        Return
+        ------
+        done : ndarray
+            The flags of whether each episode has finished or not.
+        """
+        line_table = self.utils.line_table
+        if len(line_table.lines) == 0:
+            return np.zeros(len(env_ids), dtype=bool)
+        cells = (heights * self.num_grid + wide) * self.num_grid + depth
+        line_ids = line_table.cell_lines[cells]
+        flat_boards = self.boards.reshape(self.num_envs, -1)
+        # (ゲーム, ライン, マス) の形で石を集め、ラインごとの和を取る。存在しないライン(-1)は0として扱う。
+        sums = flat_boards[env_ids[:, None, None], line_table.lines[line_ids]].sum(axis=2)
+        sums[line_ids < 0] = 0
+        return (np.abs(sums) == self.utils.num_win_seq).any(axis=1)
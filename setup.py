@@ -26,6 +26,10 @@ def main():
         author_email='31807@toyota.kosen-ac.jp',
         packages=['gym_3d_connectX'],
         install_requires=read_requirements(),
+        extras_require={
+            'plot': ['pandas~=1.2.4', 'plotly~=4.14.3'],
+            'all': ['pandas~=1.2.4', 'plotly~=4.14.3'],
+        },
         python_requires='>=3.7',
     )
 
@@ -1,7 +1,27 @@
+import json
+import multiprocessing
+import os
+import pickle
+import asyncio
+import random
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
 import gym
+import numpy as np
+
 import gym_3d_connectX
+from gym_3d_connectX.envs import (AnyNumberInARow3dEnv, EpisodeReader, EpisodeRecorder,
+                                  SubprocVectorAnyNumberInARow3dEnv, VectorAnyNumberInARow3dEnv)
+from gym_3d_connectX.envs import arena, mcts, opening_book, playout, profiling, rendering, server, symmetry
+from gym_3d_connectX.envs.solver import WIN_VALUE, NegamaxSolver
+from gym_3d_connectX.envs.sparse import SparseAnyNumberInARow3dEnv, SparseBoard
+from gym_3d_connectX.envs.features import FeatureExtractor
+from gym_3d_connectX.envs.three_d_connect_n import Conv3dObsWrapper, FeaturePlanesWrapper
+from gym_3d_connectX.envs.utility import _LINE_TABLE_CACHE, UtilClass, get_line_table, iter_boards
 
 
 class TestCombination(unittest.TestCase):
@@ -50,5 +70,836 @@ class TestCombination(unittest.TestCase):
                 self.assertEqual(answer_dict["couldnt_locates"][idx], info["is_couldnt_locate"])
 
 
+class TestWinCheck(unittest.TestCase):
+    def test_space_diagonals(self):
+        env = AnyNumberInARow3dEnv(num_grid=4, num_win_seq=4)
+        for sign_w in (1, -1):
+            for sign_d in (1, -1):
+                cube = np.zeros((4, 4, 4), dtype=int)
+                for i in range(4):
+                    cube[i][i if sign_w == 1 else 3 - i][i if sign_d == 1 else 3 - i] = 1
+                self.assertTrue(env.utils.is_done(cube))
+                self.assertTrue(env.utils.is_done_at(cube, 3, 3 if sign_w == 1 else 0, 3 if sign_d == 1 else 0))
+
+    def test_line_table(self):
+        table = get_line_table(4, 4)
+        # 軸方向48本、平面の斜め24本、立体の斜め4本
+        self.assertEqual(table.lines.shape, (76, 4))
+        self.assertIs(table, get_line_table(4, 4))
+        for cell, line_ids in enumerate(table.cell_lines):
+            line_ids = line_ids[line_ids >= 0]
+            self.assertEqual(set(line_ids), set(np.flatnonzero((table.lines == cell).any(axis=1))))
+
+    def test_draw(self):
+        env = AnyNumberInARow3dEnv(num_grid=2, num_win_seq=3)
+        for action in [0, 0, 1, 1, 2, 2, 3]:
+            _, _, done, _ = env.step(action)
+            self.assertFalse(done)
+        _, _, done, info = env.step(3)
+        self.assertTrue(done)
+        self.assertEqual(0, info["winner"])
+        self.assertEqual(8, env.num_stones)
+        self.assertTrue((env.heights == 2).all())
+
+    def test_incremental_matches_full(self):
+        for num_grid, num_win_seq in [(4, 4), (5, 3), (6, 4)]:
+            for seed in range(10):
+                rng = random.Random(seed)
+                full = AnyNumberInARow3dEnv(num_grid=num_grid, num_win_seq=num_win_seq, win_check="full")
+                others = [
+                    AnyNumberInARow3dEnv(num_grid=num_grid, num_win_seq=num_win_seq),
+                    AnyNumberInARow3dEnv(num_grid=num_grid, num_win_seq=num_win_seq, backend="bitboard"),
+                    AnyNumberInARow3dEnv(num_grid=num_grid, num_win_seq=num_win_seq, backend="bitboard",
+                                         win_check="full"),
+                ]
+                done = False
+                while not done:
+                    action = rng.randrange(num_grid * num_grid)
+                    _, full_reward, done, full_info = full.step(action)
+                    full_action_mask = full_info.pop("action_mask")
+                    for env in others:
+                        _, reward, other_done, info = env.step(action)
+                        self.assertEqual(full_reward, reward)
+                        self.assertEqual(done, other_done)
+                        self.assertTrue((full_action_mask == info.pop("action_mask")).all())
+                        self.assertEqual(full_info, info)
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_core_does_not_import_optional_dependencies(self):
+        code = ("import sys, gym_3d_connectX.envs as envs;"
+                "env = envs.AnyNumberInARow3dEnv(obs_backend='numpy'); env.reset(); env.step(0);"
+                "print(sorted(m for m in ('torch', 'pandas', 'plotly') if m in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), "[]")
+
+
+class TestActionCoding(unittest.TestCase):
+    def test_round_trip(self):
+        env = AnyNumberInARow3dEnv(num_grid=11, num_win_seq=4, obs_backend="numpy")
+        actions = np.arange(121)
+        wide, depth = env.utils.decode_actions(actions)
+        self.assertEqual([env.utils.decode_action(action) for action in actions], list(zip(wide, depth)))
+        self.assertTrue((env.utils.encode_action(wide, depth) == actions).all())
+        with self.assertRaises(ValueError):
+            env.utils.decode_action(121)
+        with self.assertRaises(ValueError):
+            env.utils.decode_actions([0, -1])
+        with self.assertRaises(ValueError):
+            env.utils.encode_action(11, 0)
+
+    def test_large_board(self):
+        env = AnyNumberInARow3dEnv(num_grid=11, num_win_seq=4, obs_backend="numpy")
+        env.reset()
+        for action in (120, 0, 120, 1, 120, 2, 120):
+            obs, _, done, info = env.step(action)
+        self.assertTrue(done)
+        self.assertEqual(info["winner"], 1)
+        self.assertTrue((obs[:4, 10, 10] == 1).all())
+
+
+class TestActionMask(unittest.TestCase):
+    def test_full_pile(self):
+        env = AnyNumberInARow3dEnv(num_grid=4, num_win_seq=4)
+        for _ in range(3):
+            env.step(6)
+        self.assertTrue(env.action_mask()[1, 2])
+        _, _, _, info = env.step(6)
+        self.assertFalse(info["action_mask"][1, 2])
+        self.assertEqual(15, info["action_mask"].sum())
+        self.assertNotIn(6, env.legal_actions())
+        self.assertNotEqual(6, env.sample_legal_action(np.random.RandomState(0)))
+
+    def test_vector_sampling(self):
+        env = VectorAnyNumberInARow3dEnv(4, num_grid=3, num_win_seq=4)
+        random_state = np.random.RandomState(0)
+        for _ in range(27):
+            masks = env.action_masks()
+            actions = env.sample_legal_actions(random_state)
+            self.assertTrue(masks.reshape(4, -1)[np.arange(4), actions].all())
+            _, _, dones, info = env.step(actions)
+            self.assertFalse(info["is_couldnt_locate"].any())
+        self.assertTrue(dones.all())
+
+
+class TestSolver(unittest.TestCase):
+    def test_immediate_win_and_block(self):
+        solver = NegamaxSolver(num_grid=4, num_win_seq=4, max_depth=3)
+        env = AnyNumberInARow3dEnv()
+        for action in [0, 5, 1, 5, 2]:
+            env.step(action)
+        # プレーヤー-1 は 3 に置かないと負ける
+        self.assertEqual(3, solver.best_action(env.board, env.player))
+        env.step(6)
+        result = solver.search(env.board, env.player)
+        self.assertEqual(3, result.action)
+        self.assertEqual(WIN_VALUE - 1, result.value)
+        self.assertTrue(result.exact)
+
+    def test_exact_value(self):
+        env = AnyNumberInARow3dEnv(num_grid=3, num_win_seq=3)
+        for action in [4, 4, 0, 8, 8, 0]:
+            env.step(action)
+        solver = NegamaxSolver(num_grid=3, num_win_seq=3, max_depth=27)
+        result = solver.search(env.board, env.player)
+        self.assertTrue(result.exact)
+        # 置換表に前回の探索結果が残っていても同じ値になる
+        second_result = solver.search(env.board, env.player)
+        self.assertEqual((result.value, result.exact), (second_result.value, second_result.exact))
+        # 最善手を打った後の局面は、相手から見て1手分遠い同じ結果になる
+        self.assertGreater(result.value, 0)
+        env.step(result.action)
+        self.assertEqual(-result.value - 1, solver.search(env.board, env.player).value)
+
+class TestState(unittest.TestCase):
+    def test_get_set_state(self):
+        for backend in ["numpy", "bitboard"]:
+            env = AnyNumberInARow3dEnv(backend=backend, record_history=True)
+            for action in [0, 0, 0, 5]:
+                env.step(action)
+            state = env.get_state()
+            board, action_mask = env.board.copy(), env.action_mask()
+            results = [env.step(action)[1:3] for action in [0, 1, 1, 2, 2, 3, 3, 4]]
+            env.set_state(state)
+            self.assertTrue((board == env.board).all())
+            self.assertTrue((action_mask == env.action_mask()).all())
+            self.assertEqual((1, 4, 3), (env.player, env.step_number, len(env.obs_history)))
+            # 復元後も同じ手順で同じ結果になる
+            self.assertEqual(results, [env.step(action)[1:3] for action in [0, 1, 1, 2, 2, 3, 3, 4]])
+
+    def test_history(self):
+        env = AnyNumberInARow3dEnv(record_history=True)
+        boards = []
+        for action in [0, 5, 5, 0, 3]:
+            env.step(action)
+            boards.append(env.board.copy())
+        env.step(15)
+        self.assertEqual(6, env.num_moves)
+        self.assertEqual([5, -1], env.moves[1].tolist())
+        # 2手目以降の盤面が記録される
+        self.assertEqual(5, len(env.obs_history))
+        for board, frame in zip(boards[1:], env.obs_history):
+            self.assertTrue((board == frame).all())
+        self.assertEqual(0, len(AnyNumberInARow3dEnv().obs_history))
+        # 記録しない場合は履歴の配列を確保しない
+        self.assertIsNone(AnyNumberInARow3dEnv().move_history)
+        self.assertIsNone(AnyNumberInARow3dEnv().clone().move_history)
+        # 以前のように [] を代入して履歴を消せる
+        env.obs_history = []
+        self.assertEqual((0, []), (env.num_moves, env.obs_history))
+        with self.assertRaises(ValueError):
+            env.obs_history = boards
+
+    def test_clone(self):
+        env = AnyNumberInARow3dEnv(backend="bitboard")
+        env.step(0)
+        cloned = env.clone()
+        cloned.step(0)
+        self.assertEqual(1, env.num_stones)
+        self.assertEqual(2, cloned.num_stones)
+        self.assertEqual(0, env.board[1, 0, 0])
+        self.assertEqual(1, env.bitboard.num_stones)
+        self.assertIs(env.utils, cloned.utils)
+
+
+class TestObservation(unittest.TestCase):
+    def test_numpy_view(self):
+        env = AnyNumberInARow3dEnv(obs_backend="numpy", obs_dtype="int8")
+        obs, _, _, _ = env.step(5)
+        self.assertTrue(np.shares_memory(obs, env.board))
+        self.assertFalse(obs.flags.writeable)
+        self.assertEqual(1, obs[0, 1, 1])
+
+    def test_perspective_onehot(self):
+        env = AnyNumberInARow3dEnv(obs_backend="numpy", obs_dtype="onehot", obs_perspective=True)
+        env.step(0)
+        obs, _, _, _ = env.step(1)
+        # 次に打つのはプレーヤー1なので、プレーヤー1の石が1枚目の平面に入る
+        self.assertEqual((2, 4, 4, 4), obs.shape)
+        self.assertEqual(1, obs[0, 0, 0, 0])
+        self.assertEqual(1, obs[1, 0, 0, 1])
+        self.assertEqual(2, obs.sum())
+        self.assertEqual(obs.shape, Conv3dObsWrapper(env).observation(obs).shape)
+
+    def test_reuse_buffer(self):
+        env = AnyNumberInARow3dEnv(obs_perspective=True, obs_reuse_buffer=True)
+        first_obs, _, _, _ = env.step(0)
+        obs, _, _, _ = env.step(1)
+        self.assertIs(first_obs, obs)
+        self.assertEqual(1.0, obs[0, 0, 0].item())
+        self.assertEqual(-1.0, obs[0, 0, 1].item())
+        self.assertEqual((1, 4, 4, 4), tuple(Conv3dObsWrapper(env).observation(obs).shape))
+
+
+class TestVectorEnv(unittest.TestCase):
+    def test_matches_single_envs(self):
+        num_envs = 8
+        rng = np.random.RandomState(0)
+        vector_env = VectorAnyNumberInARow3dEnv(num_envs, num_grid=4, num_win_seq=3)
+        envs = [AnyNumberInARow3dEnv(num_grid=4, num_win_seq=3) for _ in range(num_envs)]
+        for _ in range(200):
+            actions = rng.randint(16, size=num_envs)
+            obs, rewards, dones, info = vector_env.step(actions)
+            terminal_ids = list(np.flatnonzero(dones))
+            self.assertEqual(len(info["terminal_observation"]), len(terminal_ids))
+            for i, env in enumerate(envs):
+                env_obs, reward, done, env_info = env.step(actions[i])
+                self.assertAlmostEqual(reward, rewards[i])
+                self.assertEqual(done, dones[i])
+                for key in ["turn", "winner", "is_couldnt_locate"]:
+                    self.assertEqual(env_info[key], info[key][i])
+                if not done:
+                    self.assertTrue((env_info["action_mask"] == info["action_mask"][i]).all())
+                if done:
+                    self.assertTrue((env_obs == info["terminal_observation"][terminal_ids.index(i)]).all())
+                    env_obs = env.reset()
+                    env.player = 1
+                self.assertTrue((env_obs == obs[i]).all())
+
+
+class TestSubprocVectorEnv(unittest.TestCase):
+    def test_matches_vector_env(self):
+        num_envs = 6
+        rng = np.random.RandomState(0)
+        subproc_env = SubprocVectorAnyNumberInARow3dEnv(num_envs, num_workers=2, num_grid=4, num_win_seq=3)
+        vector_env = VectorAnyNumberInARow3dEnv(num_envs, num_grid=4, num_win_seq=3)
+        try:
+            for _ in range(50):
+                actions = rng.randint(16, size=num_envs)
+                subproc_results = subproc_env.step(actions)
+                vector_results = vector_env.step(actions)
+                for subproc_result, vector_result in zip(subproc_results[:3], vector_results[:3]):
+                    self.assertTrue((np.asarray(subproc_result) == np.asarray(vector_result)).all())
+                for key, value in vector_results[3].items():
+                    self.assertTrue((np.asarray(subproc_results[3][key]) == np.asarray(value)).all())
+
+            subproc_env.step_async(rng.randint(16, size=num_envs))
+            env_ids = []
+            while len(env_ids) < num_envs:
+                ready_ids, obs, _, _, _ = subproc_env.step_any()
+                self.assertEqual(len(ready_ids), len(obs))
+                env_ids.extend(ready_ids)
+            self.assertEqual(sorted(env_ids), list(range(num_envs)))
+        finally:
+            subproc_env.close()
+
+    def test_worker_errors(self):
+        env = SubprocVectorAnyNumberInARow3dEnv(4, num_workers=2, obs_backend="numpy", num_grid=3, num_win_seq=3)
+        try:
+            # 範囲外の action はワーカーの中で例外になり、トレースバックと共に親で送出される
+            with self.assertRaisesRegex(RuntimeError, "ValueError"):
+                env.step([0, 0, 0, 9])
+            env.step_async([0, 0, 0, 9])
+            with self.assertRaisesRegex(RuntimeError, "worker 1"):
+                while True:
+                    env.step_any()
+            _, rewards, _, _ = env.step([0, 1, 2, 3])
+            self.assertEqual(len(rewards), 4)
+            # 実行中のワーカーがなければ、待ち続けずに例外にする
+            with self.assertRaisesRegex(RuntimeError, "step_async"):
+                env.step_any()
+        finally:
+            env.close()
+        before = set(multiprocessing.active_children())
+        with self.assertRaisesRegex(RuntimeError, "TypeError"):
+            SubprocVectorAnyNumberInARow3dEnv(2, num_workers=2, obs_backend="numpy", unknown_option=1)
+        # 起動に失敗しても、起動したワーカーは全て止められている
+        self.assertEqual(set(multiprocessing.active_children()) - before, set())
+
+
+class TestRecording(unittest.TestCase):
+    def test_env_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            final_boards, winners = [], []
+            with EpisodeRecorder(directory, shard_size=2) as recorder:
+                env = AnyNumberInARow3dEnv(num_grid=3, num_win_seq=3, obs_backend="numpy", recorder=recorder)
+                rng = np.random.RandomState(0)
+                for _ in range(5):
+                    env.reset()
+                    done = False
+                    while not done:
+                        _, _, done, info = env.step(env.sample_legal_action(rng))
+                    final_boards.append(env.board.copy())
+                    winners.append(info["winner"])
+
+            reader = EpisodeReader(directory)
+            self.assertEqual(len(reader), 5)
+            for episode_id, (final_board, winner) in enumerate(zip(final_boards, winners)):
+                episode = reader.episode(episode_id)
+                self.assertEqual(episode.winner, winner)
+                self.assertTrue((list(reader.boards(episode_id))[-1] == final_board).all())
+                transitions = list(reader.transitions(episode_id))
+                self.assertEqual(len(transitions), len(episode.actions))
+                self.assertTrue((transitions[0][0] == 0).all())
+                if winner != 0:
+                    self.assertEqual(transitions[-1][2], episode.rewards["win_reward"])
+
+    def test_first_player_and_clear(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with EpisodeRecorder(directory) as recorder:
+                env = AnyNumberInARow3dEnv(num_grid=3, num_win_seq=3, obs_backend="numpy", recorder=recorder)
+                env.player = -1
+                env.obs_history = []
+                env.step(0)
+                # 記録中のエピソードの手は消せない
+                with self.assertRaises(ValueError):
+                    env.obs_history = []
+                for action in [1, 0, 1, 0]:
+                    env.step(action)
+            episode = EpisodeReader(directory).episode(0)
+            self.assertEqual(episode.players.tolist(), [-1, 1, -1, 1, -1])
+            self.assertEqual(episode.winner, -1)
+
+    def test_clone_does_not_record(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with EpisodeRecorder(directory) as recorder:
+                env = AnyNumberInARow3dEnv(num_grid=3, num_win_seq=3, obs_backend="numpy", recorder=recorder)
+                clone = env.clone()
+                rng = np.random.RandomState(0)
+                done = False
+                while not done:
+                    _, _, done, _ = clone.step(clone.sample_legal_action(rng))
+            self.assertEqual(recorder.num_recorded, 0)
+            self.assertIs(env.recorder, recorder)
+
+    def test_new_recorder_after_deleted_shard(self):
+        utils = UtilClass(3, 3, 10, 5, 10, 0.1, 0.1, 0.1)
+        with tempfile.TemporaryDirectory() as directory:
+            with EpisodeRecorder(directory, shard_size=1) as recorder:
+                for actions in ([0, 1, 0], [3, 4], [6, 7, 8]):
+                    recorder.record(actions, 1, 0, utils)
+            for extension in (".moves", ".index"):
+                os.remove(os.path.join(directory, "shard-00000" + extension))
+            with EpisodeRecorder(directory) as recorder:
+                recorder.record([2, 5], -1, 0, utils)
+            reader = EpisodeReader(directory)
+            self.assertEqual([reader.episode(i).actions.tolist() for i in range(len(reader))],
+                             [[3, 4], [6, 7, 8], [2, 5]])
+
+    def test_vector_env(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with EpisodeRecorder(directory) as recorder:
+                env = VectorAnyNumberInARow3dEnv(4, num_grid=3, num_win_seq=3, obs_backend="numpy",
+                                                 recorder=recorder)
+                rng = np.random.RandomState(0)
+                terminal_boards = []
+                for _ in range(60):
+                    _, _, dones, info = env.step(env.sample_legal_actions(rng))
+                    terminal_boards.extend(info["terminal_observation"])
+
+            reader = EpisodeReader(directory)
+            self.assertEqual(len(reader), len(terminal_boards))
+            for episode_id, terminal_board in enumerate(terminal_boards):
+                self.assertTrue((list(reader.boards(episode_id))[-1] == terminal_board).all())
+
+
+class TestSymmetry(unittest.TestCase):
+    def test_actions_follow_boards(self):
+        rng = np.random.RandomState(0)
+        env = AnyNumberInARow3dEnv(num_grid=4, num_win_seq=5, obs_backend="numpy", record_history=True)
+        env.reset()
+        for _ in range(20):
+            env.step(env.sample_legal_action(rng))
+        for sym in range(symmetry.NUM_SYMMETRIES):
+            moves = env.moves.copy()
+            moves[:, 0] = symmetry.transform_action(moves[:, 0], sym, 4)
+            replayed = list(gym_3d_connectX.envs.utility.iter_boards(moves, 4))[-1]
+            self.assertTrue((replayed == symmetry.transform_board(env.board, sym)).all())
+            self.assertTrue((symmetry.transform_plane(env.legal_mask, sym)
+                             == symmetry.transform_plane(env.legal_mask.ravel(), sym).reshape(4, 4)).all())
+
+    def test_batch_of_flat_planes(self):
+        # バッチの大きさが N * N でも、1枚の (N * N, N * N) の平面と取り違えない
+        rng = np.random.RandomState(2)
+        boards = rng.randint(-1, 2, size=(16, 4, 4, 4)).astype(np.int8)
+        policies = rng.random_sample((16, 16))
+        for sym in range(symmetry.NUM_SYMMETRIES):
+            expected = np.stack([symmetry.transform_plane(policy, sym) for policy in policies])
+            self.assertTrue((symmetry.transform_plane(policies, sym, num_grid=4) == expected).all())
+        _, planes = symmetry.augment(boards, planes=policies)
+        expected = np.stack([symmetry.transform_plane(policy, 1) for policy in policies])
+        self.assertTrue((planes[16:32] == expected).all())
+
+    def test_canonical_hash(self):
+        rng = np.random.RandomState(1)
+        boards = rng.randint(-1, 2, size=(5, 4, 4, 4)).astype(np.int8)
+        keys, syms = symmetry.canonical_hash(boards, return_symmetry=True)
+        self.assertEqual(keys.shape, (5,))
+        for board, key, sym in zip(boards, keys, syms):
+            self.assertEqual(symmetry.board_hash(symmetry.transform_board(board, sym)), key)
+            for other in range(symmetry.NUM_SYMMETRIES):
+                self.assertEqual(symmetry.canonical_hash(symmetry.transform_board(board, other)), key)
+        augmented, actions = symmetry.augment(boards, np.arange(5))
+        self.assertEqual(augmented.shape, (40, 4, 4, 4))
+        self.assertEqual(len(set(symmetry.canonical_hash(augmented).tolist())), len(set(keys.tolist())))
+
+
+class TestRendering(unittest.TestCase):
+    def test_scatter_data(self):
+        boards = np.random.RandomState(0).randint(-1, 2, size=(3, 4, 4, 4)).astype(np.int8)
+        data = rendering.scatter_data(boards, drop_empty=False)
+        rows = [(j, k, i, boards[f][i][j][k], f)
+                for f in range(3) for i in range(4) for j in range(4) for k in range(4)]
+        self.assertEqual(list(zip(*(data[key].tolist() for key in ("W", "D", "H", "Player", "frame")))), rows)
+        data = rendering.scatter_data(boards)
+        self.assertEqual(len(data["Player"]), np.count_nonzero(boards))
+        self.assertTrue((data["Player"] != 0).all())
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with EpisodeRecorder(directory) as recorder:
+                env = AnyNumberInARow3dEnv(num_grid=3, num_win_seq=3, obs_backend="numpy", recorder=recorder)
+                env.reset()
+                done = False
+                rng = np.random.RandomState(0)
+                while not done:
+                    _, _, done, _ = env.step(env.sample_legal_action(rng))
+            reader = EpisodeReader(directory)
+            paths = rendering.export_episodes(reader, directory + "/json", fmt="json")
+            with open(paths[0]) as f:
+                document = json.load(f)
+            self.assertEqual(document["num_frames"], len(reader.episode(0).actions))
+            self.assertEqual(len(document["Player"]), sum(range(1, document["num_frames"] + 1)))
+            try:
+                import plotly  # noqa: F401
+            except ImportError:
+                self.skipTest("plotly is not installed")
+            fig = rendering.make_figure(np.stack(list(reader.boards(0))), animate=True)
+            self.assertEqual(len(fig.frames), document["num_frames"])
+            self.assertEqual(len(fig.frames[-1].data[0].x), document["num_frames"])
+            path, = rendering.export_episodes(reader, directory + "/html", fmt="html")
+            self.assertTrue(os.path.getsize(path) > 0)
+
+    def test_export_empty_episode(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with EpisodeRecorder(directory) as recorder:
+                recorder.record([], 1, 0, UtilClass(3, 3, 10, 5, 10, 0.1, 0.1, 0.1))
+            path, = rendering.export_episodes(EpisodeReader(directory), directory + "/json", fmt="json")
+            with open(path) as f:
+                document = json.load(f)
+            self.assertEqual((document["num_frames"], len(document["Player"])), (1, 0))
+
+
+def _first_legal_policy(obs, legal_mask):
+    return int(np.flatnonzero(legal_mask)[0])
+
+
+def _illegal_policy(obs, legal_mask):
+    return -1
+
+
+class TestArena(unittest.TestCase):
+    def test_play_match(self):
+        result = arena.play_match(arena.random_policy, arena.random_policy, 8, num_workers=2,
+                                  num_grid=3, num_win_seq=3)
+        self.assertEqual(result.wins + result.draws + result.losses, 8)
+        self.assertEqual([game.game_id for game in result.games], list(range(8)))
+        self.assertEqual([game.a_first for game in result.games], [True, False] * 4)
+        self.assertTrue(result.elo_lower <= result.elo <= result.elo_upper)
+
+    def test_forfeit(self):
+        result = arena.play_match(_first_legal_policy, _illegal_policy, 4, num_workers=0, num_grid=3, num_win_seq=3)
+        self.assertEqual((result.wins, result.forfeits), (4, (0, 4)))
+        self.assertEqual(result.elo, float("inf"))
+        # 先手なら最初の手で、後手なら相手の1手の後に反則負けになる
+        self.assertEqual([game.num_moves for game in result.games], [1, 0, 1, 0])
+
+    def test_no_games(self):
+        result = arena.play_match(arena.random_policy, arena.random_policy, 0, num_workers=2, num_grid=3, num_win_seq=3)
+        self.assertEqual((result.wins, result.draws, result.losses, result.games), (0, 0, 0, []))
+
+    def test_elo(self):
+        self.assertEqual(arena.elo_from_score(0.5), 0)
+        self.assertAlmostEqual(arena.elo_from_score(10 / 11), 400)
+
+
+class TestFeatures(unittest.TestCase):
+    def test_incremental_matches_recompute(self):
+        rng = np.random.RandomState(0)
+        env = FeaturePlanesWrapper(AnyNumberInARow3dEnv(num_grid=4, num_win_seq=3, obs_backend="numpy"))
+        reference = FeatureExtractor(4, 3)
+        line_table = get_line_table(4, 3)
+        for _ in range(3):
+            obs = env.reset()
+            self.assertEqual(obs.shape, env.observation_space.shape)
+            done = False
+            while not done:
+                obs, _, done, _ = env.step(rng.randint(16))
+                reference.set_board(env.board)
+                self.assertTrue((obs == reference.planes(env.player)).all())
+            # 開いているラインの数を全ラインから数え直して比べる
+            stones = env.board.ravel()[line_table.lines]
+            own, opponent = (stones == env.player).sum(axis=1), (stones == -env.player).sum(axis=1)
+            for k in range(1, 3):
+                expected = np.bincount(line_table.lines[(own == k) & (opponent == 0)].ravel(), minlength=64)
+                self.assertTrue((obs[1 + k].ravel() == expected).all())
+
+    def test_winning_cells(self):
+        env = FeaturePlanesWrapper(AnyNumberInARow3dEnv(num_grid=4, num_win_seq=4, obs_backend="numpy"))
+        env.reset()
+        for action in (0, 4, 1, 5, 2):
+            obs = env.step(action)[0]
+        # 後手の手番。先手は (0, 0, 3) に置けば勝つので、後手はそこを塞ぐ必要がある
+        self.assertEqual(env.player, -1)
+        self.assertEqual(np.flatnonzero(obs[9]).tolist(), [3])
+        self.assertFalse(obs[8].any())
+        self.assertTrue((obs[11] == 0).all())
+
+
+class TestMCTS(unittest.TestCase):
+    @staticmethod
+    def _threat_board():
+        env = AnyNumberInARow3dEnv(num_grid=4, num_win_seq=4, obs_backend="numpy")
+        env.reset()
+        for action in (0, 4, 1, 5, 2):
+            env.step(action)
+        return env.board.copy()
+
+    def test_win_and_block(self):
+        board = self._threat_board()
+        search = mcts.MCTS(num_grid=4, num_win_seq=4, batch_size=8)
+        self.assertEqual(search.best_action(board, -1, num_simulations=400), 3)
+        board[0, 1, 3] = -1
+        stats = search.search(board, 1, num_simulations=200)
+        self.assertEqual(stats.visits.argmax(), 3)
+        self.assertGreater(stats.value, 0.5)
+        self.assertEqual(stats.visits.sum(), 199)
+
+    def test_parallel_search(self):
+        stats = mcts.parallel_search(self._threat_board(), -1, num_simulations=50, num_workers=2,
+                                     num_grid=4, num_win_seq=4)
+        self.assertEqual(stats.visits.sum(), 2 * 49)
+
+
+class TestProfiling(unittest.TestCase):
+    def test_stats(self):
+        phases = []
+        env = AnyNumberInARow3dEnv(obs_backend="numpy", profile_callback=lambda phase, seconds: phases.append(phase))
+        self.assertEqual(AnyNumberInARow3dEnv(obs_backend="numpy").profile_stats(), {})
+        env.reset()
+        for action in (0, 1, 2):
+            env.step(action)
+        stats = env.profile_stats()
+        self.assertEqual(stats["reset"]["calls"], 2)
+        for phase in profiling.STEP_PHASES:
+            self.assertEqual(stats[phase]["calls"], 3)
+            self.assertGreaterEqual(stats[phase]["seconds"], 0)
+        self.assertEqual(phases[-5:], list(profiling.STEP_PHASES))
+
+        merged = profiling.merge_stats([stats, stats])
+        self.assertEqual(merged["decode"]["calls"], 6)
+        self.assertAlmostEqual(merged["placing"]["seconds"], 2 * stats["placing"]["seconds"])
+
+    def test_callback_not_timed(self):
+        # 遅いコールバックの時間は、次の段階の時間に含まれない
+        profiler = profiling.StepProfiler(lambda phase, seconds: time.sleep(0.05))
+        profiler.start()
+        profiler.lap("first")
+        profiler.lap("second")
+        self.assertLess(profiler.stats()["second"]["seconds"], 0.04)
+
+
+class TestPlayout(unittest.TestCase):
+    def test_outcomes_follow_rules(self):
+        utils = UtilClass(3, 3, 0, 0, 0, 0, 0, 0)
+        result = playout.random_playouts(50, num_grid=3, num_win_seq=3, batch_size=16, return_moves=True,
+                                         random_state=np.random.RandomState(0))
+        self.assertTrue((result.winners != 0).any())
+        for winner, length, actions in zip(result.winners, result.lengths, result.moves):
+            self.assertTrue((actions[length:] == -1).all())
+            moves = np.stack([actions[:length], np.where(np.arange(length) % 2 == 0, 1, -1)], axis=1)
+            boards = list(iter_boards(moves, 3))
+            self.assertFalse(any(utils.is_done(board) for board in boards[:-1]))
+            self.assertEqual(utils.is_done(boards[-1]), winner != 0)
+            if winner == 0:
+                self.assertEqual(length, 27)
+            else:
+                self.assertEqual(winner, moves[-1, 1])
+
+    def test_start_position_and_prior(self):
+        board = np.zeros((4, 4, 4), dtype=np.int8)
+        board[0, 0, :3] = 1
+        board[0, 1, :3] = -1
+        prior = np.zeros(16)
+        prior[3] = 1
+        result = playout.random_playouts(10, board=board, player_number=1, prior=prior, epsilon=0)
+        self.assertTrue((result.winners == 1).all())
+        self.assertTrue((result.lengths == 1).all())
+        rates = playout.first_player_advantage(200, num_grid=3, num_win_seq=3, random_state=np.random.RandomState(0))
+        self.assertAlmostEqual(rates["first"] + rates["second"] + rates["draw"], 1)
+
+
+def _random_move(board, player, legal_mask):
+    return int(np.random.choice(np.flatnonzero(legal_mask)))
+
+
+def _failing_batch_policy(boards, players, legal_masks):
+    raise RuntimeError("model failure")
+
+
+class TestServer(unittest.TestCase):
+    def test_matches_against_model(self):
+        async def run():
+            game_server = server.GameServer(num_grid=3, num_win_seq=3, max_wait=0.01)
+            host, port = await game_server.start()
+            try:
+                results = await asyncio.gather(*[server.play_games(_random_move, 10, host=host, port=port,
+                                                                   concurrency=5) for _ in range(4)])
+            finally:
+                await game_server.close()
+            return game_server, results
+
+        game_server, results = asyncio.run(run())
+        self.assertEqual([len(result) for result in results], [10] * 4)
+        self.assertEqual(game_server.num_finished, 40)
+        # 複数の試合のモデルの手がまとめて評価されている
+        self.assertLess(game_server.num_batches, game_server.num_model_moves)
+
+    def test_remote_pair_and_forfeit(self):
+        async def run():
+            game_server = server.GameServer(num_grid=3, num_win_seq=3)
+            host, port = await game_server.start()
+            try:
+                results = await asyncio.gather(
+                    server.play_games(_random_move, 3, host=host, port=port, opponent="remote"),
+                    server.play_games(_random_move, 3, host=host, port=port, opponent="remote"))
+                client = await server.GameClient.connect(host, port)
+                await client.join(seat=1)
+                state = await client.receive()
+                await client.move(state.match_id, 9)
+                final = await client.receive()
+                await client.close()
+            finally:
+                await game_server.close()
+            return results, state, final
+
+        results, state, final = asyncio.run(run())
+        self.assertEqual([sorted(result) for result in results][0], sorted(-r for r in results[1]))
+        self.assertEqual((state.player, state.to_move, state.done), (1, 1, False))
+        self.assertTrue(final.done)
+        self.assertEqual(final.winner, -1)
+
+    def test_seats(self):
+        async def run():
+            game_server = server.GameServer(num_grid=3, num_win_seq=3)
+            host, port = await game_server.start()
+            try:
+                # どちらの手番でもよい場合、モデルとの試合の手番は交互になる
+                client = await server.GameClient.connect(host, port)
+                await client.join()
+                await client.join()
+                model_players = sorted([(await client.receive()).player for _ in range(2)])
+                await client.close()
+                # 後手を指定した接続と組まれると、どちらでもよい接続は先手になる
+                second = await server.GameClient.connect(host, port)
+                await second.join("remote", seat=-1)
+                either = await server.GameClient.connect(host, port)
+                await either.join("remote")
+                remote_player = (await either.receive()).player
+                await second.close()
+                await either.close()
+                # 同じ手番を指定した接続どうしは組まれない
+                clients = [await server.GameClient.connect(host, port) for _ in range(2)]
+                for client in clients:
+                    await client.join("remote", seat=1)
+                    await client.join(seat=1)
+                    await client.receive()
+                num_waiting = len(game_server._waiting)
+                for client in clients:
+                    await client.close()
+            finally:
+                await game_server.close()
+            return model_players, remote_player, num_waiting
+
+        model_players, remote_player, num_waiting = asyncio.run(run())
+        self.assertEqual(model_players, [-1, 1])
+        self.assertEqual(remote_player, 1)
+        self.assertEqual(num_waiting, 2)
+
+    def test_policy_error_and_bad_messages(self):
+        async def run():
+            game_server = server.GameServer(num_grid=3, num_win_seq=3, batch_policy=_failing_batch_policy)
+            host, port = await game_server.start()
+            try:
+                # モデルが例外を出しても試合は終わり、後続の試合も止まらない
+                results = await asyncio.wait_for(server.play_games(_random_move, 3, host=host, port=port), 5)
+                # 待機中の接続からの2回目の参加は、自分自身と組まれない
+                first = await server.GameClient.connect(host, port)
+                await first.join("remote", seat=1)
+                await first.join("remote", seat=1)
+                second = await server.GameClient.connect(host, port)
+                await second.join("remote")
+                state = await asyncio.wait_for(first.receive(), 5)
+                paired = (len(game_server._waiting), len(game_server._matches))
+                await first.close()
+                await second.close()
+                # 空のメッセージを送った接続は閉じられる
+                client = await server.GameClient.connect(host, port)
+                server._write_message(client._writer, b"")
+                with self.assertRaises(asyncio.IncompleteReadError):
+                    await asyncio.wait_for(client.receive(), 5)
+                await client.close()
+            finally:
+                await game_server.close()
+            return game_server, results, state, paired
+
+        game_server, results, state, paired = asyncio.run(run())
+        self.assertEqual(results, [1, 1, 1])
+        self.assertEqual(game_server.num_policy_errors, 3)
+        self.assertEqual((state.player, state.done), (1, False))
+        self.assertEqual(paired, (0, 1))
+        with self.assertRaises(ValueError):
+            asyncio.run(server.play_games(_random_move, 2, port=1, opponent="remote", concurrency=2))
+
+
+class TestSparse(unittest.TestCase):
+    def test_same_as_dense_env(self):
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            dense = AnyNumberInARow3dEnv(num_grid=4, num_win_seq=3, obs_backend="numpy", obs_dtype="int8")
+            sparse = SparseAnyNumberInARow3dEnv(num_grid=4, num_win_seq=3, obs_mode="dense")
+            done = False
+            while not done:
+                # 満杯の柱も選び、置けない場合の報酬も比べる
+                action = int(rng.randint(16))
+                obs, reward, done, info = dense.step(action)
+                sparse_obs, sparse_reward, sparse_done, sparse_info = sparse.step(action)
+                np.testing.assert_array_equal(sparse_obs, obs)
+                self.assertEqual((sparse_reward, sparse_done, sparse_info["winner"], sparse_info["turn"]),
+                                 (reward, done, info["winner"], info["turn"]))
+                np.testing.assert_array_equal(sparse_info["action_mask"], info["action_mask"])
+            np.testing.assert_array_equal(SparseBoard.from_board(dense.board, 3).to_dense(), dense.board)
+
+    def test_large_board_without_line_table(self):
+        env = SparseAnyNumberInARow3dEnv(num_grid=32, num_win_seq=5)
+        for action in [0, 1, 0, 1, 0, 1, 0, 1]:
+            coords, _, done, _ = env.step(action)
+            self.assertFalse(done)
+        coords, reward, done, info = env.step(0)
+        self.assertTrue(done)
+        self.assertEqual(info["winner"], 1)
+        self.assertEqual(coords.shape, (9, 4))
+        np.testing.assert_array_equal(coords[:3], [[0, 0, 0, 1], [0, 0, 1, -1], [1, 0, 0, 1]])
+        np.testing.assert_array_equal(env.moves[:, 0], [0, 1, 0, 1, 0, 1, 0, 1, 0])
+        self.assertEqual(env.observation("dense").shape, (32, 32, 32))
+        self.assertTrue(env.observation_space.contains(coords))
+        self.assertTrue(env.observation_space.contains(env.reset()))
+        self.assertTrue(env.observation_space.contains(env.observation_space.sample()))
+        self.assertFalse(env.observation_space.contains(np.zeros((1, 4), dtype=np.int32)))
+        self.assertNotIn((32, 5), _LINE_TABLE_CACHE)
+
+    def test_diagonal_and_undo(self):
+        board = SparseBoard(8, 4)
+        # 高さ方向を含む斜めのライン (i, i, i)
+        for i in range(4):
+            for _ in range(i):
+                board.place(i, i, -1)
+            cell = board.place(i, i, 1)
+        self.assertTrue(board.is_win_at(cell, 1))
+        self.assertTrue(board.is_done())
+        board.undo(3, 3)
+        self.assertFalse(board.is_done())
+        self.assertEqual(board.num_stones, 9)
+
+
+class TestOpeningBook(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "book.bin")
+        opening_book.main([self.path, "--num-grid", "3", "--num-win-seq", "3", "--max-plies", "2",
+                           "--search-depth", "3", "--num-workers", "0"])
+
+    @classmethod
+    def tearDownClass(self):
+        self.directory.cleanup()
+
+    def test_lookup_matches_search(self):
+        book = opening_book.OpeningBook(self.path)
+        self.assertEqual(len(book), len(opening_book.enumerate_positions(3, 3, 2)))
+        # 対称性を持たない局面: プレーヤー1が柱 (0, 1)、プレーヤー-1が柱 (0, 0)
+        board = np.zeros((3, 3, 3), dtype=np.int8)
+        board[0, 0, 1], board[0, 0, 0] = 1, -1
+        entry = book.lookup(board, 1)
+        result = NegamaxSolver(3, 3, max_depth=3).search(board, 1)
+        self.assertEqual((entry.value, entry.depth, entry.exact), (result.value, result.depth, result.exact))
+        for s in range(symmetry.NUM_SYMMETRIES):
+            transformed = book.lookup(symmetry.transform_board(board, s), 1)
+            self.assertEqual(transformed.action, symmetry.transform_action(entry.action, s, 3))
+        # 手番から見た盤面が同じなら同じ局面
+        self.assertEqual(book.lookup(-board, -1), entry)
+        board[1, 0, 0] = 1
+        self.assertIsNone(book.lookup(board, -1))
+
+    def test_solver_and_policy_use_book(self):
+        book = opening_book.OpeningBook(self.path)
+        board = np.zeros((3, 3, 3), dtype=np.int8)
+        result = NegamaxSolver(3, 3, max_depth=3, book=book).search(board, 1)
+        self.assertEqual(result.nodes, 0)
+        self.assertEqual(result.action, book.lookup(board, 1).action)
+        policy = pickle.loads(pickle.dumps(opening_book.BookPolicy(self.path, arena.random_policy)))
+        self.assertEqual(policy(board, np.ones((3, 3), dtype=bool)), result.action)
+
+
 if __name__ == '__main__':
     unittest.main()